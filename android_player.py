@@ -12,28 +12,58 @@ from kivy.uix.gridlayout import GridLayout
 from kivy.uix.button import Button
 from kivy.uix.slider import Slider
 from kivy.uix.label import Label
+from kivy.uix.widget import Widget
 from kivy.uix.video import Video
 from kivy.uix.popup import Popup
 from kivy.uix.filechooser import FileChooserListView
 from kivy.properties import StringProperty, NumericProperty, BooleanProperty
 from kivy.clock import Clock
 from kivy.core.window import Window
-from kivy.graphics import Color, Rectangle
+from kivy.graphics import Color, Rectangle, Line, Mesh
 from kivy.utils import platform
 import os
+import bisect
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import mp4_index
+import waveform
+from media_cache import DiskCache, file_fingerprint
+
+
+# 音频波形（峰值金字塔）缓存的容量
+WAVEFORM_CACHE_BYTES = 128 * 1024 ** 2
 
 
 class ABLoopController:
     """AB循环控制器"""
+    # A点向前吸附到关键帧的最大距离（秒），跳回关键帧更快更准
+    KEYFRAME_SNAP = 0.5
+
     def __init__(self):
         self.point_a = None
         self.point_b = None
         self.is_a_set = False
         self.is_b_set = False
         self.enabled = False
+        self.keyframes = []
+
+    def set_keyframes(self, times):
+        self.keyframes = sorted(times)
+
+    def snap(self, position):
+        """吸附到 position 之前最近的关键帧（距离在 KEYFRAME_SNAP 以内时）"""
+        i = bisect.bisect_right(self.keyframes, position) - 1
+        if i >= 0 and position - self.keyframes[i] <= self.KEYFRAME_SNAP:
+            return self.keyframes[i]
+        return position
 
     def set_a(self, position):
-        self.point_a = position
+        self.point_a = self.snap(position)
         self.is_a_set = True
         return True
 
@@ -74,6 +104,132 @@ class ABLoopController:
         return f"{minutes:02d}:{secs:02d}"
 
 
+class WaveformWidget(Widget):
+    """音频波形：按可见范围和宽度只读取需要的一级峰值；单击跳转，双击放大，三击还原"""
+    # 波形高度，以及放大时最短的可见范围（秒）
+    WAVEFORM_HEIGHT = 60
+    MIN_SPAN = 1.0
+
+    def __init__(self, on_seek=None, **kwargs):
+        super().__init__(**kwargs)
+        self.size_hint_y = None
+        self.height = 0
+        self.on_seek = on_seek
+        self.path = None
+        self.header = None
+        self.levels = {}
+        self.view = None
+        self.position = 0.0
+        self.point_a = None
+        self.point_b = None
+        self.bind(pos=self.redraw, size=self.redraw)
+
+    def set_waveform(self, path):
+        """显示波形文件 path（None 时隐藏）"""
+        self.header = None
+        if path is not None:
+            try:
+                self.header = waveform.read_header(path)
+            except (OSError, waveform.WaveformError) as e:
+                print(f"读取波形失败: {e}")
+        self.path = path if self.header is not None else None
+        self.levels = {}
+        self.view = None
+        self.height = self.WAVEFORM_HEIGHT if self.header is not None else 0
+        self.redraw()
+
+    def set_position(self, position):
+        """播放位置（秒）；放大时可见范围跟随播放位置"""
+        self.position = position
+        if self.header is None:
+            return
+        if self.view is not None and not self.view[0] <= position <= self.view[1]:
+            span = self.view[1] - self.view[0]
+            start = min(max(position - span * 0.1, 0), self.header['duration'] - span)
+            self.view = (start, start + span)
+        self.redraw()
+
+    def set_loop(self, point_a, point_b):
+        self.point_a = point_a
+        self.point_b = point_b
+        self.redraw()
+
+    def visible_range(self):
+        return self.view or (0.0, self.header['duration'])
+
+    def time_at(self, x):
+        start, end = self.visible_range()
+        return start + min(max((x - self.x) / max(self.width, 1), 0.0), 1.0) * (end - start)
+
+    def peaks(self, level):
+        # 每级只在第一次用到时从文件读取
+        if level not in self.levels:
+            self.levels[level] = waveform.level_peaks(self.path, self.header, level)
+        return self.levels[level]
+
+    def redraw(self, *args):
+        self.canvas.clear()
+        width = int(self.width)
+        if self.header is None or width <= 0 or self.height <= 0:
+            return
+        start, end = self.visible_range()
+
+        def x(t):
+            return self.x + (t - start) / (end - start) * self.width
+
+        level = waveform.choose_level(self.header, end - start, width)
+        try:
+            peaks = self.peaks(level)
+        except (OSError, waveform.WaveformError) as e:
+            print(f"读取波形失败: {e}")
+            return
+        mins, maxs = waveform.column_peaks(
+            peaks, self.header['levels'][level]['samples_per_peak'], self.header['sample_rate'],
+            start, end, width)
+        # 每个像素一条竖线：(x, 下端), (x, 上端)
+        middle = self.y + self.height / 2
+        vertices = numpy.zeros((width, 2, 4))
+        vertices[:, :, 0] = (self.x + numpy.arange(width))[:, None]
+        vertices[:, 0, 1] = middle + mins * self.height / 2
+        vertices[:, 1, 1] = middle + maxs * self.height / 2
+
+        with self.canvas:
+            Color(0.09, 0.13, 0.24, 1)
+            Rectangle(pos=self.pos, size=self.size)
+            if self.point_a is not None:
+                point_b = self.point_b if self.point_b is not None else self.position
+                Color(1, 0.6, 0, 0.3)
+                Rectangle(pos=(x(self.point_a), self.y),
+                          size=(max(x(point_b) - x(self.point_a), 1), self.height))
+            Color(0.3, 0.69, 0.31, 1)
+            Mesh(vertices=vertices.ravel().tolist(), indices=list(range(width * 2)), mode='lines')
+            Color(0.96, 0.26, 0.21, 1)
+            playhead = x(self.position)
+            Line(points=[playhead, self.y, playhead, self.top])
+
+    def on_touch_down(self, touch):
+        if self.header is None or not self.collide_point(*touch.pos):
+            return super().on_touch_down(touch)
+        if touch.is_triple_tap:
+            self.view = None
+        elif touch.is_double_tap:
+            self.zoom(self.time_at(touch.x), 0.25)
+        elif self.on_seek is not None:
+            self.on_seek(self.time_at(touch.x))
+        self.redraw()
+        return True
+
+    def zoom(self, center, factor):
+        duration = self.header['duration']
+        start, end = self.visible_range()
+        span = min(max((end - start) * factor, self.MIN_SPAN), duration)
+        if span >= duration:
+            self.view = None
+        else:
+            start = min(max(center - (center - start) * span / (end - start), 0), duration - span)
+            self.view = (start, start + span)
+
+
 class PlayerLayout(BoxLayout):
     """播放器主布局"""
 
@@ -144,6 +300,10 @@ class PlayerLayout(BoxLayout):
             height=50
         )
         self.progress_slider.bind(value=self.on_slider_change)
+
+        # 音频波形（进度条上方，生成后才显示）
+        self.waveform = WaveformWidget(on_seek=self.seek_to)
+        self.add_widget(self.waveform)
         self.add_widget(self.progress_slider)
 
         # 播放控制按钮
@@ -358,6 +518,40 @@ class PlayerLayout(BoxLayout):
             self.file_label.text = f'📁 {os.path.basename(filepath)}'
             self.ab_controller.reset()
             self.update_ab_status()
+            self.waveform.set_waveform(None)
+            threading.Thread(target=self.analyze_file, args=(filepath,), daemon=True).start()
+
+    def analyze_file(self, filepath):
+        """在后台线程读取关键帧（大文件的moov解析较慢）并生成波形，完成后回到主线程应用"""
+        keyframes = mp4_index.keyframe_times(filepath)
+        Clock.schedule_once(lambda dt: self.on_keyframes_ready(filepath, keyframes))
+        if waveform.can_build(filepath):
+            self.build_waveform(filepath)
+
+    def on_keyframes_ready(self, filepath, keyframes):
+        if filepath == self.current_file:
+            self.ab_controller.set_keyframes(keyframes)
+
+    def build_waveform(self, filepath):
+        """生成（或从缓存取）波形（在后台线程中调用），完成后回到主线程显示"""
+        cache_dir = os.path.join(App.get_running_app().user_data_dir, 'waveforms')
+        try:
+            key = f'waveform:{file_fingerprint(filepath)}:8:{waveform.VERSION}'
+            peaks = DiskCache(cache_dir, WAVEFORM_CACHE_BYTES).get_or_create(
+                key, '.peaks', lambda temp_path: waveform.build_waveform(filepath, temp_path))
+        except (OSError, waveform.WaveformError) as e:
+            print(f"生成波形失败: {e}")
+            return
+        Clock.schedule_once(lambda dt: self.on_waveform_ready(filepath, peaks))
+
+    def on_waveform_ready(self, filepath, peaks):
+        if filepath == self.current_file:
+            self.waveform.set_waveform(peaks)
+
+    def seek_to(self, seconds):
+        """跳转到 seconds 秒（Video.seek 的参数是占总时长的比例）"""
+        if self.video.loaded and self.video.duration > 0:
+            self.video.seek(seconds / self.video.duration)
 
     def play_pause(self, instance):
         """播放/暂停"""
@@ -394,7 +588,7 @@ class PlayerLayout(BoxLayout):
             position = self.video.position
             self.ab_controller.set_a(position)
             self.update_ab_status()
-            self.set_a_btn.text = f'A: {self.ab_controller.format_time(position)}'
+            self.set_a_btn.text = f'A: {self.ab_controller.format_time(self.ab_controller.point_a)}'
 
     def set_point_b(self, instance):
         """设置B点"""
@@ -425,6 +619,7 @@ class PlayerLayout(BoxLayout):
             b_time = self.ab_controller.format_time(self.ab_controller.point_b)
             self.ab_status_label.text = f'AB循环: {a_time} - {b_time} ✓'
             self.ab_status_label.color = (0.3, 0.69, 0.31, 1)
+        self.waveform.set_loop(self.ab_controller.point_a, self.ab_controller.point_b)
 
     def on_position_change(self, instance, value):
         """位置变化回调"""
@@ -432,6 +627,8 @@ class PlayerLayout(BoxLayout):
             self.progress_slider.value = (value / self.video.duration) * 100
 
         # 检查AB循环
+        self.waveform.set_position(value)
+
         if self.ab_controller.enabled:
             loop_pos = self.ab_controller.check_loop(value)
             if loop_pos is not None:
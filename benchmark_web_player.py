@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+全能播放器 - Web版压力测试
+在本机启动 web_player，用生成的媒体文件（有ffmpeg时为真实的MP4，否则为WAV噪声）模拟多个客户端（开始播放、随机跳转、AB循环），
+统计吞吐量、首字节耗时、跳转耗时和服务器内存，写出JSON报告便于不同版本对比
+"""
+
+import os
+import sys
+import json
+import time
+import wave
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import platform
+import threading
+import subprocess
+import http.client
+import urllib.parse
+from datetime import datetime
+
+
+# 各操作的默认权重
+PATTERN_WEIGHTS = {'play': 1, 'seek': 2, 'ab': 2}
+
+# 开始播放时读取的字节数，以及跳转后读取的字节数（浏览器拿到这些数据后通常会中断连接）
+PLAY_BYTES = 8 * 1024 * 1024
+SEEK_BYTES = 1024 * 1024
+
+# 跳转耗时：从发出请求到收到这么多字节（足够开始解码）为止
+SEEK_READY_BYTES = 256 * 1024
+
+# AB循环区间的长度（字节），所有客户端循环同一段，模拟课堂上跟读同一句
+AB_BYTES = 2 * 1024 * 1024
+
+READ_CHUNK = 64 * 1024
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='全能播放器 - Web版压力测试')
+    parser.add_argument('--sizes', default='64,512',
+                        help='生成的媒体文件大小MB，逗号分隔（默认64,512）')
+    parser.add_argument('--clients', type=int, default=20, help='并发客户端数（默认20）')
+    parser.add_argument('--duration', type=float, default=20.0, help='测试秒数（默认20）')
+    parser.add_argument('--patterns', default='play:1,seek:2,ab:2',
+                        help='操作及权重，如 play:1,seek:2,ab:2')
+    parser.add_argument('--server', choices=['waitress', 'dev'], default='waitress',
+                        help='web_player 使用的服务器（默认waitress）')
+    parser.add_argument('--server-args', default='',
+                        help='传给 web_player.py 的其它参数，如 "--threads 32 --block-cache 512"')
+    parser.add_argument('--port', type=int, default=0, help='端口（默认自动选择空闲端口）')
+    parser.add_argument('--seed', type=int, default=1, help='随机数种子（默认1）')
+    parser.add_argument('--output', default='benchmark_report.json',
+                        help='JSON报告路径（默认benchmark_report.json）')
+    return parser.parse_args()
+
+
+def parse_patterns(value):
+    weights = {}
+    for item in value.split(','):
+        name, _, weight = item.partition(':')
+        if name not in PATTERN_WEIGHTS:
+            raise SystemExit(f'未知的操作: {name}（可选 {", ".join(PATTERN_WEIGHTS)}）')
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def generate_mp4(path, size_mb):
+    """用ffmpeg生成约 size_mb MB 的MP4（带噪点的测试画面，几乎不可压缩；每2秒一个关键帧）"""
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        return False
+    args = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-y',
+            '-f', 'lavfi', '-i', 'testsrc2=size=640x360:rate=25,noise=alls=60:allf=t',
+            '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=44100',
+            '-c:v', 'mpeg4', '-q:v', '2', '-g', '50', '-c:a', 'aac',
+            '-t', '36000', '-fs', str(size_mb * 1024 * 1024), '-movflags', '+faststart', path]
+    try:
+        subprocess.run(args, check=True, stdin=subprocess.DEVNULL, timeout=600)
+        return True
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"⚠️  ffmpeg生成测试文件失败，改用WAV: {e}")
+        return False
+
+
+def generate_wav(path, size_mb):
+    """生成 size_mb MB 的WAV（16位立体声白噪声，不可压缩）"""
+    block = os.urandom(1024 * 1024)
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(44100)
+        for i in range(size_mb):
+            # 每MB内容不同，避免存储层去重
+            data = i.to_bytes(8, 'little') + block[8:]
+            if i == size_mb - 1:
+                data = data[:len(data) - 44]  # 给文件头留出位置，总大小正好 size_mb MB
+            f.writeframesraw(data)
+
+
+def generate_media(directory, sizes_mb):
+    """生成指定大小的测试文件，返回 [(文件名, 实际字节数)]
+
+    文件内容必须与扩展名一致：服务器会按扩展名解析文件（如MP4的moov索引），
+    把随机字节命名为 .mp4 测到的是解析失败的路径。
+    """
+    files = []
+    for size_mb in sizes_mb:
+        name = f'bench_{size_mb}MB.mp4'
+        path = os.path.join(directory, name)
+        if not generate_mp4(path, size_mb):
+            if os.path.exists(path):
+                os.remove(path)
+            name = f'bench_{size_mb}MB.wav'
+            path = os.path.join(directory, name)
+            generate_wav(path, size_mb)
+        files.append((name, os.path.getsize(path)))
+    return files
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(media_dir, home_dir, port, server, extra_args):
+    """启动 web_player 子进程（数据目录放在临时目录，不影响正常使用的索引和缓存）"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web_player.py')
+    env = dict(os.environ, HOME=home_dir, USERPROFILE=home_dir, PYTHONIOENCODING='utf-8')
+    args = [sys.executable, script, media_dir, '--port', str(port), '--server', server]
+    args += extra_args.split()
+    return subprocess.Popen(args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_until_ready(port, expected_files, timeout=60):
+    """等待服务器启动并扫描完测试文件"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/api/files?limit=1')
+            response = conn.getresponse()
+            data = json.loads(response.read())
+            conn.close()
+            if data.get('total', 0) >= expected_files:
+                return
+        except (OSError, ValueError, http.client.HTTPException):
+            pass
+        time.sleep(0.2)
+    raise SystemExit('服务器启动超时')
+
+
+def read_rss(pid):
+    """进程常驻内存字节数（Linux读/proc，其它系统需要psutil，都不可用时返回None）"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except Exception:
+        return None
+
+
+class Client(threading.Thread):
+    """一个模拟客户端：按权重随机执行操作，直到测试结束"""
+
+    def __init__(self, port, files, weights, ab_regions, deadline, seed):
+        super().__init__(daemon=True)
+        self.port = port
+        self.files = files
+        self.patterns = list(weights)
+        self.weights = [weights[p] for p in self.patterns]
+        self.ab_regions = ab_regions
+        self.deadline = deadline
+        self.random = random.Random(seed)
+        self.conn = None
+        self.results = []
+
+    def run(self):
+        while time.perf_counter() < self.deadline:
+            pattern = self.random.choices(self.patterns, self.weights)[0]
+            name, size = self.random.choice(self.files)
+            if pattern == 'play':
+                result = self.fetch(name, 0, None, PLAY_BYTES)
+            elif pattern == 'seek':
+                start = self.random.randrange(0, max(size - SEEK_BYTES, 1))
+                result = self.fetch(name, start, None, SEEK_BYTES)
+            else:
+                start = self.ab_regions[name]
+                result = self.fetch(name, start, start + AB_BYTES - 1, AB_BYTES)
+            result['pattern'] = pattern
+            self.results.append(result)
+
+    def fetch(self, name, start, end, limit):
+        """发出Range请求并读取最多 limit 字节；没读完就中断时关闭连接（与浏览器一致）"""
+        path = '/media/' + urllib.parse.quote(name)
+        started = time.perf_counter()
+        result = {'ttfb': None, 'ready': None, 'bytes': 0, 'error': None}
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+            self.conn.request('GET', path, headers={
+                'Range': f'bytes={start}-{"" if end is None else end}'})
+            response = self.conn.getresponse()
+            # 首字节：收到响应头为止（不含读取第一块数据的时间）
+            result['ttfb'] = time.perf_counter() - started
+            if response.status not in (200, 206):
+                raise http.client.HTTPException(f'HTTP {response.status}')
+            while result['bytes'] < limit:
+                chunk = response.read(min(READ_CHUNK, limit - result['bytes']))
+                if not chunk:
+                    break
+                now = time.perf_counter()
+                result['bytes'] += len(chunk)
+                if result['ready'] is None and result['bytes'] >= min(SEEK_READY_BYTES, limit):
+                    result['ready'] = now - started
+            if response.length:
+                self.conn.close()
+                self.conn = None
+        except (OSError, http.client.HTTPException) as e:
+            result['error'] = str(e)
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+        result['elapsed'] = time.perf_counter() - started
+        return result
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def latency_summary(values):
+    return {
+        'count': len(values),
+        'p50_ms': _ms(percentile(values, 50)),
+        'p90_ms': _ms(percentile(values, 90)),
+        'p99_ms': _ms(percentile(values, 99)),
+        'max_ms': _ms(max(values) if values else None),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def fetch_metrics(port):
+    """服务器 /metrics 中的缓存指标（没有该接口时返回空）"""
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        conn.request('GET', '/metrics')
+        response = conn.getresponse()
+        text = response.read().decode('utf-8', 'replace')
+        conn.close()
+    except (OSError, http.client.HTTPException):
+        return {}
+    if response.status != 200:
+        return {}
+    metrics = {}
+    for line in text.splitlines():
+        if line.startswith('web_player_block_cache') or line.startswith('web_player_disk_cache'):
+            name, _, value = line.rpartition(' ')
+            try:
+                metrics[name] = float(value)
+            except ValueError:
+                pass
+    return metrics
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              timeout=10).stdout.decode().strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def build_report(args, weights, files, results, elapsed, rss_samples, metrics):
+    ok = [r for r in results if r['error'] is None]
+    total_bytes = sum(r['bytes'] for r in results)
+    patterns = {}
+    for pattern in weights:
+        items = [r for r in ok if r['pattern'] == pattern]
+        patterns[pattern] = {
+            'requests': len(items),
+            'bytes': sum(r['bytes'] for r in items),
+            'ttfb': latency_summary([r['ttfb'] for r in items if r['ttfb'] is not None]),
+            'elapsed': latency_summary([r['elapsed'] for r in items]),
+        }
+    rss = [value for value in rss_samples if value is not None]
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'config': {
+            'server': args.server, 'server_args': args.server_args, 'clients': args.clients,
+            'duration': args.duration, 'patterns': weights, 'seed': args.seed,
+            'files': [{'name': name, 'bytes': size} for name, size in files],
+        },
+        'requests': len(results),
+        'errors': len(results) - len(ok),
+        'bytes': total_bytes,
+        'throughput_mbps': round(total_bytes * 8 / 1e6 / elapsed, 2),
+        'requests_per_sec': round(len(results) / elapsed, 2),
+        'ttfb': latency_summary([r['ttfb'] for r in ok if r['ttfb'] is not None]),
+        'seek_latency': latency_summary([r['ready'] for r in ok
+                                         if r['pattern'] == 'seek' and r['ready'] is not None]),
+        'patterns': patterns,
+        'server_rss_bytes': {'peak': max(rss) if rss else None,
+                             'final': rss[-1] if rss else None},
+        'server_metrics': metrics,
+    }
+
+
+def print_report(report):
+    print("=" * 50)
+    print(f"请求: {report['requests']}（失败 {report['errors']}）, "
+          f"{report['requests_per_sec']} 次/秒")
+    print(f"吞吐量: {report['throughput_mbps']} Mbps")
+    ttfb, seek = report['ttfb'], report['seek_latency']
+    print(f"首字节: p50 {ttfb['p50_ms']}ms, p99 {ttfb['p99_ms']}ms")
+    print(f"跳转:   p50 {seek['p50_ms']}ms, p99 {seek['p99_ms']}ms")
+    for name, item in report['patterns'].items():
+        print(f"  {name:5} {item['requests']:6} 次, 首字节 p50 {item['ttfb']['p50_ms']}ms "
+              f"p99 {item['ttfb']['p99_ms']}ms")
+    peak = report['server_rss_bytes']['peak']
+    if peak is not None:
+        print(f"服务器内存峰值: {peak / 1024 ** 2:.1f} MB")
+    print("=" * 50)
+
+
+def main():
+    args = parse_args()
+    weights = parse_patterns(args.patterns)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    work_dir = tempfile.mkdtemp(prefix='web_player_bench_')
+    media_dir = os.path.join(work_dir, 'media')
+    home_dir = os.path.join(work_dir, 'home')
+    os.makedirs(media_dir)
+    os.makedirs(home_dir)
+    server = None
+    try:
+        print(f"📦 生成测试文件: {', '.join(f'{s}MB' for s in sizes)}")
+        files = generate_media(media_dir, sizes)
+        print(f"   {', '.join(name for name, _ in files)}")
+        rng = random.Random(args.seed)
+        ab_regions = {name: rng.randrange(0, max(size - AB_BYTES, 1)) for name, size in files}
+
+        port = args.port or free_port()
+        print(f"🚀 启动服务器（{args.server}，端口 {port}）")
+        server = start_server(media_dir, home_dir, port, args.server, args.server_args)
+        wait_until_ready(port, len(files))
+
+        print(f"⏱️  {args.clients} 个客户端，运行 {args.duration:g} 秒...")
+        started = time.perf_counter()
+        deadline = started + args.duration
+        clients = [Client(port, files, weights, ab_regions, deadline, args.seed * 1000 + i)
+                   for i in range(args.clients)]
+        for client in clients:
+            client.start()
+        rss_samples = []
+        while any(client.is_alive() for client in clients):
+            rss_samples.append(read_rss(server.pid))
+            time.sleep(0.5)
+        elapsed = time.perf_counter() - started
+
+        results = [result for client in clients for result in client.results]
+        report = build_report(args, weights, files, results, elapsed, rss_samples,
+                              fetch_metrics(port))
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print_report(report)
+        print(f"📄 报告已写入 {args.output}")
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -36,7 +36,7 @@ version = 1.0.0
 
 # (list) Application requirements
 # comma separated e.g. requirements = sqlite3,kivy
-requirements = python3,kivy==2.2.1,ffpyplayer
+requirements = python3,kivy==2.2.1,ffpyplayer,numpy
 
 # (str) Custom source folders for requirements
 # Sets custom source for any requirements with recipes
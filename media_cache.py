@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+全能播放器 - 缓存
+DiskCache: 有容量上限的磁盘LRU缓存，用于AB片段等生成的文件
+file_fingerprint: 按文件内容计算的指纹，文件改名/移动后缓存仍然有效
+BlockCache: 内存中的文件块LRU缓存，多个客户端播放同一文件时从内存发送
+"""
+
+import os
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+# 计算指纹时读取文件开头和结尾的字节数
+FINGERPRINT_SAMPLE = 64 * 1024
+
+_fingerprints = OrderedDict()
+_fingerprints_lock = threading.Lock()
+
+
+def file_fingerprint(path):
+    """文件内容指纹：大小 + 开头和结尾各64KB的SHA1（按路径、大小、修改时间缓存）"""
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    with _fingerprints_lock:
+        fingerprint = _fingerprints.get(key)
+    if fingerprint is not None:
+        return fingerprint
+
+    digest = hashlib.sha1(str(st.st_size).encode('ascii'))
+    with open(path, 'rb') as f:
+        digest.update(f.read(FINGERPRINT_SAMPLE))
+        if st.st_size > FINGERPRINT_SAMPLE:
+            f.seek(max(st.st_size - FINGERPRINT_SAMPLE, FINGERPRINT_SAMPLE))
+            digest.update(f.read(FINGERPRINT_SAMPLE))
+    fingerprint = digest.hexdigest()
+    with _fingerprints_lock:
+        _fingerprints[key] = fingerprint
+        while len(_fingerprints) > 1024:
+            _fingerprints.popitem(last=False)
+    return fingerprint
+
+
+class DiskCache:
+    """有容量上限的磁盘LRU缓存
+
+    - 每个key对应目录下的一个文件，文件名为key的哈希加扩展名
+    - 生成时先写临时文件再原子改名，不会读到写了一半的文件
+    - 同一个key同时只生成一次，其它请求等待结果
+    - 超出容量时删除最久未使用的文件
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._files = OrderedDict()
+        self._total = 0
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        existing = []
+        for entry in os.scandir(directory):
+            if not entry.is_file():
+                continue
+            if entry.name.startswith('tmp-'):
+                # 上次退出时没写完的临时文件
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+                continue
+            st = entry.stat()
+            existing.append((st.st_atime, entry.name, st.st_size))
+        for _, name, size in sorted(existing):
+            self._files[name] = size
+            self._total += size
+
+    @staticmethod
+    def _filename(key, suffix):
+        return hashlib.sha1(key.encode('utf-8')).hexdigest() + suffix
+
+    def get(self, key, suffix=''):
+        """已缓存则返回文件路径（并标记为最近使用），否则返回None"""
+        name = self._filename(key, suffix)
+        with self._lock:
+            if name not in self._files:
+                self.misses += 1
+                return None
+            self._files.move_to_end(name)
+            self.hits += 1
+        return os.path.join(self.directory, name)
+
+    def contains(self, key, suffix=''):
+        with self._lock:
+            return self._filename(key, suffix) in self._files
+
+    def temp_path(self, suffix=''):
+        """同目录下的临时文件路径（保留扩展名，方便ffmpeg识别格式）"""
+        return os.path.join(self.directory, f'tmp-{uuid.uuid4().hex}{suffix}')
+
+    def put(self, key, temp_path, suffix=''):
+        """把生成好的临时文件放入缓存，返回最终路径"""
+        name = self._filename(key, suffix)
+        path = os.path.join(self.directory, name)
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._total -= self._files.pop(name, 0)
+            self._files[name] = size
+            self._total += size
+            self._evict()
+        return path
+
+    def get_or_create(self, key, suffix, producer):
+        """取缓存文件，不存在时调用 producer(临时路径) 生成"""
+        path = self.get(key, suffix)
+        if path is not None:
+            return path
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # 可能已由等待期间的另一个请求生成
+            if self.contains(key, suffix):
+                return self.get(key, suffix)
+            temp_path = self.temp_path(suffix)
+            try:
+                producer(temp_path)
+                return self.put(key, temp_path, suffix)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                with self._lock:
+                    self._key_locks.pop(key, None)
+
+    def _evict(self):
+        """删除最久未使用的文件直到不超过容量（调用时已持有锁）"""
+        while self._total > self.max_bytes and len(self._files) > 1:
+            name, size = next(iter(self._files.items()))
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # Windows下正在发送的文件无法删除，移到队尾下次再试
+                self._files.move_to_end(name)
+                break
+            del self._files[name]
+            self._total -= size
+
+    def stats(self):
+        with self._lock:
+            return {'files': len(self._files), 'bytes': self._total,
+                    'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+class BlockCache:
+    """多个客户端共享的内存文件块缓存
+
+    - 文件按固定大小分块缓存，最久未使用的块先淘汰，总大小不超过 max_bytes
+    - 键包含文件大小和修改时间，文件变化后旧块自然失效
+    - 未命中时连同之后 read_ahead 块一次读出（对NAS等慢速存储只发一次大读请求）
+    - 多个客户端同时未命中同一块时只读一次磁盘，其它客户端等待并直接使用读出的数据（不论是否放入缓存）
+    - 块第二次从磁盘读取时才放入缓存：只顺序读一遍的客户端不会挤掉AB循环反复读取的块
+      （第一次只记下块的键，最多记 ghost_factor 倍缓存块数）
+    """
+
+    def __init__(self, max_bytes, block_size=256 * 1024, read_ahead=4, ghost_factor=2):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.read_ahead = read_ahead
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # 第一次读取、没有放入缓存的块数
+        self.bypassed = 0
+        # 等待其它请求读出后直接使用的块数
+        self.shared = 0
+        self._lock = threading.Lock()
+        self._blocks = OrderedDict()
+        self._loading = {}
+        self._total = 0
+        # 读过一次的块的键（不含数据）
+        self._seen = OrderedDict()
+        self._max_seen = max(max_bytes // block_size, 1) * ghost_factor
+
+    def open(self, path, admit=False):
+        """以只读文件对象打开，读取都经过缓存（admit 为True时第一次读取就放入缓存，用于预读）"""
+        return CachedFile(self, path, admit)
+
+    def get_block(self, file_key, f, index, ahead=None, admit=False):
+        """取第 index 块（file_key 为 (路径, 大小, 修改时间)，f 为已打开的文件）
+
+        一起读出但没有放入缓存的后续块放进 ahead（{块号: 数据}），由调用者自己使用。
+        """
+        while True:
+            with self._lock:
+                data = self._blocks.get((file_key, index))
+                if data is not None:
+                    self._blocks.move_to_end((file_key, index))
+                    self.hits += 1
+                    return data
+                load = self._loading.get((file_key, index))
+                if load is None:
+                    self.misses += 1
+                    claimed = self._claim(file_key, index)
+                    load = _BlockLoad()
+                    for i in claimed:
+                        self._loading[(file_key, i)] = load
+                    break
+            # 另一个请求正在读这一块：读完后直接使用它读出的数据；它失败时由本请求重新读取
+            load.done.wait()
+            data = load.blocks.get(index)
+            if data is not None:
+                if ahead is not None:
+                    ahead.update((i, block) for i, block in load.blocks.items() if i > index)
+                with self._lock:
+                    self.shared += 1
+                return data
+
+        blocks = []
+        try:
+            f.seek(index * self.block_size)
+            data = f.read(len(claimed) * self.block_size)
+            blocks = [data[i:i + self.block_size] for i in range(0, len(data), self.block_size)]
+        finally:
+            with self._lock:
+                for i in claimed:
+                    self._loading.pop((file_key, i), None)
+                for i, block in zip(claimed, blocks):
+                    if self._admit((file_key, i), admit):
+                        self._blocks[(file_key, i)] = block
+                        self._total += len(block)
+                    elif ahead is not None and i != index:
+                        ahead[i] = block
+                self._evict()
+            load.blocks = dict(zip(claimed, blocks))
+            load.done.set()
+        return blocks[0] if blocks else b''
+
+    def _claim(self, file_key, index):
+        """本次要读取的块：index 及之后未缓存、也没有在读的最多 read_ahead 块（调用时已持有锁）"""
+        last = min(index + self.read_ahead, max(file_key[1] - 1, 0) // self.block_size)
+        claimed = [index]
+        for i in range(index + 1, last + 1):
+            if (file_key, i) in self._blocks or (file_key, i) in self._loading:
+                break
+            claimed.append(i)
+        return claimed
+
+    def _admit(self, key, force=False):
+        """块是否放入缓存：之前读过一次的放入，否则只记下键（调用时已持有锁）"""
+        if self._seen.pop(key, None) is not None or force:
+            return True
+        self.bypassed += 1
+        self._seen[key] = True
+        while len(self._seen) > self._max_seen:
+            self._seen.popitem(last=False)
+        return False
+
+    def _evict(self):
+        """淘汰最久未使用的块直到不超过容量（调用时已持有锁）"""
+        while self._total > self.max_bytes and self._blocks:
+            _, block = self._blocks.popitem(last=False)
+            self._total -= len(block)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {'blocks': len(self._blocks), 'bytes': self._total,
+                    'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'bypassed': self.bypassed, 'shared': self.shared}
+
+
+class _BlockLoad:
+    """正在从磁盘读取的一组块，读完后等待的请求直接取用 blocks（{块号: 数据}）"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.blocks = {}
+
+
+class CachedFile:
+    """通过 BlockCache 读取的只读文件对象，可以交给 wsgi.file_wrapper
+
+    没有 fileno()：服务器用 sendfile 发送时读的是真实文件的位置，和这里的读取位置无关。
+    需要 sendfile 时直接打开文件。
+    """
+
+    def __init__(self, cache, path, admit=False):
+        self._cache = cache
+        self._admit = admit
+        self._file = open(path, 'rb')
+        st = os.fstat(self._file.fileno())
+        self._key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+        self.size = st.st_size
+        self._pos = 0
+        # 最近一次从磁盘读出、没有放入缓存的后续块
+        self._ahead = {}
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self._pos
+        size = min(size, self.size - self._pos)
+        parts = []
+        while size > 0:
+            index, skip = divmod(self._pos, self._cache.block_size)
+            block = self._ahead.get(index)
+            if block is None:
+                self._ahead = {}
+                block = self._cache.get_block(self._key, self._file, index, self._ahead, self._admit)
+            piece = block[skip:skip + size]
+            if not piece:
+                break
+            parts.append(piece)
+            self._pos += len(piece)
+            size -= len(piece)
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
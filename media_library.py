@@ -0,0 +1,613 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+全能播放器 - 媒体库索引
+文件列表保存在SQLite中，启动时直接载入内存；
+扫描器用线程池并行递归遍历多个根目录，只重新扫描修改时间变化的目录，
+扫描结果边扫边写入索引；Linux上用 inotify 监视目录，只扫描发生变化的目录；
+探测到的媒体信息（时长、编码、分辨率）按文件大小和修改时间保存在同一个索引中
+"""
+
+import os
+import time
+import bisect
+import sqlite3
+import posixpath
+import threading
+from collections import namedtuple, defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from media_watcher import InotifyWatcher, WatchError
+
+
+# 媒体库中的一个文件（key 为URL中使用的名字，path 为相对根目录的路径，均以 / 分隔）
+MediaEntry = namedtuple('MediaEntry', ['key', 'root', 'path', 'size', 'mtime'])
+
+# 媒体信息的字段（探测失败时只有 error）
+META_FIELDS = ('duration', 'vcodec', 'acodec', 'width', 'height')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    PRIMARY KEY (root, path)
+);
+CREATE TABLE IF NOT EXISTS files (
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    PRIMARY KEY (root, path)
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (root, dir);
+CREATE TABLE IF NOT EXISTS meta (
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    duration REAL,
+    vcodec TEXT,
+    acodec TEXT,
+    width INTEGER,
+    height INTEGER,
+    error TEXT,
+    PRIMARY KEY (root, path)
+);
+'''
+
+
+def join_rel(rel_dir, name):
+    """拼接相对路径（统一使用 / 分隔）"""
+    return f'{rel_dir}/{name}' if rel_dir else name
+
+
+class ScanStats:
+    """一次扫描的统计"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.files = 0
+        self.dirs = 0
+        self.dirs_skipped = 0
+        self.changes = 0
+        self.elapsed = 0.0
+
+    @property
+    def files_per_sec(self):
+        return self.files / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        return (f'{self.files} 个文件, {self.dirs} 个目录（{self.dirs_skipped} 个未变化）, '
+                f'{self.changes} 处变化, 耗时 {self.elapsed:.2f}s, '
+                f'{self.files_per_sec:.0f} 文件/秒')
+
+
+class MediaLibrary:
+    """媒体库索引
+
+    - 文件信息持久化在SQLite中，启动时一次性载入内存
+    - files() 只读内存快照，不访问文件系统
+    - scan()/refresh() 按目录修改时间增量更新，只重新扫描变化的目录
+    - scan_dirs() 只扫描指定的目录（监视到变化时使用）
+    - 多个根目录时，key 以根目录名作为前缀，例如 "Movies/a/b.mp4"
+    - 媒体信息按 (大小, 修改时间) 保存，文件变化后旧信息自然失效，等待重新探测
+    """
+
+    def __init__(self, db_path, roots, extensions, scan_workers=8):
+        if isinstance(roots, str):
+            roots = [roots]
+        self.db_path = db_path
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.extensions = {ext.lower() for ext in extensions}
+        self.scan_workers = scan_workers
+        self.version = 0
+        # 媒体信息每写入一批加一（文件列表本身不变，只影响列表接口的响应内容）
+        self.meta_version = 0
+        self.last_scan = None
+        # 每次扫描结束后以 ScanStats 调用
+        self.scan_listeners = []
+        # 索引变化时以 (新增的 MediaEntry 列表, 更新的 MediaEntry 列表, 删除的 key 列表) 调用（在扫描线程中）
+        self.change_listeners = []
+        self._labels = {}
+        self._root_labels = {}
+        for root in self.roots:
+            base = os.path.basename(root.rstrip('/\\')) or 'root'
+            label, n = base, 2
+            while label in self._labels:
+                label, n = f'{base}-{n}', n + 1
+            self._labels[label] = root
+            self._root_labels[root] = label
+
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._entries = {}
+        self._dir_files = defaultdict(set)
+        self._dirs = {}
+        # {key: (大小, 修改时间, 信息)}
+        self._meta = {}
+        self._sorted = None
+        self._snapshot = None
+
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self._load()
+
+    def _load(self):
+        """从数据库载入索引"""
+        for root in self.roots:
+            for path, mtime_ns in self._db.execute(
+                    'SELECT path, mtime_ns FROM dirs WHERE root = ?', (root,)):
+                self._dirs[(root, path)] = mtime_ns
+            for path, rel_dir, size, mtime in self._db.execute(
+                    'SELECT path, dir, size, mtime FROM files WHERE root = ?', (root,)):
+                key = self.make_key(root, path)
+                self._entries[key] = MediaEntry(key, root, path, size, mtime)
+                self._dir_files[(root, rel_dir)].add(key)
+            for row in self._db.execute(
+                    'SELECT path, size, mtime, error, ' + ', '.join(META_FIELDS) +
+                    ' FROM meta WHERE root = ?', (root,)):
+                path, size, mtime, error = row[:4]
+                info = {'error': error} if error is not None else dict(zip(META_FIELDS, row[4:]))
+                self._meta[self.make_key(root, path)] = (size, mtime, info)
+
+    def is_media(self, filename):
+        return os.path.splitext(filename)[1].lower() in self.extensions
+
+    def make_key(self, root, path):
+        if len(self.roots) == 1:
+            return path
+        return f'{self._root_labels[root]}/{path}'
+
+    def split_key(self, key):
+        """key -> (根目录, 相对路径)，根目录未知时返回 (None, None)"""
+        if len(self.roots) == 1:
+            return self.roots[0], key
+        label, _, path = key.partition('/')
+        root = self._labels.get(label)
+        return (root, path) if root else (None, None)
+
+    def resolve(self, key):
+        """key -> 绝对路径；越出根目录的路径返回None（不检查文件是否存在）"""
+        root, path = self.split_key(key)
+        if not root or not path:
+            return None
+        full = os.path.abspath(os.path.join(root, *path.split('/')))
+        try:
+            if os.path.commonpath([full, root]) != root:
+                return None
+        except ValueError:
+            return None
+        return full
+
+    def files(self):
+        """按文件名排序的文件列表（内存快照）"""
+        with self._lock:
+            if self._sorted is None:
+                self._sorted = sorted(self._entries)
+            return self._sorted
+
+    def get(self, key):
+        with self._lock:
+            return self._entries.get(key)
+
+    def metadata(self, entry):
+        """entry 的媒体信息；还没探测过或文件已变化时返回None"""
+        with self._lock:
+            meta = self._meta.get(entry.key)
+        if meta is None or meta[:2] != (entry.size, entry.mtime):
+            return None
+        return meta[2]
+
+    def unprobed(self, accept=None):
+        """还没有当前媒体信息的文件，最新修改的在前；accept(路径) 为假的跳过"""
+        with self._lock:
+            entries = [entry for entry in self._entries.values()
+                       if self._meta.get(entry.key, (None, None))[:2] != (entry.size, entry.mtime)]
+        if accept is not None:
+            entries = [entry for entry in entries if accept(entry.path)]
+        entries.sort(key=lambda e: -e.mtime)
+        return entries
+
+    def set_metadata(self, results):
+        """保存探测结果 [(MediaEntry, 信息)]；探测期间已变化或删除的文件丢弃，
+        返回保存了的 [(MediaEntry, 信息)]"""
+        stored = []
+        # 与扫描互斥：确认文件仍在索引中和写入数据库之间不会被扫描删除
+        with self._refresh_lock:
+            with self._lock:
+                for entry, info in results:
+                    if self._entries.get(entry.key) != entry:
+                        continue
+                    self._meta[entry.key] = (entry.size, entry.mtime, info)
+                    stored.append((entry, info))
+                if stored:
+                    self.meta_version += 1
+            if stored:
+                rows = [(entry.root, entry.path, entry.size, entry.mtime, info.get('error'))
+                        + tuple(info.get(field) for field in META_FIELDS)
+                        for entry, info in stored]
+                with self._db:
+                    self._db.executemany(
+                        'INSERT OR REPLACE INTO meta (root, path, size, mtime, error, ' +
+                        ', '.join(META_FIELDS) + ') VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        return stored
+
+    def snapshot(self):
+        """当前版本的只读快照（用于分页和搜索，版本变化后才重建）"""
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.version != self.version:
+                snapshot = self._snapshot = LibrarySnapshot(self._entries.values(), self.version)
+            return snapshot
+
+    def refresh(self):
+        """增量扫描，返回是否有变化"""
+        return self.scan().changes > 0
+
+    def scan(self, full=False):
+        """扫描所有根目录（full=True 时忽略目录修改时间全部重扫），返回 ScanStats"""
+        return self._run_scan(full=full)
+
+    def scan_dirs(self, dirs):
+        """只重新列出指定的目录 [(根目录, 相对路径)]，并扫描其中新出现的子目录"""
+        return self._run_scan(dirs=list(dirs))
+
+    def _run_scan(self, full=False, dirs=None):
+        with self._refresh_lock:
+            stats = LibraryScanner(self, self.scan_workers).scan(full, dirs)
+            self.last_scan = stats
+        for listener in self.scan_listeners:
+            listener(stats)
+        return stats
+
+    def directories(self):
+        """已扫描过的目录 {(根目录, 相对路径): 绝对路径}"""
+        with self._lock:
+            keys = list(self._dirs)
+        return {(root, rel_dir): os.path.join(root, *rel_dir.split('/')) if rel_dir else root
+                for root, rel_dir in keys}
+
+    def _notify(self, added, updated, removed):
+        for listener in self.change_listeners:
+            listener(added, updated, removed)
+
+    # ---- 以下方法由扫描器在扫描线程中调用 ----
+
+    def _scanned_dirs(self):
+        """已扫描目录的修改时间 {(root, 目录): mtime_ns} 的副本（扫描开始时取一次，
+        之后扫描线程不再直接读会被并发修改的 _dirs）"""
+        with self._lock:
+            return dict(self._dirs)
+
+    @staticmethod
+    def _known_subdirs(scanned):
+        """已知目录的子目录表 {(root, 目录): [子目录]}（scanned 为 _scanned_dirs() 的结果）"""
+        children = defaultdict(list)
+        for root, path in scanned:
+            if path:
+                children[(root, posixpath.dirname(path))].append(path)
+        return children
+
+    def _apply_listing(self, root, rel_dir, names, subdirs, known_subdirs):
+        """目录列表：删除已不存在的文件和子目录，返回变化数"""
+        present = {self.make_key(root, join_rel(rel_dir, name)) for name in names}
+        gone_dirs = set(known_subdirs) - set(subdirs)
+        with self._lock:
+            removed = self._dir_files.get((root, rel_dir), set()) - present
+            dead_dirs = [(r, path) for r, path in self._dirs if r == root and any(
+                path == gone or path.startswith(gone + '/') for gone in gone_dirs)]
+            for dir_key in dead_dirs:
+                removed |= self._dir_files.pop(dir_key, set())
+                del self._dirs[dir_key]
+            for key in removed:
+                self._meta.pop(key, None)
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._dir_files.get((root, posixpath.dirname(entry.path)), set()).discard(key)
+            if removed:
+                self._sorted = None
+                self.version += 1
+
+        with self._db:
+            paths = [(root, self.split_key(key)[1]) for key in removed]
+            self._db.executemany('DELETE FROM files WHERE root = ? AND path = ?', paths)
+            self._db.executemany('DELETE FROM meta WHERE root = ? AND path = ?', paths)
+            self._db.executemany('DELETE FROM dirs WHERE root = ? AND path = ?', dead_dirs)
+        if removed:
+            self._notify([], [], sorted(removed))
+        return len(removed)
+
+    def _apply_stats(self, root, rel_dir, file_stats):
+        """一批文件的stat结果：新增或更新变化的文件，返回变化数"""
+        changed = []
+        added = []
+        updated = []
+        with self._lock:
+            for name, size, mtime in file_stats:
+                path = join_rel(rel_dir, name)
+                key = self.make_key(root, path)
+                old = self._entries.get(key)
+                if old is not None and (old.size, old.mtime) == (size, mtime):
+                    continue
+                entry = self._entries[key] = MediaEntry(key, root, path, size, mtime)
+                self._dir_files[(root, rel_dir)].add(key)
+                changed.append((root, path, rel_dir, size, mtime))
+                (added if old is None else updated).append(entry)
+            if changed:
+                self._sorted = None
+                self.version += 1
+
+        if changed:
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO files (root, path, dir, size, mtime) VALUES (?, ?, ?, ?, ?)',
+                    changed)
+            self._notify(added, updated, [])
+        return len(changed)
+
+    def _mark_dir_scanned(self, root, rel_dir, mtime_ns):
+        """目录里的文件全部处理完后才记录修改时间，中途退出下次会重扫"""
+        with self._lock:
+            self._dirs[(root, rel_dir)] = mtime_ns
+        with self._db:
+            self._db.execute('INSERT OR REPLACE INTO dirs (root, path, mtime_ns) VALUES (?, ?, ?)',
+                             (root, rel_dir, mtime_ns))
+
+    def start_auto_refresh(self, interval=10.0, watch=True, watch_interval=300.0):
+        """后台线程先扫描一次，之后跟踪目录变化
+
+        能用 inotify 时目录一有变化就只扫描变化的目录，另外每 watch_interval 秒
+        轮询一次兜底（网络挂载上其它机器做的修改不会产生事件）；
+        否则每 interval 秒轮询一次。
+        """
+        watcher = None
+
+        def on_change(dirs, overflow):
+            try:
+                if overflow:
+                    self.scan()
+                else:
+                    self.scan_dirs(dirs)
+                watcher.sync(self.directories())
+            except (OSError, sqlite3.Error, WatchError) as e:
+                print(f"⚠️  媒体库刷新失败: {e}")
+
+        def loop():
+            nonlocal watcher
+            stats = self.scan()
+            print(f"📚 媒体库扫描完成: {stats}")
+            poll = interval
+            if watch:
+                try:
+                    watcher = InotifyWatcher(on_change, self.is_media)
+                    watcher.sync(self.directories())
+                    watcher.start()
+                    poll = max(interval, watch_interval)
+                    print(f"👀 正在监视 {len(watcher)} 个目录的变化")
+                except WatchError as e:
+                    watcher = None
+                    print(f"⚠️  无法监视目录变化（{e}），改为每 {interval:g} 秒检查一次")
+            while not stop.wait(poll):
+                try:
+                    self.refresh()
+                    if watcher is not None:
+                        watcher.sync(self.directories())
+                except (OSError, sqlite3.Error, WatchError) as e:
+                    print(f"⚠️  媒体库刷新失败: {e}")
+
+        stop = threading.Event()
+        thread = threading.Thread(target=loop, name='media-library-refresh', daemon=True)
+        thread.start()
+        return stop
+
+
+class LibrarySnapshot:
+    """某个版本媒体库的只读视图
+
+    - 前缀搜索：在按小写名字排序的列表上二分查找
+    - 子串搜索：所有小写名字用换行拼成一个字符串，用 str.find 在C层扫描，
+      再按行起点偏移二分定位到文件
+    - 排序结果和搜索结果按 (排序方式, 关键词) 缓存
+    """
+
+    # 排序方式 -> 排序键（都按升序比较，方便用二分定位分页游标）
+    SORT_KEYS = {
+        'name': lambda e: (e.key.lower(), e.key),
+        'mtime': lambda e: (-e.mtime, e.key.lower(), e.key),
+        'size': lambda e: (-e.size, e.key.lower(), e.key),
+    }
+
+    # 缓存的搜索结果个数
+    MAX_CACHED_QUERIES = 64
+
+    def __init__(self, entries, version):
+        self.version = version
+        self.by_name = sorted(entries, key=self.SORT_KEYS['name'])
+        self.names_lower = [e.key.lower() for e in self.by_name]
+        self.text = '\n'.join(self.names_lower)
+        self.line_starts = []
+        offset = 0
+        for name in self.names_lower:
+            self.line_starts.append(offset)
+            offset += len(name) + 1
+        self._lock = threading.Lock()
+        self._results = {}
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def _search_prefix(self, prefix):
+        lo = bisect.bisect_left(self.names_lower, prefix)
+        hi = bisect.bisect_left(self.names_lower, prefix + '\U0010ffff', lo)
+        return self.by_name[lo:hi]
+
+    def _search_substring(self, needle):
+        found = []
+        pos = self.text.find(needle)
+        while pos != -1:
+            line = bisect.bisect_right(self.line_starts, pos) - 1
+            found.append(self.by_name[line])
+            if line + 1 >= len(self.line_starts):
+                break
+            pos = self.text.find(needle, self.line_starts[line + 1])
+        return found
+
+    def query(self, q='', mode='substring', sort='name'):
+        """返回 (排序后的条目列表, 对应的排序键列表)"""
+        cache_key = (q.lower(), mode, sort)
+        with self._lock:
+            result = self._results.get(cache_key)
+        if result is not None:
+            return result
+
+        needle = q.lower()
+        if not needle:
+            entries = self.by_name
+        elif mode == 'prefix':
+            entries = self._search_prefix(needle)
+        else:
+            entries = self._search_substring(needle)
+        sort_key = self.SORT_KEYS[sort]
+        if sort != 'name':
+            entries = sorted(entries, key=sort_key)
+        result = (entries, [sort_key(e) for e in entries])
+
+        with self._lock:
+            if len(self._results) >= self.MAX_CACHED_QUERIES:
+                self._results.pop(next(iter(self._results)))
+            self._results[cache_key] = result
+        return result
+
+    def page(self, q='', mode='substring', sort='name', after=None, limit=100):
+        """分页：after 为上一页最后一项的排序键，返回 (条目列表, 下一页游标或None, 总数)"""
+        entries, keys = self.query(q, mode, sort)
+        start = bisect.bisect_right(keys, tuple(after)) if after is not None else 0
+        items = entries[start:start + limit]
+        next_key = keys[start + limit - 1] if start + limit < len(entries) else None
+        return items, next_key, len(entries)
+
+
+class LibraryScanner:
+    """并行递归扫描器
+
+    目录列表（os.scandir）和文件stat都在有界线程池中执行，
+    NAS上每次stat的网络往返可以并行；每个结果一返回就写入索引。
+    """
+
+    # 每个stat任务处理的文件数
+    STAT_BATCH = 64
+
+    def __init__(self, library, max_workers=8):
+        self.library = library
+        self.max_workers = max(1, max_workers)
+
+    def scan(self, full=False, dirs=None):
+        """扫描；dirs 为 [(根目录, 相对路径)] 时只强制重新列出这些目录，
+        子目录中只扫描索引里还没有的（新出现的）"""
+        library = self.library
+        stats = ScanStats()
+        start = time.perf_counter()
+        scanned = library._scanned_dirs()
+        known_subdirs = library._known_subdirs(scanned)
+        # 每个目录还未完成的stat批次数 {(root, 目录): [剩余批次, mtime_ns]}
+        outstanding = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers,
+                                thread_name_prefix='media-scan') as pool:
+            pending = set()
+
+            def list_dir(root, rel_dir, force=False):
+                known_mtime = None if full or force else scanned.get((root, rel_dir))
+                pending.add(pool.submit(self._list_dir, root, rel_dir, known_mtime,
+                                        known_subdirs.get((root, rel_dir), [])))
+
+            if dirs is None:
+                for root in library.roots:
+                    list_dir(root, '')
+            else:
+                for root, rel_dir in dirs:
+                    list_dir(root, rel_dir, force=True)
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, root, rel_dir, payload = future.result()
+                    dir_key = (root, rel_dir)
+                    if kind == 'missing':
+                        continue
+                    if kind == 'stat':
+                        stats.files += len(payload)
+                        stats.changes += library._apply_stats(root, rel_dir, payload)
+                        outstanding[dir_key][0] -= 1
+                        if outstanding[dir_key][0] == 0:
+                            library._mark_dir_scanned(root, rel_dir, outstanding.pop(dir_key)[1])
+                        continue
+
+                    mtime_ns, names, subdirs = payload
+                    stats.dirs += 1
+                    for subdir in subdirs:
+                        if dirs is None or (root, subdir) not in scanned:
+                            list_dir(root, subdir)
+                    if names is None:
+                        stats.dirs_skipped += 1
+                        continue
+                    stats.changes += library._apply_listing(
+                        root, rel_dir, names, subdirs, known_subdirs.get(dir_key, []))
+                    batches = [names[i:i + self.STAT_BATCH]
+                               for i in range(0, len(names), self.STAT_BATCH)]
+                    if not batches:
+                        library._mark_dir_scanned(root, rel_dir, mtime_ns)
+                        continue
+                    outstanding[dir_key] = [len(batches), mtime_ns]
+                    for batch in batches:
+                        pending.add(pool.submit(self._stat_files, root, rel_dir, batch))
+
+        stats.elapsed = time.perf_counter() - start
+        return stats
+
+    def _list_dir(self, root, rel_dir, known_mtime, known_subdirs):
+        """列出目录；修改时间未变时不读目录，只返回已知的子目录"""
+        abs_dir = os.path.join(root, *rel_dir.split('/')) if rel_dir else root
+        try:
+            mtime_ns = os.stat(abs_dir).st_mtime_ns
+        except OSError:
+            return 'missing', root, rel_dir, None
+        if mtime_ns == known_mtime:
+            return 'dir', root, rel_dir, (mtime_ns, None, known_subdirs)
+
+        names = []
+        subdirs = []
+        try:
+            with os.scandir(abs_dir) as it:
+                for entry in it:
+                    if entry.name.startswith('.'):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(join_rel(rel_dir, entry.name))
+                        elif self.library.is_media(entry.name) and entry.is_file():
+                            names.append(entry.name)
+                    except OSError:
+                        continue
+        except OSError:
+            return 'missing', root, rel_dir, None
+        return 'dir', root, rel_dir, (mtime_ns, names, subdirs)
+
+    def _stat_files(self, root, rel_dir, names):
+        """stat一批文件"""
+        abs_dir = os.path.join(root, *rel_dir.split('/')) if rel_dir else root
+        result = []
+        for name in names:
+            try:
+                st = os.stat(os.path.join(abs_dir, name))
+            except OSError:
+                continue
+            result.append((name, st.st_size, st.st_mtime))
+        return 'stat', root, rel_dir, result
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+全能播放器 - 运行指标
+Counter / Gauge / Histogram: 线程安全、按标签分组的指标
+render: 以 Prometheus 文本格式输出所有指标
+"""
+
+import bisect
+import threading
+
+
+# 请求耗时的默认分桶（秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """指标基类：labels 是与 labelnames 对应的值的元组
+
+    collect 为函数时，输出时调用它取 {标签值元组: 数值}（用于缓存命中数等现成的统计）
+    """
+
+    TYPE = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def samples(self):
+        """[(名称后缀, 标签值元组, 额外标签, 数值)]"""
+        if self.collect is not None:
+            values = self.collect()
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [('', labels, '', value) for labels, value in sorted(values.items())]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.TYPE}']
+        for suffix, labels, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(self.labelnames, labels, extra)} '
+                         f'{_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """只增不减的计数"""
+
+    TYPE = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """可增可减的当前值"""
+
+    TYPE = 'gauge'
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    """分桶统计：每个标签组合记录各桶计数、总和与次数"""
+
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # [各桶计数..., +Inf桶计数, 总和]
+                state = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {labels: list(state) for labels, state in self._values.items()}
+        samples = []
+        for labels, state in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state):
+                cumulative += count
+                samples.append(('_bucket', labels, f'le="{_format_value(float(bound))}"',
+                                cumulative))
+            samples.append(('_sum', labels, '', state[-1]))
+            samples.append(('_count', labels, '', cumulative))
+        return samples
+
+
+def render():
+    """所有指标的 Prometheus 文本格式"""
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
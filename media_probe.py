@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+全能播放器 - 媒体信息探测
+probe_file: 时长、编码、分辨率；MP4/WAV/FLAC 直接解析文件头，其它格式调用 ffprobe
+MetadataProber: 后台用进程池探测媒体库中还没有信息（或文件已变化）的文件，结果写入索引
+"""
+
+import os
+import struct
+import threading
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import media_tools
+import mp4_index
+from media_tools import FFmpegError
+from mp4_index import MP4Error
+
+
+# MP4 采样描述中的编码（fourcc） -> 与 ffprobe 一致的编码名
+MP4_CODECS = {
+    'avc1': 'h264', 'avc3': 'h264', 'hvc1': 'hevc', 'hev1': 'hevc', 'av01': 'av1',
+    'vp09': 'vp9', 'mp4v': 'mpeg4', 'mp4a': 'aac', 'Opus': 'opus', '.mp3': 'mp3',
+    'ac-3': 'ac3', 'ec-3': 'eac3', 'alac': 'alac', 'fLaC': 'flac',
+}
+
+# WAV fmt 块中的格式标记
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# 不需要 ffprobe 就能探测的格式
+BUILTIN_EXTENSIONS = mp4_index.MP4_EXTENSIONS | {'.wav', '.flac'}
+
+
+class ProbeError(Exception):
+    """文件头无法解析"""
+
+
+def can_probe(path):
+    """本机能否探测这个文件（没有 ffprobe 时只支持内置解析的格式）"""
+    return media_tools.FFPROBE is not None or \
+        os.path.splitext(path)[1].lower() in BUILTIN_EXTENSIONS
+
+
+def probe_file(path):
+    """{duration, vcodec, acodec, width, height}，未知的项为None
+
+    内置解析失败（例如编码不认识）时改用 ffprobe。
+    """
+    ext = os.path.splitext(path)[1].lower()
+    parser = _probe_mp4 if ext in mp4_index.MP4_EXTENSIONS else \
+        {'.wav': _probe_wav, '.flac': _probe_flac}.get(ext)
+    if parser is not None:
+        try:
+            return parser(path)
+        except (ProbeError, MP4Error, struct.error):
+            if media_tools.FFPROBE is None:
+                raise
+    return media_tools.probe_info(path)
+
+
+def probe_or_error(path):
+    """在进程池中执行：返回探测结果，失败时返回 {'error': 原因}"""
+    try:
+        return probe_file(path)
+    except (OSError, ProbeError, MP4Error, FFmpegError, struct.error) as e:
+        return {'error': str(e) or type(e).__name__}
+
+
+def _probe_mp4(path):
+    index = mp4_index.MP4Index(path)
+    video = next((t for t in index.tracks if t.is_video), None)
+    audio = next((t for t in index.tracks if t.kind == 'soun'), None)
+    codecs = []
+    for track in (video, audio):
+        if track is None:
+            codecs.append(None)
+        elif track.codec in MP4_CODECS:
+            codecs.append(MP4_CODECS[track.codec])
+        else:
+            raise ProbeError(f'未知的编码 {track.codec!r}')
+    # 分片MP4的 moov 中没有时长
+    return {'duration': index.duration or None, 'vcodec': codecs[0], 'acodec': codecs[1],
+            'width': (video.width or None) if video else None,
+            'height': (video.height or None) if video else None}
+
+
+# WAV 文件的格式：格式标记、声道数、采样率、每秒字节数、位深，以及采样数据的位置和长度
+WavFormat = namedtuple('WavFormat', ['tag', 'channels', 'sample_rate', 'byte_rate', 'bits',
+                                     'data_offset', 'data_size'])
+
+
+def wav_format(f):
+    """解析已打开的 WAV 文件头（WAVE_FORMAT_EXTENSIBLE 取其中的实际格式），返回 WavFormat"""
+    size = os.fstat(f.fileno()).st_size
+    f.seek(0)
+    riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+    if riff != b'RIFF' or wave != b'WAVE':
+        raise ProbeError('不是 RIFF/WAVE 文件')
+    fmt = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise ProbeError('没有 data 块')
+        chunk, length = struct.unpack('<4sI', header)
+        if chunk == b'fmt ':
+            fmt = f.read(length)
+            if length < 16:
+                raise ProbeError('fmt 块不完整')
+        elif chunk == b'data':
+            if fmt is None:
+                raise ProbeError('data 块之前没有 fmt 块')
+            data_offset = f.tell()
+            # 边录边写的文件长度字段可能是0或超出文件
+            data_size = min(length, size - data_offset) if length else size - data_offset
+            break
+        else:
+            f.seek(length, os.SEEK_CUR)
+        if length % 2:
+            f.seek(1, os.SEEK_CUR)
+
+    tag, channels, sample_rate, byte_rate, _, bits = struct.unpack_from('<HHIIHH', fmt)
+    if tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+        tag = struct.unpack_from('<H', fmt, 24)[0]
+    return WavFormat(tag, channels, sample_rate, byte_rate, bits, data_offset, data_size)
+
+
+def _probe_wav(path):
+    with open(path, 'rb') as f:
+        wav = wav_format(f)
+    if wav.tag == WAVE_FORMAT_PCM:
+        codec = 'pcm_u8' if wav.bits == 8 else f'pcm_s{wav.bits}le'
+    elif wav.tag == WAVE_FORMAT_IEEE_FLOAT:
+        codec = f'pcm_f{wav.bits}le'
+    else:
+        raise ProbeError(f'不支持的 WAV 格式 0x{wav.tag:04x}')
+    if not wav.byte_rate:
+        raise ProbeError('码率为0')
+    return {'duration': wav.data_size / wav.byte_rate, 'vcodec': None, 'acodec': codec,
+            'width': None, 'height': None}
+
+
+def _probe_flac(path):
+    with open(path, 'rb') as f:
+        head = f.read(10)
+        if head[:3] == b'ID3':
+            # 开头的 ID3v2 标签：长度为4个7位字节
+            length = 0
+            for byte in head[6:10]:
+                length = (length << 7) | (byte & 0x7F)
+            f.seek(10 + length)
+        else:
+            f.seek(0)
+        if f.read(4) != b'fLaC':
+            raise ProbeError('不是 FLAC 文件')
+        block_header = f.read(4)
+        streaminfo = f.read(34)
+    if len(streaminfo) < 34 or block_header[0] & 0x7F != 0:
+        raise ProbeError('没有 STREAMINFO 块')
+    # 采样率20位、声道数3位、位深5位、总采样数36位
+    packed = int.from_bytes(streaminfo[10:18], 'big')
+    sample_rate = packed >> 44
+    total_samples = packed & ((1 << 36) - 1)
+    duration = total_samples / sample_rate if sample_rate and total_samples else None
+    return {'duration': duration, 'vcodec': None, 'acodec': 'flac', 'width': None, 'height': None}
+
+
+class MetadataProber:
+    """后台探测媒体库中缺少信息的文件
+
+    - 探测在进程池中执行，解析文件头不占用服务器进程的GIL，ffprobe 也能并行
+    - 最新修改的文件先探测；媒体库有新增或修改时唤醒
+    - 每批结果写入索引后以 [(MediaEntry, 信息)] 调用 on_probed
+    - 本机无法探测的格式（没有 ffprobe 时的 MKV 等）跳过，信息保持未知
+    - 子进程崩溃（进程池损坏）时重建进程池，把这一批逐个重新探测，
+      让子进程崩溃的文件记为探测失败，不会每次都排在最前面卡住后面的文件
+    """
+
+    # 每批探测的文件数
+    BATCH = 32
+
+    def __init__(self, library, workers=2, on_probed=None):
+        self.library = library
+        self.workers = max(1, workers)
+        self.on_probed = on_probed
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.library.change_listeners.append(self._on_change)
+        self._thread = threading.Thread(target=self._loop, name='media-prober', daemon=True)
+        self._thread.start()
+        self._wake.set()
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def pending(self):
+        """还需要探测的文件数"""
+        return len(self.library.unprobed(can_probe))
+
+    def _on_change(self, added, updated, removed):
+        if added or updated:
+            self._wake.set()
+
+    def _loop(self):
+        # spawn：子进程不继承服务器的线程和打开的连接，各平台行为一致
+        context = multiprocessing.get_context('spawn')
+        while not self._stop.is_set():
+            self._wake.wait()
+            self._wake.clear()
+            todo = self.library.unprobed(can_probe)
+            if not todo or self._stop.is_set():
+                continue
+            # 进程池只在有文件要探测时存在，空闲时不占内存
+            pool = None
+            try:
+                for start in range(0, len(todo), self.BATCH):
+                    if self._stop.is_set():
+                        break
+                    batch = todo[start:start + self.BATCH]
+                    paths = [self.library.resolve(entry.key) for entry in batch]
+                    if pool is None:
+                        pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+                    try:
+                        results = list(pool.map(probe_or_error, paths))
+                    except Exception as e:
+                        print(f"⚠️  探测媒体信息失败，逐个重新探测这一批: {e}")
+                        pool.shutdown(wait=False)
+                        pool = None
+                        results = self._probe_each(context, paths)
+                        if results is None:
+                            break
+                    probed = self.library.set_metadata(zip(batch, results))
+                    if probed and self.on_probed is not None:
+                        self.on_probed(probed)
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+
+    def _probe_each(self, context, paths):
+        """在单进程的进程池中逐个探测，进程崩溃的文件记为失败后重建进程池；停止时返回None"""
+        results = []
+        pool = None
+        try:
+            for path in paths:
+                if self._stop.is_set():
+                    return None
+                if pool is None:
+                    pool = ProcessPoolExecutor(max_workers=1, mp_context=context)
+                try:
+                    results.append(pool.submit(probe_or_error, path).result())
+                except BrokenProcessPool:
+                    print(f"⚠️  探测时进程崩溃: {path}")
+                    results.append({'error': '探测时进程崩溃'})
+                    pool.shutdown(wait=False)
+                    pool = None
+                except Exception as e:
+                    print(f"⚠️  探测媒体信息失败 {path}: {e}")
+                    results.append({'error': str(e) or type(e).__name__})
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return results
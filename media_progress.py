@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+全能播放器 - 播放进度和书签
+每个文件的播放位置、速度和当前的AB点，以及多个命名的A-B书签，保存在SQLite（WAL模式）中；
+播放位置每秒都会上报，先合并在内存中（同一文件只保留最新一次），由后台线程定期在一个事务中写入，
+进程崩溃时最多丢失最后 flush_interval 秒的进度，已写入的数据由WAL保证完整
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS progress (
+    file TEXT PRIMARY KEY,
+    position REAL NOT NULL,
+    speed REAL NOT NULL,
+    a REAL,
+    b REAL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS progress_updated ON progress (updated);
+CREATE TABLE IF NOT EXISTS bookmarks (
+    file TEXT NOT NULL,
+    name TEXT NOT NULL,
+    a REAL NOT NULL,
+    b REAL NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (file, name)
+);
+'''
+
+PROGRESS_FIELDS = ('position', 'speed', 'a', 'b', 'updated')
+
+
+class PlaybackStore:
+    """播放进度和书签
+
+    - save_progress 只更新内存中待写入的表，不访问磁盘；后台线程每 flush_interval 秒写入一次
+    - progress/recent 先看待写入的数据，读到的总是最新的
+    - 书签是用户的操作，很少发生，立即写入
+    """
+
+    def __init__(self, db_path, flush_interval=2.0):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        # 写入次数和合并掉的上报次数（用于观察合并效果）
+        self.flushes = 0
+        self.coalesced = 0
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self._lock = threading.Lock()
+        # {文件: (position, speed, a, b, updated)}
+        self._pending = {}
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name='playback-store-flush', daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"⚠️  保存播放进度失败: {e}")
+
+    def close(self):
+        """停止后台线程，写入剩余的进度"""
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+        with self._lock:
+            self._db.close()
+
+    def save_progress(self, file, position, speed, a=None, b=None):
+        with self._lock:
+            if file in self._pending:
+                self.coalesced += 1
+            self._pending[file] = (position, speed, a, b, time.time())
+
+    def flush(self):
+        """把合并后的进度在一个事务中写入
+
+        提交成功后才清空待写入的表：写入失败（磁盘满、数据库被锁等）时进度留在内存中，
+        下次再写。写入期间持有锁，不会有新的上报被清掉。
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            rows = [(file,) + values for file, values in self._pending.items()]
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO progress (file, ' + ', '.join(PROGRESS_FIELDS) +
+                    ') VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self._pending = {}
+            self.flushes += 1
+
+    def progress(self, file):
+        """{position, speed, a, b, updated}，没有记录时返回None"""
+        with self._lock:
+            values = self._pending.get(file)
+            if values is None:
+                values = self._db.execute(
+                    'SELECT ' + ', '.join(PROGRESS_FIELDS) + ' FROM progress WHERE file = ?',
+                    (file,)).fetchone()
+        return dict(zip(PROGRESS_FIELDS, values)) if values else None
+
+    def recent(self, limit=10):
+        """最近播放的文件 [(文件, 进度)]，新的在前
+
+        还没写入的进度直接合并到数据库的结果中，不必先写入；数据库出错时打印警告，只返回还没写入的进度。
+        """
+        with self._lock:
+            progress = dict(self._pending)
+            try:
+                rows = self._db.execute(
+                    'SELECT file, ' + ', '.join(PROGRESS_FIELDS) +
+                    ' FROM progress ORDER BY updated DESC LIMIT ?', (limit,)).fetchall()
+            except sqlite3.Error as e:
+                print(f"⚠️  读取播放进度失败: {e}")
+                rows = []
+        for row in rows:
+            progress.setdefault(row[0], row[1:])
+        updated = PROGRESS_FIELDS.index('updated')
+        files = sorted(progress, key=lambda file: progress[file][updated], reverse=True)[:limit]
+        return [(file, dict(zip(PROGRESS_FIELDS, progress[file]))) for file in files]
+
+    def bookmarks(self, file):
+        """文件的书签 [{name, a, b}]，按A点排序"""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT name, a, b FROM bookmarks WHERE file = ? ORDER BY a, name', (file,)).fetchall()
+        return [{'name': name, 'a': a, 'b': b} for name, a, b in rows]
+
+    def save_bookmark(self, file, name, a, b):
+        """保存书签，同名的书签被替换"""
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO bookmarks (file, name, a, b, created) VALUES (?, ?, ?, ?, ?)',
+                (file, name, a, b, time.time()))
+
+    def delete_bookmark(self, file, name):
+        """删除书签，返回是否存在"""
+        with self._lock, self._db:
+            cursor = self._db.execute('DELETE FROM bookmarks WHERE file = ? AND name = ?', (file, name))
+        return cursor.rowcount > 0
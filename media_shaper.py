@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+全能播放器 - 带宽分配
+BandwidthShaper: 按客户端的令牌桶限速，总带宽在客户端之间按权重公平分配，
+播放急需的数据优先于后台预读
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class BandwidthShaper:
+    """按客户端限速和公平分配发送带宽
+
+    - 每个客户端（按IP）一个令牌桶，速率为它分到的带宽
+    - 设置了总带宽时按权重分配：有急需数据的客户端权重更高；
+      某客户端分到的超过单客户端上限时，多出的部分分给其它客户端
+    - 按请求的意图区分急需数据和预读：只有开始播放或跳转后（同一客户端、同一文件的请求
+      不接着上次发送到的位置）的第一个响应，开头 critical_bytes 字节算作急需数据；
+      接着上次位置的请求（Service Worker 按块取数据、顺序播放）和页面标明是预读的请求
+      都是预读。同一客户端有急需数据在发送时，它的预读暂停让路
+    - 速率单位为字节/秒，0 表示不限制
+    """
+
+    def __init__(self, total_rate=0, client_rate=0, critical_bytes=2 * 1024 * 1024,
+                 critical_weight=4, burst_seconds=0.25, max_positions=1024):
+        self.total_rate = total_rate
+        self.client_rate = client_rate
+        self.critical_bytes = critical_bytes
+        self.critical_weight = critical_weight
+        self.burst_seconds = burst_seconds
+        self.max_positions = max_positions
+        self._lock = threading.Lock()
+        # 客户端的急需数据发送完时唤醒等待的预读
+        self._changed = threading.Condition(self._lock)
+        self._clients = {}
+        # {(客户端, 文件): 上次发送到的位置}，客户端没有响应在发送时也保留
+        self._positions = OrderedDict()
+
+    def open_stream(self, client, key=None, start=0, prefetch=False):
+        """开始向 client 发送一个响应
+
+        key 为文件（不区分文件时为None），start 为响应在文件中的起始位置，
+        prefetch 为页面标明的预读请求。
+        """
+        with self._lock:
+            state = self._clients.get(client)
+            if state is None:
+                state = self._clients[client] = _ClientState()
+            critical = not prefetch and not self._continues(client, key, start)
+            stream = ShapedStream(self, state, client, critical, key, start)
+            state.streams.add(stream)
+            if critical:
+                state.critical += 1
+            self._moved(client, key, start)
+            self._reallocate()
+        return stream
+
+    def _continues(self, client, key, start):
+        """请求是否接着同一文件上次发送到的位置（调用时已持有锁）"""
+        if key is None:
+            return False
+        position = self._positions.get((client, key))
+        return position is not None and abs(start - position) <= self.critical_bytes
+
+    def _moved(self, client, key, position):
+        """记下发送到的位置（调用时已持有锁）"""
+        if key is None:
+            return
+        self._positions[(client, key)] = position
+        self._positions.move_to_end((client, key))
+        while len(self._positions) > self.max_positions:
+            self._positions.popitem(last=False)
+
+    def _reallocate(self):
+        """重新计算各客户端的速率，唤醒等待的预读（调用时已持有锁）"""
+        self._changed.notify_all()
+        active = {client: state for client, state in self._clients.items() if state.streams}
+        for client in [c for c in self._clients if c not in active]:
+            del self._clients[client]
+        cap = self.client_rate or float('inf')
+        if not self.total_rate:
+            for state in active.values():
+                state.rate = cap
+            return
+
+        # 按权重分配总带宽，超过单客户端上限的部分再分给其余客户端
+        pending = dict(active)
+        remaining = float(self.total_rate)
+        while pending:
+            total_weight = sum(self._weight(state) for state in pending.values())
+            capped = {client: state for client, state in pending.items()
+                      if remaining * self._weight(state) / total_weight > cap}
+            if not capped:
+                for state in pending.values():
+                    state.rate = remaining * self._weight(state) / total_weight
+                break
+            for client, state in capped.items():
+                state.rate = cap
+                remaining -= cap
+                del pending[client]
+
+    def _weight(self, state):
+        return self.critical_weight if state.critical else 1
+
+    def allocations(self):
+        """当前各客户端的分配情况"""
+        now = time.monotonic()
+        with self._lock:
+            clients = []
+            for client, state in sorted(self._clients.items()):
+                clients.append({
+                    'client': client,
+                    'rate': None if state.rate == float('inf') else round(state.rate),
+                    'throughput': round(state.throughput(now)),
+                    'streams': len(state.streams),
+                    'critical_streams': state.critical,
+                    'sent': state.sent,
+                })
+        return {'total_rate': self.total_rate or None, 'client_rate': self.client_rate or None,
+                'clients': clients}
+
+
+class _ClientState:
+    __slots__ = ('streams', 'critical', 'rate', 'tokens', 'updated', 'sent',
+                 'window_start', 'window_bytes', 'last_rate')
+
+    def __init__(self):
+        self.streams = set()
+        self.critical = 0
+        self.rate = float('inf')
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.sent = 0
+        self.window_start = self.updated
+        self.window_bytes = 0
+        self.last_rate = 0.0
+
+    def throughput(self, now):
+        """最近一秒左右的实际发送速率（字节/秒）"""
+        elapsed = now - self.window_start
+        if elapsed >= 1.0:
+            return self.window_bytes / elapsed
+        return self.last_rate
+
+    def record(self, n, now):
+        self.sent += n
+        self.window_bytes += n
+        if now - self.window_start >= 1.0:
+            self.last_rate = self.window_bytes / (now - self.window_start)
+            self.window_start = now
+            self.window_bytes = 0
+
+
+class ShapedStream:
+    """一个响应的发送配额，发送每块数据前调用 consume"""
+
+    def __init__(self, shaper, state, client, critical, key=None, start=0):
+        self._shaper = shaper
+        self._state = state
+        self.client = client
+        self.key = key
+        self.start = start
+        self.sent = 0
+        self.critical = critical
+        self.closed = False
+
+    def consume(self, n):
+        """等到令牌桶允许发送 n 字节"""
+        shaper, state = self._shaper, self._state
+        with shaper._lock:
+            # 同一客户端有急需数据在发送时，预读让路
+            while not self.critical and state.critical:
+                shaper._changed.wait()
+            now = time.monotonic()
+            if state.rate != float('inf'):
+                burst = state.rate * shaper.burst_seconds
+                state.tokens = min(state.tokens + (now - state.updated) * state.rate, burst)
+                state.tokens -= n
+            state.updated = now
+            wait = -state.tokens / state.rate if state.tokens < 0 else 0.0
+            state.record(n, now)
+            self.sent += n
+            shaper._moved(self.client, self.key, self.start + self.sent)
+            if self.critical and self.sent >= shaper.critical_bytes:
+                self.critical = False
+                state.critical -= 1
+                shaper._reallocate()
+        if wait > 0:
+            time.sleep(wait)
+
+    def close(self):
+        with self._shaper._lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.critical:
+                self._state.critical -= 1
+            self._state.streams.discard(self)
+            self._shaper._reallocate()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+全能播放器 - 进度条预览缩略图
+整个视频按固定间隔截取缩略图，拼成一张雪碧图（sprite sheet）；
+sprite_layout 给出布局（间隔、张数、行列、每张大小），tile_at 把时间换算为图中的位置，
+拖动或悬停进度条时只需在这张图上取一块显示，不用真正跳转
+"""
+
+import math
+
+import media_tools
+
+
+# 每张缩略图的宽度（高度按视频比例）、每行张数
+THUMB_WIDTH = 160
+THUMB_COLUMNS = 10
+
+# 一个文件最多截取的张数，以及截取间隔的下限（秒，短视频不会截出大量重复画面）
+MAX_THUMBS = 100
+MIN_INTERVAL = 2.0
+
+# 雪碧图的JPEG质量（ffmpeg -q:v，2最好，31最差）
+JPEG_QUALITY = 5
+
+
+def sprite_layout(duration, width, height, tile_width=THUMB_WIDTH, columns=THUMB_COLUMNS,
+                  max_thumbs=MAX_THUMBS, min_interval=MIN_INTERVAL):
+    """雪碧图布局；没有画面（纯音频）或时长未知时返回None"""
+    if not duration or not width or not height:
+        return None
+    interval = max(duration / max_thumbs, min_interval)
+    count = max(1, min(math.ceil(duration / interval), max_thumbs))
+    columns = min(columns, count)
+    # 宽高取偶数（yuvj420p 要求）
+    tile_height = max(2, round(tile_width * height / width / 2) * 2)
+    return {
+        'interval': round(interval, 3),
+        'count': count,
+        'columns': columns,
+        'rows': math.ceil(count / columns),
+        'tile_width': tile_width,
+        'tile_height': tile_height,
+    }
+
+
+def tile_at(layout, t):
+    """时间 t（秒）对应的缩略图在雪碧图中的左上角坐标 (x, y)"""
+    index = min(max(round(t / layout['interval']), 0), layout['count'] - 1)
+    row, column = divmod(index, layout['columns'])
+    return column * layout['tile_width'], row * layout['tile_height']
+
+
+def make_sprite(src, dst, layout):
+    """用 ffmpeg 生成雪碧图（JPEG）
+
+    只解码关键帧（-skip_frame nokey），fps 滤镜按间隔取最接近的关键帧，
+    长视频也只需顺序读一遍文件，不用逐张跳转。
+    """
+    vf = (f"fps=1/{layout['interval']},"
+          f"scale={layout['tile_width']}:{layout['tile_height']},"
+          f"tile={layout['columns']}x{layout['rows']}")
+    media_tools.run([media_tools.FFMPEG, '-hide_banner', '-loglevel', 'error', '-y',
+                     '-skip_frame', 'nokey', '-i', src, '-map', '0:v:0', '-an', '-sn', '-dn',
+                     '-vf', vf, '-frames:v', '1', '-q:v', str(JPEG_QUALITY),
+                     '-f', 'image2', dst], timeout=1800)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+全能播放器 - ffmpeg工具
+调用本机的 ffmpeg/ffprobe 截取片段、查询关键帧、切分HLS片段、转封装、多码率转码等
+"""
+
+import os
+import json
+import heapq
+import shutil
+import itertools
+import threading
+import subprocess
+from concurrent.futures import Future
+
+
+FFMPEG = shutil.which('ffmpeg')
+FFPROBE = shutil.which('ffprobe')
+
+# 音频格式：所有帧都可以独立解码，截取时总是直接复制
+AUDIO_ONLY_EXTENSIONS = {'.mp3', '.wav', '.flac', '.aac', '.m4a', '.ogg', '.wma'}
+
+# 直接复制流时片段使用的容器
+COPY_CONTAINERS = {'.mp4': '.mp4', '.m4v': '.mp4', '.mov': '.mp4', '.webm': '.webm',
+                   '.mkv': '.mkv'}
+
+
+class FFmpegError(Exception):
+    """ffmpeg/ffprobe 不可用或执行失败"""
+
+
+def have_ffmpeg():
+    return FFMPEG is not None and FFPROBE is not None
+
+
+def run(args, timeout=300):
+    """执行 ffmpeg/ffprobe，返回标准输出"""
+    if args[0] is None:
+        raise FFmpegError('未找到 ffmpeg/ffprobe，请先安装并加入PATH')
+    try:
+        result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise FFmpegError(f'{os.path.basename(args[0])} 执行超时')
+    if result.returncode != 0:
+        message = result.stderr.decode('utf-8', 'replace').strip().splitlines()
+        raise FFmpegError(message[-1] if message else f'{args[0]} 返回 {result.returncode}')
+    return result.stdout
+
+
+def keyframes_near(path, t, window=10.0):
+    """查询 t 之前 window 秒内视频的关键帧时间（升序），只读取这一小段"""
+    out = run([FFPROBE, '-v', 'error', '-select_streams', 'v:0', '-skip_frame', 'nokey',
+               '-read_intervals', f'{max(t - window, 0):.3f}%{t + 0.1:.3f}',
+               '-show_entries', 'frame=pts_time,best_effort_timestamp_time',
+               '-of', 'csv=p=0', path], timeout=60)
+    times = []
+    for line in out.decode('ascii', 'replace').splitlines():
+        for value in line.split(','):
+            try:
+                times.append(float(value))
+                break
+            except ValueError:
+                continue
+    return sorted(times)
+
+
+def clip_suffix(path, copy):
+    """片段文件的扩展名"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in AUDIO_ONLY_EXTENSIONS:
+        return ext
+    if copy:
+        return COPY_CONTAINERS.get(ext, ext)
+    return '.mp4'
+
+
+def cut_clip(src, dst, start, end, copy=True):
+    """截取 [start, end) 到 dst
+
+    copy=True 时直接复制音视频流，不重新编码（起点需落在关键帧上才准确）；
+    否则用 H.264/AAC 重新编码，任意起点都精确。
+    """
+    args = [FFMPEG, '-hide_banner', '-loglevel', 'error', '-y',
+            '-ss', f'{start:.3f}', '-i', src, '-t', f'{end - start:.3f}',
+            '-map', '0:v:0?', '-map', '0:a:0?', '-sn', '-dn']
+    if copy:
+        args += ['-c', 'copy', '-avoid_negative_ts', 'make_zero']
+    else:
+        args += ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '20',
+                 '-c:a', 'aac', '-b:a', '160k']
+    if dst.endswith('.mp4'):
+        args += ['-movflags', '+faststart']
+    run(args + [dst])
+
+
+def probe_duration(path):
+    """媒体时长（秒）"""
+    out = run([FFPROBE, '-v', 'error', '-show_entries', 'format=duration',
+               '-of', 'csv=p=0', path], timeout=60)
+    try:
+        return float(out.decode('ascii', 'replace').strip())
+    except ValueError:
+        raise FFmpegError('无法获取时长')
+
+
+def keyframe_times(path):
+    """视频轨道所有关键帧的时间（只读包头，不解码）"""
+    out = run([FFPROBE, '-v', 'error', '-select_streams', 'v:0',
+               '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', path],
+              timeout=1800)
+    times = []
+    for line in out.decode('ascii', 'replace').splitlines():
+        pts, _, flags = line.partition(',')
+        if 'K' in flags:
+            try:
+                times.append(float(pts))
+            except ValueError:
+                continue
+    return sorted(times)
+
+
+def plan_segments(keyframes, duration, target):
+    """按关键帧切分为约 target 秒的片段，返回 [(起点, 终点)]
+
+    没有关键帧信息时按固定时长切分；结尾过短的片段并入前一段。
+    """
+    bounds = [0.0]
+    if keyframes:
+        for k in keyframes:
+            if k - bounds[-1] >= target and k < duration:
+                bounds.append(k)
+    else:
+        while bounds[-1] + target < duration:
+            bounds.append(bounds[-1] + target)
+    if len(bounds) > 1 and duration - bounds[-1] < target / 3:
+        bounds.pop()
+    return list(zip(bounds, bounds[1:] + [duration]))
+
+
+def cut_segment(src, dst, start, end):
+    """把 [start, end) 直接复制为 MPEG-TS 片段，时间戳保持与原文件一致"""
+    run([FFMPEG, '-hide_banner', '-loglevel', 'error', '-y',
+         '-ss', f'{start:.3f}', '-i', src, '-t', f'{end - start:.3f}',
+         '-map', '0:v:0?', '-map', '0:a:0?', '-sn', '-dn', '-c', 'copy',
+         '-output_ts_offset', f'{start:.3f}', '-muxdelay', '0', '-f', 'mpegts', dst])
+
+
+# 浏览器 <video> 普遍支持、可以直接复制到MP4的编码
+BROWSER_VIDEO_CODECS = {'h264', 'vp9', 'av1'}
+BROWSER_AUDIO_CODECS = {'aac', 'mp3', 'opus'}
+
+
+def probe_codecs(path):
+    """第一条视频轨道和音频轨道的编码名，没有则为None"""
+    out = run([FFPROBE, '-v', 'error', '-show_entries', 'stream=codec_type,codec_name',
+               '-of', 'json', path], timeout=60)
+    try:
+        streams = json.loads(out.decode('utf-8', 'replace')).get('streams', [])
+    except ValueError:
+        raise FFmpegError('无法解析 ffprobe 输出')
+    video = next((s.get('codec_name') for s in streams if s.get('codec_type') == 'video'), None)
+    audio = next((s.get('codec_name') for s in streams if s.get('codec_type') == 'audio'), None)
+    return video, audio
+
+
+def remux_profile(path):
+    """转封装方案 "视频-音频"：copy 表示直接复制，否则为转码目标编码"""
+    video, audio = probe_codecs(path)
+    video_mode = 'copy' if video is None or video in BROWSER_VIDEO_CODECS else 'h264'
+    audio_mode = 'copy' if audio is None or audio in BROWSER_AUDIO_CODECS else 'aac'
+    return f'{video_mode}-{audio_mode}'
+
+
+def _remux_args(path, profile):
+    """转封装为分片MP4的 ffmpeg 参数（不含输出位置）"""
+    if FFMPEG is None:
+        raise FFmpegError('未找到 ffmpeg/ffprobe，请先安装并加入PATH')
+    video_mode, _, audio_mode = profile.partition('-')
+    args = [FFMPEG, '-hide_banner', '-loglevel', 'error', '-i', path,
+            '-map', '0:v:0?', '-map', '0:a:0?', '-sn', '-dn']
+    if video_mode == 'copy':
+        args += ['-c:v', 'copy']
+    else:
+        args += ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-pix_fmt', 'yuv420p']
+    if audio_mode == 'copy':
+        args += ['-c:a', 'copy']
+    else:
+        args += ['-c:a', 'aac', '-b:a', '160k', '-ac', '2']
+    return args + ['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov+default_base_moof']
+
+
+def open_remux(path, profile):
+    """启动 ffmpeg 把文件转封装为分片MP4，从标准输出边转边读
+
+    管道写满时 ffmpeg 会阻塞，读取速度自然决定转封装速度。
+    """
+    return subprocess.Popen(_remux_args(path, profile) + ['pipe:1'], stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+
+
+def remux_file(src, dst, profile):
+    """把文件转封装为分片MP4文件 dst（与 open_remux 的输出相同）"""
+    run(_remux_args(src, profile) + ['-y', dst], timeout=6 * 3600)
+
+
+def open_pcm(path, sample_rate, stderr=subprocess.DEVNULL):
+    """启动 ffmpeg 把第一条音频轨道解码为单声道 16 位 PCM（s16le），从标准输出边解码边读
+
+    stderr 为接收错误输出的文件（默认丢弃）。不要传管道：读完标准输出之前没人读它，
+    错误信息写满管道后 ffmpeg 会阻塞。
+    """
+    if FFMPEG is None:
+        raise FFmpegError('未找到 ffmpeg/ffprobe，请先安装并加入PATH')
+    return subprocess.Popen([FFMPEG, '-hide_banner', '-loglevel', 'error', '-i', path,
+                             '-map', '0:a:0', '-vn', '-sn', '-dn', '-ac', '1',
+                             '-ar', str(sample_rate), '-f', 's16le', 'pipe:1'],
+                            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=stderr)
+
+
+def probe_media(path):
+    """时长（秒）和视频高度（纯音频为None）"""
+    out = run([FFPROBE, '-v', 'error', '-show_entries',
+               'format=duration:stream=codec_type,height', '-of', 'json', path], timeout=60)
+    try:
+        info = json.loads(out.decode('utf-8', 'replace'))
+        duration = float(info.get('format', {}).get('duration', 0))
+    except ValueError:
+        raise FFmpegError('无法解析 ffprobe 输出')
+    height = next((s.get('height') for s in info.get('streams', [])
+                   if s.get('codec_type') == 'video' and s.get('height')), None)
+    return duration, height
+
+
+def probe_info(path):
+    """时长、第一条视频/音频轨道的编码和视频分辨率（封面图片不算视频轨道）"""
+    out = run([FFPROBE, '-v', 'error', '-show_entries',
+               'format=duration:stream=codec_type,codec_name,width,height'
+               ':stream_disposition=attached_pic', '-of', 'json', path], timeout=60)
+    try:
+        info = json.loads(out.decode('utf-8', 'replace'))
+        duration = float(info.get('format', {}).get('duration') or 0) or None
+    except ValueError:
+        raise FFmpegError('无法解析 ffprobe 输出')
+    streams = info.get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video'
+                  and not s.get('disposition', {}).get('attached_pic')), {})
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), {})
+    return {'duration': duration, 'vcodec': video.get('codec_name'),
+            'acodec': audio.get('codec_name'), 'width': video.get('width'),
+            'height': video.get('height')}
+
+
+def transcode_video(src, dst, height, video_kbps, audio_kbps):
+    """转码为不高于 height 的 H.264/AAC MP4（限制峰值码率，moov前置）"""
+    run([FFMPEG, '-hide_banner', '-loglevel', 'error', '-y', '-i', src,
+         '-map', '0:v:0?', '-map', '0:a:0?', '-sn', '-dn',
+         '-vf', f"scale=-2:'min(ih,{height})'", '-c:v', 'libx264', '-preset', 'veryfast',
+         '-b:v', f'{video_kbps}k', '-maxrate', f'{video_kbps}k', '-bufsize', f'{video_kbps * 2}k',
+         '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-b:a', f'{audio_kbps}k', '-ac', '2',
+         '-movflags', '+faststart', dst], timeout=6 * 3600)
+
+
+def transcode_audio(src, dst, audio_kbps):
+    """转码为 Opus（WebM容器）"""
+    run([FFMPEG, '-hide_banner', '-loglevel', 'error', '-y', '-i', src,
+         '-map', '0:a:0', '-vn', '-sn', '-dn', '-c:a', 'libopus', '-b:a', f'{audio_kbps}k',
+         '-f', 'webm', dst], timeout=3600)
+
+
+class PriorityPool:
+    """固定数量的工作线程，按优先级执行任务（数值小的先执行）
+
+    每个任务通常运行一个ffmpeg进程，线程数就是同时运行的ffmpeg进程上限。
+    同一个key排队中只保留一个任务；再次提交更高的优先级时提前执行。
+    """
+
+    class _Job:
+        __slots__ = ('priority', 'seq', 'fn', 'future', 'started')
+
+    def __init__(self, workers, name='worker'):
+        self._heap = []
+        self._jobs = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f'{name}-{i}', daemon=True).start()
+
+    def submit(self, key, priority, fn):
+        """提交任务，返回 Future；同一key已在排队或执行时返回原来的 Future"""
+        with self._cond:
+            job = self._jobs.get(key)
+            if job is not None:
+                if not job.started and priority < job.priority:
+                    job.priority, job.seq = priority, next(self._seq)
+                    heapq.heappush(self._heap, (job.priority, job.seq, key))
+                return job.future
+            job = self._Job()
+            job.priority, job.seq, job.fn = priority, next(self._seq), fn
+            job.future, job.started = Future(), False
+            self._jobs[key] = job
+            heapq.heappush(self._heap, (priority, job.seq, key))
+            self._cond.notify()
+            return job.future
+
+    def pending(self):
+        """排队中和执行中的任务数"""
+        with self._cond:
+            running = sum(1 for job in self._jobs.values() if job.started)
+            return len(self._jobs) - running, running
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while True:
+                    while not self._heap:
+                        self._cond.wait()
+                    _, seq, key = heapq.heappop(self._heap)
+                    job = self._jobs.get(key)
+                    # 提高优先级后旧的堆条目作废
+                    if job is not None and job.seq == seq and not job.started:
+                        break
+                job.started = True
+            if not job.future.set_running_or_notify_cancel():
+                result, error = None, None
+            else:
+                try:
+                    result, error = job.fn(), None
+                except Exception as e:
+                    result, error = None, e
+            with self._cond:
+                del self._jobs[key]
+            if job.future.running():
+                if error is None:
+                    job.future.set_result(result)
+                else:
+                    job.future.set_exception(error)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+全能播放器 - 目录监视
+InotifyWatcher: 通过 ctypes 调用 Linux 的 inotify 监视媒体库目录，
+有变化时只把变化的目录交给回调重新扫描；其它系统上不可用，由调用者退回定期轮询
+"""
+
+import os
+import sys
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+import time
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# 文件写完、移入移出、新建删除都会让所在目录重新扫描
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class WatchError(Exception):
+    """inotify 不可用（非Linux、watch数量超过上限等）"""
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        raise WatchError('当前系统不支持 inotify')
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    except (OSError, AttributeError):
+        raise WatchError('当前系统不支持 inotify')
+    return libc
+
+
+class InotifyWatcher:
+    """监视一组目录，变化的目录攒 debounce 秒后一起交给 on_change(目录集合, 是否溢出)
+
+    - 目录用调用者给的 key 标识（媒体库中为 (根目录, 相对路径)）
+    - interesting(文件名) 过滤不相关的文件（子目录的变化总是相关）
+    - 内核事件队列溢出时无法知道哪些目录变了，overflow 为 True，调用者应全部扫描
+    - 新出现或消失的目录由调用者扫描后通过 sync() 增删 watch
+    """
+
+    def __init__(self, on_change, interesting=None, debounce=0.5):
+        self._libc = _load_libc()
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise WatchError(os.strerror(ctypes.get_errno()))
+        self.on_change = on_change
+        self.interesting = interesting
+        self.debounce = debounce
+        self._lock = threading.Lock()
+        self._by_wd = {}
+        self._by_key = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._by_key)
+
+    def sync(self, directories):
+        """按 {key: 绝对路径} 增删 watch"""
+        with self._lock:
+            for key in [key for key in self._by_key if key not in directories]:
+                wd = self._by_key.pop(key)
+                self._by_wd.pop(wd, None)
+                self._libc.inotify_rm_watch(self._fd, wd)
+            for key, path in directories.items():
+                if key in self._by_key:
+                    continue
+                wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+                if wd < 0:
+                    err = ctypes.get_errno()
+                    if err == errno.ENOSPC:
+                        raise WatchError('watch 数量达到上限（可调大 fs.inotify.max_user_watches）')
+                    # 目录已被删除或没有权限，下次扫描会处理
+                    continue
+                self._by_wd[wd] = key
+                self._by_key[key] = wd
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='media-watcher', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self._fd)
+
+    def _loop(self):
+        dirty = set()
+        overflow = False
+        deadline = None
+        while not self._stop.is_set():
+            timeout = max(deadline - time.monotonic(), 0) if dirty or overflow else 1.0
+            readable, _, _ = select.select([self._fd], [], [], timeout)
+            if readable:
+                try:
+                    data = os.read(self._fd, 64 * 1024)
+                except BlockingIOError:
+                    data = b''
+                changed, lost = self._parse(data)
+                if (changed or lost) and not (dirty or overflow):
+                    deadline = time.monotonic() + self.debounce
+                dirty |= changed
+                overflow = overflow or lost
+            if (dirty or overflow) and time.monotonic() >= deadline:
+                batch, was_overflow = dirty, overflow
+                dirty, overflow = set(), False
+                try:
+                    self.on_change(batch, was_overflow)
+                except Exception as e:
+                    print(f"⚠️  处理目录变化失败: {e}")
+
+    def _parse(self, data):
+        """解析事件，返回 (变化的目录key集合, 是否溢出)"""
+        changed = set()
+        overflow = False
+        offset = 0
+        with self._lock:
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length]
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                if mask & IN_IGNORED:
+                    # 目录被删除后内核自动移除watch
+                    key = self._by_wd.pop(wd, None)
+                    if key is not None:
+                        self._by_key.pop(key, None)
+                    continue
+                key = self._by_wd.get(wd)
+                if key is None:
+                    continue
+                name = os.fsdecode(name.rstrip(b'\0'))
+                if name.startswith('.'):
+                    continue
+                if mask & IN_ISDIR or self.interesting is None or self.interesting(name):
+                    changed.add(key)
+        return changed, overflow
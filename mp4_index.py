@@ -0,0 +1,758 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+全能播放器 - MP4/MOV 索引
+纯Python解析 moov/stbl 的采样表（stts、stss、stsz、stsc、stco/co64），
+用数组保存，二分查找回答"时间t对应的字节位置和最近的关键帧"；
+moov 在文件末尾时可以生成虚拟faststart布局；
+分片MP4（moof+mdat）可以列出每个片段的时间和字节范围，供 MSE 按片段追加；
+解析结果按 (路径, 大小, 修改时间) 缓存
+"""
+
+import os
+import sys
+import bisect
+import struct
+import threading
+from array import array
+from collections import OrderedDict, namedtuple
+
+
+MP4_EXTENSIONS = {'.mp4', '.m4v', '.mov', '.m4a'}
+
+# 缓存的解析结果个数
+INDEX_CACHE_SIZE = 32
+
+# moov 超过这个大小视为文件损坏
+MAX_MOOV_SIZE = 256 * 1024 * 1024
+
+# 文件中的一个box：类型、起始偏移、头长度、总长度
+Box = namedtuple('Box', ['type', 'start', 'header_size', 'size'])
+
+# 查找结果：请求的时间、对应采样的字节偏移、之前最近关键帧的时间和字节偏移
+SeekPoint = namedtuple('SeekPoint', ['time', 'offset', 'keyframe_time', 'keyframe_offset'])
+
+# 分片MP4中的一段（一个或几个相邻的 moof+mdat）：开始、结束时间（秒）和字节范围
+Fragment = namedtuple('Fragment', ['start', 'end', 'offset', 'size'])
+
+
+class MP4Error(Exception):
+    """不是有效的MP4/MOV文件"""
+
+
+def _be_array(typecode, data):
+    """大端字节 -> array"""
+    values = array(typecode)
+    values.frombytes(bytes(data))
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+
+def iter_boxes(data, start=0, end=None):
+    """遍历内存中一段数据里的box"""
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, pos)
+        header_size = 8
+        if size == 1:
+            if pos + 16 > end:
+                raise MP4Error('box 头不完整')
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - pos
+        if size < header_size or pos + size > end:
+            raise MP4Error(f'box {box_type!r} 大小无效')
+        yield Box(box_type, pos, header_size, size)
+        pos += size
+
+
+def read_top_level_boxes(f, file_size):
+    """读取文件顶层box（只读每个box的头）"""
+    boxes = []
+    pos = 0
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        header = f.read(16)
+        size, box_type = struct.unpack_from('>I4s', header)
+        header_size = 8
+        if size == 1:
+            if len(header) < 16:
+                raise MP4Error('box 头不完整')
+            size = struct.unpack_from('>Q', header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = file_size - pos
+        if size < header_size:
+            raise MP4Error(f'box {box_type!r} 大小无效')
+        boxes.append(Box(box_type, pos, header_size, min(size, file_size - pos)))
+        pos += size
+    return boxes
+
+
+def find_box(data, path, start=0, end=None):
+    """按路径（如 [b'mdia', b'minf']）查找第一个子box"""
+    box = None
+    for box_type in path:
+        for child in iter_boxes(data, start, end):
+            if child.type == box_type:
+                box = child
+                break
+        else:
+            return None
+        start, end = box.start + box.header_size, box.start + box.size
+    return box
+
+
+def _payload(data, box):
+    return box.start + box.header_size, box.start + box.size
+
+
+def _descriptor(data, pos):
+    """MPEG-4 描述符（esds 中）：返回 (标签, 内容起点, 内容终点)"""
+    tag = data[pos]
+    length = 0
+    pos += 1
+    for _ in range(4):
+        byte = data[pos]
+        pos += 1
+        length = (length << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            break
+    return tag, pos, pos + length
+
+
+def _aac_codec(data, esds):
+    """esds -> mp4a.40.<AOT>（AAC），其它音频为 mp4a.<objectTypeIndication>"""
+    pos, end = _payload(data, esds)
+    tag, pos, end = _descriptor(data, pos + 4)
+    if tag != 0x03:
+        raise MP4Error('esds 中没有 ES_Descriptor')
+    flags = data[pos + 2]
+    pos += 3
+    if flags & 0x80:
+        pos += 2
+    if flags & 0x40:
+        pos += 1 + data[pos]
+    if flags & 0x20:
+        pos += 2
+    tag, pos, end = _descriptor(data, pos)
+    if tag != 0x04:
+        raise MP4Error('esds 中没有 DecoderConfigDescriptor')
+    object_type = data[pos]
+    if object_type != 0x40:
+        return f'mp4a.{object_type:02x}'
+    aot = 2
+    if pos + 13 < end:
+        tag, info, _ = _descriptor(data, pos + 13)
+        if tag == 0x05:
+            aot = data[info] >> 3
+            if aot == 31:
+                aot = 32 + (((data[info] & 0x07) << 3) | (data[info + 1] >> 5))
+    return f'mp4a.40.{aot}'
+
+
+def _codec_string(data, stsd):
+    """采样描述 -> MSE/isTypeSupported 使用的编码字符串（RFC 6381），不认识的编码返回None"""
+    if stsd is None:
+        return None
+    pos, end = _payload(data, stsd)
+    if struct.unpack_from('>I', data, pos + 4)[0] == 0:
+        return None
+    entry = next(iter_boxes(data, pos + 8, end), None)
+    if entry is None:
+        return None
+    fourcc = entry.type.decode('latin-1')
+    entry_start, entry_end = _payload(data, entry)
+    if fourcc in ('mp4a', 'Opus', 'fLaC', '.mp3', 'ac-3', 'ec-3'):
+        # AudioSampleEntry 固定部分28字节（QuickTime 第1、2版更长）
+        version = struct.unpack_from('>H', data, entry_start + 8)[0]
+        children = entry_start + {1: 44, 2: 64}.get(version, 28)
+    else:
+        # VisualSampleEntry 固定部分78字节
+        children = entry_start + 78
+    boxes = {box.type: box for box in iter_boxes(data, children, entry_end)}
+
+    if fourcc in ('avc1', 'avc3') and b'avcC' in boxes:
+        p = boxes[b'avcC'].start + boxes[b'avcC'].header_size
+        return f'{fourcc}.{data[p + 1]:02x}{data[p + 2]:02x}{data[p + 3]:02x}'
+    if fourcc in ('hvc1', 'hev1') and b'hvcC' in boxes:
+        p = boxes[b'hvcC'].start + boxes[b'hvcC'].header_size
+        space, tier, profile = data[p + 1] >> 6, (data[p + 1] >> 5) & 1, data[p + 1] & 0x1F
+        # 兼容标志按位反序
+        compat = int(f'{struct.unpack_from(">I", data, p + 2)[0]:032b}'[::-1], 2)
+        constraints = bytes(data[p + 6:p + 12]).rstrip(b'\0')
+        return (f"{fourcc}.{['', 'A', 'B', 'C'][space]}{profile}.{compat:X}."
+                f"{'H' if tier else 'L'}{data[p + 12]}" + ''.join(f'.{b:02X}' for b in constraints))
+    if fourcc == 'vp09' and b'vpcC' in boxes:
+        p = boxes[b'vpcC'].start + boxes[b'vpcC'].header_size
+        return f'vp09.{data[p + 4]:02d}.{data[p + 5]:02d}.{data[p + 6] >> 4:02d}'
+    if fourcc == 'av01' and b'av1C' in boxes:
+        p = boxes[b'av1C'].start + boxes[b'av1C'].header_size
+        profile, level = data[p + 1] >> 5, data[p + 1] & 0x1F
+        tier, high, twelve = data[p + 2] >> 7, (data[p + 2] >> 6) & 1, (data[p + 2] >> 5) & 1
+        depth = 12 if twelve else 10 if high else 8
+        return f"av01.{profile}.{level:02d}{'H' if tier else 'M'}.{depth:02d}"
+    if fourcc == 'mp4a' and b'esds' in boxes:
+        return _aac_codec(data, boxes[b'esds'])
+    return {'Opus': 'opus', 'fLaC': 'flac', '.mp3': 'mp3', 'ac-3': 'ac-3', 'ec-3': 'ec-3'}.get(fourcc)
+
+
+class Track:
+    """一条轨道的采样表
+
+    stts 按"游程"保存（每段的首个采样序号、起始时间、帧间隔），
+    时间 -> 采样 先二分找到游程再算出序号；
+    关键帧（stss）为有序数组，二分查找 <= 某采样的最近关键帧；
+    每个采样的字节偏移在第一次需要时由 stsc/stco/stsz 一次算出。
+    """
+
+    def __init__(self, data, trak):
+        trak_start, trak_end = _payload(data, trak)
+        self.track_id = 0
+        self.width = self.height = 0
+        tkhd = find_box(data, [b'tkhd'], trak_start, trak_end)
+        if tkhd is not None:
+            pos, end = _payload(data, tkhd)
+            version = data[pos]
+            self.track_id = struct.unpack_from('>I', data, pos + (20 if version == 1 else 12))[0]
+            self.width, self.height = (v >> 16 for v in struct.unpack_from('>II', data, end - 8))
+
+        mdhd = find_box(data, [b'mdia', b'mdhd'], trak_start, trak_end)
+        hdlr = find_box(data, [b'mdia', b'hdlr'], trak_start, trak_end)
+        stbl = find_box(data, [b'mdia', b'minf', b'stbl'], trak_start, trak_end)
+        if mdhd is None or stbl is None:
+            raise MP4Error('轨道缺少 mdhd/stbl')
+
+        pos = mdhd.start + mdhd.header_size
+        if data[pos] == 1:
+            self.timescale, duration = struct.unpack_from('>IQ', data, pos + 20)
+        else:
+            self.timescale, duration = struct.unpack_from('>II', data, pos + 12)
+        if not self.timescale:
+            raise MP4Error('timescale 为0')
+        self.duration = duration / self.timescale
+        self.kind = bytes(data[hdlr.start + hdlr.header_size + 8:
+                               hdlr.start + hdlr.header_size + 12]).decode('latin-1') if hdlr else ''
+
+        stbl_start, stbl_end = _payload(data, stbl)
+        tables = {box.type: box for box in iter_boxes(data, stbl_start, stbl_end)}
+
+        self.codec = ''
+        if b'stsd' in tables:
+            pos = tables[b'stsd'].start + tables[b'stsd'].header_size
+            if struct.unpack_from('>I', data, pos + 4)[0] > 0:
+                self.codec = bytes(data[pos + 12:pos + 16]).decode('latin-1')
+        try:
+            self.codec_string = _codec_string(data, tables.get(b'stsd'))
+        except (MP4Error, struct.error, IndexError):
+            self.codec_string = None
+
+        # stts: (采样数, 间隔) 游程
+        stts = tables.get(b'stts')
+        if stts is None:
+            raise MP4Error('缺少 stts')
+        pos = stts.start + stts.header_size
+        count = struct.unpack_from('>I', data, pos + 4)[0]
+        runs = _be_array('I', data[pos + 8:pos + 8 + count * 8])
+        self._run_first_sample = array('Q')
+        self._run_start_time = array('Q')
+        self._run_delta = runs[1::2]
+        sample, ticks = 0, 0
+        for run_count, delta in zip(runs[0::2], runs[1::2]):
+            self._run_first_sample.append(sample)
+            self._run_start_time.append(ticks)
+            sample += run_count
+            ticks += run_count * delta
+
+        # stsz: 采样大小
+        stsz = tables.get(b'stsz')
+        if stsz is None:
+            raise MP4Error('缺少 stsz')
+        pos = stsz.start + stsz.header_size
+        self._constant_size, self.sample_count = struct.unpack_from('>II', data, pos + 4)
+        self._sizes = (None if self._constant_size else
+                       _be_array('I', data[pos + 12:pos + 12 + self.sample_count * 4]))
+        self.sample_count = min(self.sample_count, sample)
+
+        # stss: 关键帧采样号（从1开始）；没有 stss 表示所有采样都是关键帧
+        stss = tables.get(b'stss')
+        self.keyframes = None
+        if stss is not None:
+            pos = stss.start + stss.header_size
+            count = struct.unpack_from('>I', data, pos + 4)[0]
+            self.keyframes = _be_array('I', data[pos + 8:pos + 8 + count * 4])
+
+        # stsc: (首个chunk号, 每chunk采样数) 游程
+        stsc = tables.get(b'stsc')
+        if stsc is None:
+            raise MP4Error('缺少 stsc')
+        pos = stsc.start + stsc.header_size
+        count = struct.unpack_from('>I', data, pos + 4)[0]
+        entries = _be_array('I', data[pos + 8:pos + 8 + count * 12])
+        self._stsc_first_chunk = entries[0::3]
+        self._stsc_samples_per_chunk = entries[1::3]
+
+        # stco/co64: chunk 在文件中的偏移
+        chunk_box = tables.get(b'stco') or tables.get(b'co64')
+        if chunk_box is None:
+            raise MP4Error('缺少 stco/co64')
+        pos = chunk_box.start + chunk_box.header_size
+        count = struct.unpack_from('>I', data, pos + 4)[0]
+        if chunk_box.type == b'stco':
+            self.chunk_offsets = array('Q', _be_array('I', data[pos + 8:pos + 8 + count * 4]))
+        else:
+            self.chunk_offsets = _be_array('Q', data[pos + 8:pos + 8 + count * 8])
+        # chunk偏移表在moov中的位置，虚拟faststart改写偏移时使用
+        self.chunk_table = (chunk_box.type, pos + 8)
+
+        self._sample_offsets = None
+        self._offsets_lock = threading.Lock()
+
+    @property
+    def is_video(self):
+        return self.kind == 'vide'
+
+    def sample_size(self, index):
+        return self._constant_size or self._sizes[index]
+
+    def sample_offsets(self):
+        """每个采样的字节偏移（第一次调用时计算）"""
+        with self._offsets_lock:
+            if self._sample_offsets is None:
+                offsets = array('Q')
+                sizes = self._sizes
+                constant = self._constant_size
+                sample = 0
+                chunks = len(self.chunk_offsets)
+                for j, first_chunk in enumerate(self._stsc_first_chunk):
+                    per_chunk = self._stsc_samples_per_chunk[j]
+                    next_first = (self._stsc_first_chunk[j + 1]
+                                  if j + 1 < len(self._stsc_first_chunk) else chunks + 1)
+                    for chunk in range(first_chunk, min(next_first, chunks + 1)):
+                        offset = self.chunk_offsets[chunk - 1]
+                        for _ in range(per_chunk):
+                            if sample >= self.sample_count:
+                                break
+                            offsets.append(offset)
+                            offset += constant or sizes[sample]
+                            sample += 1
+                self._sample_offsets = offsets
+            return self._sample_offsets
+
+    def sample_at(self, t):
+        """时间t（秒）所在的采样序号（从0开始）"""
+        if self.sample_count == 0:
+            raise MP4Error('轨道没有采样')
+        ticks = max(0, int(t * self.timescale))
+        run = max(bisect.bisect_right(self._run_start_time, ticks) - 1, 0)
+        delta = self._run_delta[run]
+        index = self._run_first_sample[run]
+        if delta:
+            index += (ticks - self._run_start_time[run]) // delta
+        return min(index, self.sample_count - 1)
+
+    def sample_time(self, index):
+        """采样的解码时间（秒）"""
+        run = max(bisect.bisect_right(self._run_first_sample, index) - 1, 0)
+        ticks = (self._run_start_time[run]
+                 + (index - self._run_first_sample[run]) * self._run_delta[run])
+        return ticks / self.timescale
+
+    def keyframe_at_or_before(self, index):
+        """<= index 的最近关键帧序号"""
+        if self.keyframes is None or not len(self.keyframes):
+            return index
+        k = bisect.bisect_right(self.keyframes, index + 1) - 1
+        return self.keyframes[max(k, 0)] - 1
+
+    def keyframe_times(self):
+        if self.keyframes is None:
+            return [self.sample_time(i) for i in range(self.sample_count)]
+        return [self.sample_time(k - 1) for k in self.keyframes]
+
+
+class MP4Index:
+    """一个MP4/MOV文件的结构和采样表"""
+
+    def __init__(self, path):
+        self.path = path
+        st = os.stat(path)
+        self.size = st.st_size
+        with open(path, 'rb') as f:
+            self.boxes = read_top_level_boxes(f, self.size)
+            moov = next((box for box in self.boxes if box.type == b'moov'), None)
+            if moov is None:
+                raise MP4Error('没有 moov')
+            if moov.size > MAX_MOOV_SIZE:
+                raise MP4Error('moov 过大')
+            f.seek(moov.start)
+            self.moov_data = f.read(moov.size)
+        self.moov = moov
+        self._faststart = False
+        data = memoryview(self.moov_data)
+        self.tracks = [Track(data, box) for box in iter_boxes(data, moov.header_size, moov.size)
+                       if box.type == b'trak']
+        if not self.tracks:
+            raise MP4Error('没有轨道')
+
+    @property
+    def main_track(self):
+        """查找时使用的轨道：优先视频轨道"""
+        return next((t for t in self.tracks if t.is_video and t.sample_count), self.tracks[0])
+
+    @property
+    def duration(self):
+        return max(track.duration for track in self.tracks)
+
+    def lookup(self, t):
+        """时间t对应的字节位置，以及之前最近的关键帧"""
+        track = self.main_track
+        offsets = track.sample_offsets()
+        if not offsets:
+            raise MP4Error('采样表为空')
+        index = min(track.sample_at(t), len(offsets) - 1)
+        key = min(track.keyframe_at_or_before(index), index)
+        return SeekPoint(t, offsets[index], track.sample_time(key), offsets[key])
+
+    def keyframe_times(self):
+        return self.main_track.keyframe_times()
+
+    @property
+    def moov_at_end(self):
+        """moov 位于 mdat 之后（播放前需要先读到文件末尾）"""
+        mdat = next((box for box in self.boxes if box.type == b'mdat'), None)
+        return mdat is not None and self.moov.start > mdat.start
+
+    def faststart_layout(self):
+        """moov 在末尾时返回虚拟faststart布局（结果缓存），否则返回None
+
+        无法生成（例如改写后的偏移超出 stco 范围）时也缓存为None，之后按原文件发送。
+        """
+        if self._faststart is False:
+            layout = None
+            if self.moov_at_end:
+                try:
+                    layout = FaststartLayout(self)
+                except MP4Error as e:
+                    print(f"⚠️  无法生成虚拟faststart布局 {self.path}: {e}")
+            self._faststart = layout
+        return self._faststart
+
+
+class FaststartLayout:
+    """不改写文件的虚拟faststart布局
+
+    按 [mdat之前的box（ftyp等）][改写了chunk偏移的moov][其余box] 的顺序
+    把文件重新拼接成一个虚拟字节流，总大小与原文件相同；
+    moov 在内存中，其余部分直接从原文件读取。
+    """
+
+    def __init__(self, index):
+        mdat_start = next(box.start for box in index.boxes if box.type == b'mdat')
+        head = [box for box in index.boxes if box.start < mdat_start and box.type != b'moov']
+        tail = [box for box in index.boxes if box.start >= mdat_start and box.type != b'moov']
+        moov = index.moov
+
+        # (虚拟起点, 长度, 文件偏移或None, 内存数据)
+        self.segments = []
+        self._shifts = []
+        pos = 0
+        for box in head:
+            self.segments.append((pos, box.size, box.start, None))
+            pos += box.size
+        moov_pos = pos
+        pos += moov.size
+        for box in tail:
+            self.segments.append((pos, box.size, box.start, None))
+            self._shifts.append((box.start, box.start + box.size, pos - box.start))
+            pos += box.size
+        self.size = pos
+
+        patched = bytearray(index.moov_data)
+        for track in index.tracks:
+            box_type, table_pos = track.chunk_table
+            new_offsets = array('Q', (self.map_offset(offset) for offset in track.chunk_offsets))
+            if box_type == b'stco':
+                if new_offsets and max(new_offsets) > 0xFFFFFFFF:
+                    raise MP4Error('chunk偏移超出stco范围')
+                table = array('I', new_offsets)
+            else:
+                table = new_offsets
+            if sys.byteorder == 'little':
+                table.byteswap()
+            raw = table.tobytes()
+            patched[table_pos:table_pos + len(raw)] = raw
+        self.moov_data = bytes(patched)
+        self.segments.insert(len(head), (moov_pos, moov.size, None, self.moov_data))
+
+    def map_offset(self, offset):
+        """原文件中的偏移 -> 虚拟布局中的偏移（只对moov之外的数据有效）"""
+        for start, end, shift in self._shifts:
+            if start <= offset < end:
+                return offset + shift
+        return offset
+
+    def open(self, path, opener=None):
+        """以只读文件对象打开虚拟布局（opener 用于替换默认的 open(path, 'rb')）"""
+        return LayoutFile(self, opener(path) if opener else open(path, 'rb'))
+
+    def iter_range(self, path, start, length, chunk_size=256 * 1024, opener=None):
+        """按块读取虚拟布局中的一段"""
+        with self.open(path, opener) as f:
+            f.seek(start)
+            remaining = length
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+
+class LayoutFile:
+    """按虚拟布局读取的文件对象，支持 read/seek/tell
+
+    可以交给 wsgi.file_wrapper：waitress 由异步I/O线程读取发送，不占用处理请求的线程。
+    没有 fileno()，服务器不会用 sendfile 直接发送原文件的字节。
+    """
+
+    def __init__(self, layout, f):
+        self._layout = layout
+        self._file = f
+        self._pos = 0
+
+    def read(self, size=-1):
+        end = self._layout.size
+        if size is not None and size >= 0:
+            end = min(end, self._pos + size)
+        parts = []
+        for seg_start, seg_len, file_offset, data in self._layout.segments:
+            seg_end = seg_start + seg_len
+            if seg_end <= self._pos or seg_start >= end:
+                continue
+            lo = max(self._pos, seg_start) - seg_start
+            hi = min(end, seg_end) - seg_start
+            if data is not None:
+                chunk = data[lo:hi]
+            else:
+                self._file.seek(file_offset + lo)
+                chunk = self._file.read(hi - lo)
+            parts.append(chunk)
+            self._pos = seg_start + lo + len(chunk)
+            if len(chunk) < hi - lo:
+                # 原文件被截断
+                break
+        return b''.join(parts)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._layout.size
+        if offset < 0:
+            raise ValueError('负的文件位置')
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FragmentMap:
+    """分片MP4（moof+mdat）的片段表
+
+    初始化段为第一个 moof 之前的全部内容（ftyp+moov）；每个片段从 moof 开始到下一个 moof 之前，
+    时间取自主轨道（优先视频）的 tfdt 和 trun 中各采样的时长。MSE 追加初始化段后，
+    任意片段（或几个相邻片段的连续字节）都可以单独追加。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            boxes = read_top_level_boxes(f, size)
+            moov = next((box for box in boxes if box.type == b'moov'), None)
+            moofs = [box for box in boxes if box.type == b'moof']
+            if moov is None or not moofs:
+                raise MP4Error('不是分片MP4')
+            if moov.start > moofs[0].start or moov.size > MAX_MOOV_SIZE:
+                raise MP4Error('moov 不在片段之前')
+            f.seek(moov.start)
+            moov_data = f.read(moov.size)
+            data = memoryview(moov_data)
+            tracks = [Track(data, box) for box in iter_boxes(data, moov.header_size, moov.size)
+                      if box.type == b'trak']
+            if not tracks:
+                raise MP4Error('没有轨道')
+            video = next((t for t in tracks if t.is_video), None)
+            audio = next((t for t in tracks if t.kind == 'soun'), None)
+            main = video or tracks[0]
+
+            codecs = [t.codec_string for t in (video, audio) if t is not None]
+            if not codecs or None in codecs:
+                raise MP4Error(f'无法确定编码参数: {", ".join(t.codec for t in tracks)}')
+            self.mime = f'{"video" if video else "audio"}/mp4; codecs="{",".join(codecs)}"'
+            self.init_size = moofs[0].start
+
+            default_duration = 0
+            for trex in self._boxes(data, moov.header_size, moov.size, b'mvex', b'trex'):
+                track_id, _, duration = struct.unpack_from('>III', data, trex.start + trex.header_size + 4)
+                if track_id == main.track_id:
+                    default_duration = duration
+
+            # 每个片段到下一个 moof 为止；最后一个到 mfra（片段随机访问表）之前
+            ends = [box.start for box in moofs[1:]]
+            tail = [box for box in boxes if box.start > moofs[-1].start and box.type != b'mfra']
+            ends.append(tail[-1].start + tail[-1].size if tail else moofs[-1].start + moofs[-1].size)
+
+            self.fragments = []
+            ticks = 0
+            for moof, end in zip(moofs, ends):
+                f.seek(moof.start)
+                moof_data = f.read(moof.size)
+                start_ticks, duration = self._fragment_time(memoryview(moof_data), main.track_id,
+                                                            default_duration)
+                ticks = ticks if start_ticks is None else start_ticks
+                self.fragments.append(Fragment(ticks / main.timescale,
+                                               (ticks + duration) / main.timescale,
+                                               moof.start, end - moof.start))
+                ticks += duration
+        self.duration = self.fragments[-1].end if self.fragments else 0.0
+
+    @staticmethod
+    def _boxes(data, start, end, parent, child):
+        """parent 下的所有 child box"""
+        for box in iter_boxes(data, start, end):
+            if box.type == parent:
+                for inner in iter_boxes(data, *_payload(data, box)):
+                    if inner.type == child:
+                        yield inner
+
+    @classmethod
+    def _fragment_time(cls, data, track_id, default_duration):
+        """moof 中 track_id 轨道的 (起始时间tick或None, 总时长tick)"""
+        for traf in iter_boxes(data, 8, len(data)):
+            if traf.type != b'traf':
+                continue
+            start, end = _payload(data, traf)
+            children = list(iter_boxes(data, start, end))
+            tfhd = next((box for box in children if box.type == b'tfhd'), None)
+            if tfhd is None:
+                continue
+            pos = tfhd.start + tfhd.header_size
+            flags = struct.unpack_from('>I', data, pos)[0] & 0xFFFFFF
+            if struct.unpack_from('>I', data, pos + 4)[0] != track_id:
+                continue
+            # tfhd 中依次可选：base_data_offset(8)、sample_description_index(4)、default_sample_duration(4)
+            pos += 8 + (8 if flags & 0x01 else 0) + (4 if flags & 0x02 else 0)
+            if flags & 0x08:
+                default_duration = struct.unpack_from('>I', data, pos)[0]
+
+            base_time = None
+            duration = 0
+            for box in children:
+                pos = box.start + box.header_size
+                if box.type == b'tfdt':
+                    base_time = struct.unpack_from('>Q' if data[pos] == 1 else '>I', data, pos + 4)[0]
+                elif box.type == b'trun':
+                    flags = struct.unpack_from('>I', data, pos)[0] & 0xFFFFFF
+                    count = struct.unpack_from('>I', data, pos + 4)[0]
+                    if not flags & 0x100:
+                        duration += count * default_duration
+                        continue
+                    # 每个采样依次可选：时长、大小、标志、合成时间偏移，各4字节
+                    first = pos + 8 + (4 if flags & 0x01 else 0) + (4 if flags & 0x04 else 0)
+                    stride = 4 * bin(flags & 0xF00).count('1')
+                    duration += sum(struct.unpack_from('>I', data, first + i * stride)[0]
+                                    for i in range(count))
+            return base_time, duration
+        return None, 0
+
+    def segments(self, min_duration):
+        """把相邻的片段合并为不短于 min_duration 秒的段（音频等每帧一个片段的文件不会有大量小段）"""
+        merged = []
+        for fragment in self.fragments:
+            if merged and merged[-1].end - merged[-1].start < min_duration:
+                last = merged[-1]
+                merged[-1] = Fragment(last.start, fragment.end, last.offset,
+                                      fragment.offset + fragment.size - last.offset)
+            else:
+                merged.append(fragment)
+        return merged
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _open_cached(cls, path):
+    """解析（或取缓存的）结果，按 (类型, 路径, 大小, 修改时间) 缓存
+
+    解析失败（MP4Error）也缓存，损坏的文件或扩展名是 .mp4 的其它文件不会每次请求都重新解析。
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    key = (cls.__name__, path, st.st_size, st.st_mtime_ns)
+    with _cache_lock:
+        result = _cache.get(key)
+        if result is not None:
+            _cache.move_to_end(key)
+    if isinstance(result, MP4Error):
+        # 每次抛出新的异常，缓存的异常不会累积 traceback
+        raise MP4Error(*result.args)
+    if result is not None:
+        return result
+    error = None
+    try:
+        result = cls(path)
+    except (struct.error, IndexError):
+        error = MP4Error('文件结构不完整')
+    except MP4Error as e:
+        error = e
+    with _cache_lock:
+        # 缓存不带 traceback 的副本，不会留住解析时的帧和数据
+        _cache[key] = result if error is None else MP4Error(*error.args)
+        while len(_cache) > INDEX_CACHE_SIZE:
+            _cache.popitem(last=False)
+    if error is not None:
+        raise error
+    return result
+
+
+def open_index(path):
+    """解析（或取缓存的）索引"""
+    return _open_cached(MP4Index, path)
+
+
+def open_fragment_map(path):
+    """解析（或取缓存的）分片MP4片段表；不是分片MP4时抛出 MP4Error"""
+    return _open_cached(FragmentMap, path)
+
+
+def is_mp4(path):
+    return os.path.splitext(path)[1].lower() in MP4_EXTENSIONS
+
+
+def keyframe_times(path):
+    """关键帧时间列表；不是MP4或解析失败时返回空列表"""
+    if not is_mp4(path):
+        return []
+    try:
+        return open_index(path).keyframe_times()
+    except (OSError, MP4Error):
+        return []
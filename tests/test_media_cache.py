@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+
+import pytest
+
+from media_cache import BlockCache
+
+BLOCK = 16
+
+
+@pytest.fixture
+def media_file(tmp_path):
+    path = tmp_path / 'clip.bin'
+    path.write_bytes(os.urandom(BLOCK * 20 + 5))
+    return str(path)
+
+
+def read_all(cache, path, admit=False):
+    with cache.open(path, admit) as f:
+        return f.read()
+
+
+def test_reads_match_file(media_file):
+    cache = BlockCache(BLOCK * 8, BLOCK, read_ahead=3)
+    data = open(media_file, 'rb').read()
+    assert read_all(cache, media_file) == data
+    with cache.open(media_file) as f:
+        f.seek(BLOCK * 3 + 7)
+        assert f.read(BLOCK * 2) == data[BLOCK * 3 + 7:BLOCK * 5 + 7]
+        f.seek(-3, os.SEEK_END)
+        assert f.read() == data[-3:]
+
+
+def test_first_read_is_not_cached(media_file):
+    cache = BlockCache(BLOCK * 64, BLOCK, read_ahead=3)
+    read_all(cache, media_file)
+    stats = cache.stats()
+    assert stats['blocks'] == 0
+    # 预读的后续块由文件对象自己使用，不会再去读磁盘
+    assert stats['misses'] == 6
+    assert stats['bypassed'] == 21
+
+
+def test_second_read_is_cached(media_file):
+    cache = BlockCache(BLOCK * 64, BLOCK, read_ahead=3)
+    read_all(cache, media_file)
+    read_all(cache, media_file)
+    assert cache.stats()['blocks'] == 21
+    misses = cache.stats()['misses']
+    read_all(cache, media_file)
+    assert cache.stats()['misses'] == misses
+
+
+def test_sequential_read_does_not_evict_hot_blocks(media_file, tmp_path):
+    cache = BlockCache(BLOCK * 4, BLOCK, read_ahead=0)
+    for _ in range(2):
+        with cache.open(media_file) as f:
+            f.read(BLOCK * 2)
+    assert cache.stats()['blocks'] == 2
+
+    other = tmp_path / 'movie.bin'
+    other.write_bytes(os.urandom(BLOCK * 40))
+    read_all(cache, str(other))
+    hits = cache.stats()['hits']
+    with cache.open(media_file) as f:
+        f.read(BLOCK * 2)
+    assert cache.stats()['hits'] == hits + 2
+
+
+def test_admit_caches_on_first_read(media_file):
+    cache = BlockCache(BLOCK * 64, BLOCK, read_ahead=3)
+    read_all(cache, media_file, admit=True)
+    assert cache.stats()['blocks'] == 21
+
+
+class CountingFile:
+    """记录磁盘读取次数的文件，读取较慢，让其它请求在读取期间到达"""
+
+    def __init__(self, path, reads):
+        self._file = open(path, 'rb')
+        self._reads = reads
+
+    def seek(self, offset):
+        self._file.seek(offset)
+
+    def read(self, size):
+        self._reads.append(size)
+        time.sleep(0.2)
+        return self._file.read(size)
+
+
+def test_concurrent_misses_read_disk_once(media_file):
+    cache = BlockCache(BLOCK * 64, BLOCK, read_ahead=3)
+    data = open(media_file, 'rb').read()
+    key = (media_file, len(data), 0)
+    reads = []
+    results = [None] * 8
+    aheads = [{} for _ in results]
+    barrier = threading.Barrier(len(results))
+
+    def worker(n):
+        barrier.wait()
+        results[n] = cache.get_block(key, CountingFile(media_file, reads), 0, aheads[n])
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(len(results))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # 第一次读取不放入缓存，等待的请求也直接使用读出的数据，不再各自读盘
+    assert reads == [BLOCK * 4]
+    assert results == [data[:BLOCK]] * len(results)
+    assert cache.stats()['shared'] == len(results) - 1
+    assert all(ahead[3] == data[BLOCK * 3:BLOCK * 4] for ahead in aheads)
@@ -0,0 +1,81 @@
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import media_probe
+from media_probe import MetadataProber
+
+Entry = namedtuple('Entry', ['key'])
+
+POISON = 'poison.mp4'
+
+
+class FakePool:
+    """在本进程中执行的进程池：探测 POISON 时像子进程崩溃一样损坏"""
+
+    def __init__(self, max_workers, mp_context):
+        self.broken = False
+
+    def _run(self, path):
+        if self.broken or path == POISON:
+            self.broken = True
+            raise BrokenProcessPool('子进程异常退出')
+        return {'duration': 1.0, 'path': path}
+
+    def map(self, fn, paths):
+        return [self._run(path) for path in paths]
+
+    def submit(self, fn, path):
+        future = Future()
+        try:
+            future.set_result(self._run(path))
+        except BrokenProcessPool as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class FakeLibrary:
+    def __init__(self, keys):
+        self.todo = [Entry(key) for key in keys]
+        self.metadata = {}
+        self.change_listeners = []
+
+    def unprobed(self, can_probe):
+        return [entry for entry in self.todo if entry.key not in self.metadata]
+
+    def resolve(self, key):
+        return key
+
+    def set_metadata(self, results):
+        results = list(results)
+        for entry, info in results:
+            self.metadata[entry.key] = info
+        return results
+
+
+def test_crashing_file_is_recorded_and_rest_continue(monkeypatch):
+    monkeypatch.setattr(media_probe, 'ProcessPoolExecutor', FakePool)
+    monkeypatch.setattr(MetadataProber, 'BATCH', 4)
+    keys = ['a.mp4', POISON, 'b.mp4', 'c.mp4', 'd.mp4', 'e.mp4']
+    library = FakeLibrary(keys)
+    batches = []
+    done = threading.Event()
+
+    def on_probed(probed):
+        batches.append(probed)
+        if len(library.metadata) == len(keys):
+            done.set()
+
+    prober = MetadataProber(library, on_probed=on_probed)
+    prober.start()
+    assert done.wait(5)
+    prober.close()
+
+    assert set(library.metadata) == set(keys)
+    assert 'error' in library.metadata[POISON]
+    assert all('error' not in library.metadata[key] for key in keys if key != POISON)
+    assert len(batches) == 2
@@ -0,0 +1,51 @@
+import sqlite3
+
+import pytest
+
+from media_progress import PlaybackStore, SCHEMA
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = PlaybackStore(str(tmp_path / 'progress.db'), flush_interval=3600)
+    yield store
+    store.close()
+
+
+def test_reports_are_coalesced(store):
+    store.save_progress('a.mp4', 1.0, 1.0)
+    store.save_progress('a.mp4', 2.0, 1.0)
+    store.flush()
+    assert store.coalesced == 1
+    assert store.flushes == 1
+    assert store.progress('a.mp4')['position'] == 2.0
+
+
+def test_failed_flush_keeps_pending(store, capsys):
+    store.save_progress('a.mp4', 1.0, 1.0)
+    store.flush()
+    store.save_progress('b.mp4', 5.0, 1.5, 1.0, 4.0)
+    store._db.execute('DROP TABLE progress')
+
+    with pytest.raises(sqlite3.Error):
+        store.flush()
+    assert store.progress('b.mp4')['position'] == 5.0
+
+    # recent() 不因数据库出错而失败，返回还没写入的进度
+    assert [file for file, _ in store.recent()] == ['b.mp4']
+    assert '⚠️' in capsys.readouterr().out
+
+    store._db.executescript(SCHEMA)
+    store.flush()
+    assert store.flushes == 2
+    assert store._db.execute('SELECT file, position FROM progress').fetchall() == [('b.mp4', 5.0)]
+
+
+def test_recent_orders_pending_and_stored(store):
+    store.save_progress('old.mp4', 1.0, 1.0)
+    store.flush()
+    store.save_progress('new.mp4', 2.0, 1.0)
+    assert [file for file, _ in store.recent()] == ['new.mp4', 'old.mp4']
+    assert [file for file, _ in store.recent(limit=1)] == ['new.mp4']
+    # recent() 不写数据库，还没写入的进度留到下次定期写入
+    assert store.flushes == 1
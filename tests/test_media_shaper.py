@@ -0,0 +1,62 @@
+import threading
+
+from media_shaper import BandwidthShaper
+
+MB = 1024 * 1024
+
+
+def test_first_request_is_critical():
+    shaper = BandwidthShaper(critical_bytes=MB)
+    stream = shaper.open_stream('a', 'f.mp4', 0)
+    assert stream.critical
+    stream.consume(MB)
+    assert not stream.critical
+    stream.close()
+
+
+def test_continuation_is_not_critical():
+    shaper = BandwidthShaper(critical_bytes=MB)
+    stream = shaper.open_stream('a', 'f.mp4', 0)
+    stream.consume(4 * MB)
+    stream.close()
+    # 接着上次位置（Service Worker 对齐到块边界，可能稍早）
+    stream = shaper.open_stream('a', 'f.mp4', 4 * MB - 512 * 1024)
+    assert not stream.critical
+    stream.close()
+    # 其它客户端、其它文件、跳转都不是接着读
+    assert shaper.open_stream('b', 'f.mp4', 4 * MB).critical
+    assert shaper.open_stream('a', 'g.mp4', 4 * MB).critical
+    assert shaper.open_stream('a', 'f.mp4', 40 * MB).critical
+
+
+def test_prefetch_is_not_critical():
+    shaper = BandwidthShaper(critical_bytes=MB)
+    assert not shaper.open_stream('a', 'f.mp4', 0, prefetch=True).critical
+
+
+def test_prefetch_waits_for_critical_stream():
+    shaper = BandwidthShaper(critical_bytes=MB)
+    critical = shaper.open_stream('a', 'f.mp4', 0)
+    prefetch = shaper.open_stream('a', 'f.mp4', 50 * MB, prefetch=True)
+    done = threading.Event()
+
+    def send():
+        prefetch.consume(1024)
+        done.set()
+
+    threading.Thread(target=send, daemon=True).start()
+    assert not done.wait(0.1)
+    critical.close()
+    assert done.wait(1)
+    prefetch.close()
+
+
+def test_rate_is_shared_by_weight():
+    shaper = BandwidthShaper(total_rate=10 * MB, critical_bytes=MB)
+    seeking = shaper.open_stream('a', 'f.mp4', 0)
+    playing = shaper.open_stream('b', 'f.mp4', 0, prefetch=True)
+    rates = {item['client']: item['rate'] for item in shaper.allocations()['clients']}
+    assert rates == {'a': 8 * MB, 'b': 2 * MB}
+    seeking.close()
+    assert shaper.allocations()['clients'][0]['rate'] == 10 * MB
+    playing.close()
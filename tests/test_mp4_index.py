@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""mp4_index 的测试：用合成的MP4文件检查采样表查找、虚拟faststart和分片表"""
+
+import os
+import struct
+
+import pytest
+
+import mp4_index
+from mp4_index import MP4Error, MP4Index, FragmentMap
+
+
+def box(box_type, *parts):
+    body = b''.join(parts)
+    return struct.pack('>I4s', 8 + len(body), box_type) + body
+
+
+def full(box_type, version, flags, *parts):
+    return box(box_type, struct.pack('>I', (version << 24) | flags), *parts)
+
+
+def desc(tag, body):
+    return bytes([tag, len(body)]) + body
+
+
+# avc1（High@3.1）和 AAC-LC 的采样描述
+AVC1 = box(b'avc1', b'\0' * 6 + struct.pack('>H', 1), b'\0' * 16, struct.pack('>HH', 640, 360),
+           b'\0' * 50, box(b'avcC', bytes([1, 0x64, 0, 0x1f, 0xff])))
+ESDS = full(b'esds', 0, 0, desc(3, struct.pack('>HB', 1, 0)
+                                + desc(4, bytes([0x40, 0x15]) + b'\0' * 11 + desc(5, bytes([0x12, 0x10])))
+                                + desc(6, b'\2')))
+MP4A = box(b'mp4a', b'\0' * 6 + struct.pack('>H', 1) + b'\0' * 8
+           + struct.pack('>HHHHI', 2, 16, 0, 0, 44100 << 16), ESDS)
+
+
+def trak(track_id, kind, timescale, duration, entry, stts, sizes, stsc, offsets,
+         stss=None, co64=False, width=0, height=0):
+    """一条轨道；sizes 为列表（逐个大小）或 (固定大小, 采样数)"""
+    tkhd = full(b'tkhd', 0, 3, struct.pack('>IIIII', 0, 0, track_id, 0, duration), b'\0' * 52,
+                struct.pack('>II', width << 16, height << 16))
+    mdhd = full(b'mdhd', 0, 0, struct.pack('>IIII', 0, 0, timescale, duration), b'\0' * 4)
+    hdlr = full(b'hdlr', 0, 0, b'\0' * 4, kind, b'\0' * 12, b'x\0')
+    tables = [
+        full(b'stsd', 0, 0, struct.pack('>I', 1), entry),
+        full(b'stts', 0, 0, struct.pack('>I', len(stts)), *(struct.pack('>II', *run) for run in stts)),
+    ]
+    if isinstance(sizes, tuple):
+        tables.append(full(b'stsz', 0, 0, struct.pack('>II', *sizes)))
+    else:
+        tables.append(full(b'stsz', 0, 0, struct.pack('>II', 0, len(sizes)),
+                           *(struct.pack('>I', size) for size in sizes)))
+    if stss is not None:
+        tables.append(full(b'stss', 0, 0, struct.pack('>I', len(stss)),
+                           *(struct.pack('>I', k) for k in stss)))
+    tables.append(full(b'stsc', 0, 0, struct.pack('>I', len(stsc)),
+                       *(struct.pack('>III', first, per, 1) for first, per in stsc)))
+    if co64:
+        tables.append(full(b'co64', 0, 0, struct.pack('>I', len(offsets)),
+                           *(struct.pack('>Q', offset) for offset in offsets)))
+    else:
+        tables.append(full(b'stco', 0, 0, struct.pack('>I', len(offsets)),
+                           *(struct.pack('>I', offset) for offset in offsets)))
+    return box(b'trak', tkhd, box(b'mdia', mdhd, hdlr, box(b'minf', box(b'stbl', *tables))))
+
+
+# 视频：10个采样，两段 stts（4×100、6×50，timescale 1000），关键帧 1/5/9，
+# stsc 前两个chunk每个3个采样、之后每个2个；音频：10个4字节采样，每chunk 5个，用 co64
+VIDEO_SIZES = [10 + i for i in range(10)]
+VIDEO_CHUNKS = [[0, 1, 2], [3, 4, 5], [6, 7], [8, 9]]
+AUDIO_CHUNKS = [[0, 1, 2, 3, 4], [5, 6, 7, 8, 9]]
+GAP = b'\xee' * 7
+
+
+def video_sample(i):
+    return bytes([i + 1]) * VIDEO_SIZES[i]
+
+
+def audio_sample(i):
+    return bytes([0x80 + i]) * 4
+
+
+def build_mp4(moov_first):
+    """返回 (文件内容, 视频各采样的偏移, 音频各chunk的偏移)"""
+    ftyp = box(b'ftyp', b'isom\0\0\2\0isomiso2')
+    # 交错排列：视频chunk0、音频chunk0、视频chunk1、音频chunk1、视频chunk2、视频chunk3，chunk之间有空隙
+    order = [('v', 0), ('a', 0), ('v', 1), ('a', 1), ('v', 2), ('v', 3)]
+
+    def layout(mdat_payload_start):
+        payload = b''
+        video_chunk_offsets = [0] * len(VIDEO_CHUNKS)
+        audio_chunk_offsets = [0] * len(AUDIO_CHUNKS)
+        video_offsets = [0] * len(VIDEO_SIZES)
+        for kind, n in order:
+            payload += GAP
+            offset = mdat_payload_start + len(payload)
+            if kind == 'v':
+                video_chunk_offsets[n] = offset
+                for i in VIDEO_CHUNKS[n]:
+                    video_offsets[i] = mdat_payload_start + len(payload)
+                    payload += video_sample(i)
+            else:
+                audio_chunk_offsets[n] = offset
+                payload += b''.join(audio_sample(i) for i in AUDIO_CHUNKS[n])
+        return payload, video_chunk_offsets, audio_chunk_offsets, video_offsets
+
+    def moov(video_chunk_offsets, audio_chunk_offsets):
+        return box(b'moov', full(b'mvhd', 0, 0, b'\0' * 96),
+                   trak(1, b'vide', 1000, 700, AVC1, [(4, 100), (6, 50)], VIDEO_SIZES,
+                        [(1, 3), (3, 2)], video_chunk_offsets, stss=[1, 5, 9], width=640, height=360),
+                   trak(2, b'soun', 44100, 10240, MP4A, [(10, 1024)], (4, 10), [(1, 5)],
+                        audio_chunk_offsets, co64=True))
+
+    # moov 的大小与偏移的值无关，先用占位的偏移算出 mdat 的位置
+    moov_size = len(moov([0] * len(VIDEO_CHUNKS), [0] * len(AUDIO_CHUNKS)))
+    mdat_payload_start = len(ftyp) + (moov_size if moov_first else 0) + 8
+    payload, video_chunks, audio_chunks, video_offsets = layout(mdat_payload_start)
+    mdat = box(b'mdat', payload)
+    moov_box = moov(video_chunks, audio_chunks)
+    data = ftyp + moov_box + mdat if moov_first else ftyp + mdat + moov_box
+    return data, video_offsets, audio_chunks
+
+
+@pytest.fixture
+def faststart_file(tmp_path):
+    data, video_offsets, audio_chunks = build_mp4(moov_first=True)
+    path = tmp_path / 'faststart.mp4'
+    path.write_bytes(data)
+    return str(path), video_offsets, audio_chunks
+
+
+@pytest.fixture
+def moov_at_end_file(tmp_path):
+    data, video_offsets, audio_chunks = build_mp4(moov_first=False)
+    path = tmp_path / 'moov_at_end.mp4'
+    path.write_bytes(data)
+    return str(path), video_offsets, audio_chunks
+
+
+def test_tracks(faststart_file):
+    index = MP4Index(faststart_file[0])
+    video, audio = index.tracks
+    assert (video.track_id, video.kind, video.codec) == (1, 'vide', 'avc1')
+    assert (video.width, video.height) == (640, 360)
+    assert video.codec_string == 'avc1.64001f'
+    assert audio.codec_string == 'mp4a.40.2'
+    assert video.sample_count == 10 and audio.sample_count == 10
+    assert index.main_track is video
+    # 各轨道时长中最长的（视频 700/1000，音频 10240/44100）
+    assert index.duration == 0.7
+
+
+def test_stts_lookup():
+    data, _, _ = build_mp4(moov_first=True)
+    video = _video_track(data)
+    # 第一段游程每帧100，第二段从400开始每帧50；超出范围的时间截到首尾
+    assert [video.sample_at(t) for t in (0.0, 0.099, 0.25, 0.42, 0.5, 0.649, 5.0, -1)] == \
+        [0, 0, 2, 4, 6, 8, 9, 0]
+    assert [video.sample_time(i) for i in (0, 3, 4, 6, 9)] == [0.0, 0.3, 0.4, 0.5, 0.65]
+
+
+def test_keyframes():
+    data, _, _ = build_mp4(moov_first=True)
+    video = _video_track(data)
+    assert [video.keyframe_at_or_before(i) for i in range(10)] == [0, 0, 0, 0, 4, 4, 4, 4, 8, 8]
+    assert video.keyframe_times() == [0.0, 0.4, 0.6]
+
+
+def test_sample_offsets_stsc_runs(faststart_file):
+    path, video_offsets, audio_chunks = faststart_file
+    index = MP4Index(path)
+    video, audio = index.tracks
+    assert list(video.sample_offsets()) == video_offsets
+    # co64 + 固定采样大小
+    expected = [audio_chunks[i // 5] + (i % 5) * 4 for i in range(10)]
+    assert list(audio.sample_offsets()) == expected
+    with open(path, 'rb') as f:
+        for i, offset in enumerate(video_offsets):
+            f.seek(offset)
+            assert f.read(VIDEO_SIZES[i]) == video_sample(i)
+
+
+def test_lookup(faststart_file):
+    path, video_offsets, _ = faststart_file
+    point = MP4Index(path).lookup(0.5)
+    assert point.time == 0.5
+    assert point.offset == video_offsets[6]
+    assert point.keyframe_time == 0.4
+    assert point.keyframe_offset == video_offsets[4]
+
+
+def test_no_faststart_needed(faststart_file):
+    index = MP4Index(faststart_file[0])
+    assert not index.moov_at_end
+    assert index.faststart_layout() is None
+
+
+def test_virtual_faststart(moov_at_end_file, tmp_path):
+    path, video_offsets, _ = moov_at_end_file
+    index = MP4Index(path)
+    assert index.moov_at_end
+    layout = index.faststart_layout()
+    assert layout.size == os.path.getsize(path)
+
+    virtual = b''.join(layout.iter_range(path, 0, layout.size, chunk_size=5))
+    assert len(virtual) == layout.size
+    # 任意一段与整体读出的对应部分相同（跨越 ftyp/moov/mdat 的边界）
+    for start, length in [(0, 1), (5, 100), (30, 400), (layout.size - 9, 9), (layout.size - 3, 50)]:
+        assert b''.join(layout.iter_range(path, start, length)) == virtual[start:start + length]
+
+    # 虚拟文件本身是 moov 在前的有效MP4，改写后的偏移指向相同的采样数据
+    virtual_path = tmp_path / 'virtual.mp4'
+    virtual_path.write_bytes(virtual)
+    patched = MP4Index(str(virtual_path))
+    assert not patched.moov_at_end
+    offsets = patched.tracks[0].sample_offsets()
+    for i in range(10):
+        assert virtual[offsets[i]:offsets[i] + VIDEO_SIZES[i]] == video_sample(i)
+    assert [layout.map_offset(offset) for offset in video_offsets] == list(offsets)
+
+
+def test_layout_file_behaves_like_a_file(moov_at_end_file):
+    """wsgi.file_wrapper 先 tell/seek 到末尾求长度，读出后再 seek 退回未发送的部分"""
+    path = moov_at_end_file[0]
+    layout = MP4Index(path).faststart_layout()
+    virtual = b''.join(layout.iter_range(path, 0, layout.size))
+    with layout.open(path) as f:
+        f.seek(30)
+        assert f.seek(0, os.SEEK_END) == layout.size
+        f.seek(30)
+        assert f.read(400) == virtual[30:430]
+        f.seek(-50, os.SEEK_CUR)
+        assert f.tell() == 380
+        assert f.read() == virtual[380:]
+        assert f.read(10) == b''
+
+
+def test_faststart_failure_is_cached(moov_at_end_file, monkeypatch):
+    index = MP4Index(moov_at_end_file[0])
+    calls = []
+
+    def fail(layout, index):
+        calls.append(index)
+        raise MP4Error('chunk偏移超出stco范围')
+
+    monkeypatch.setattr(mp4_index.FaststartLayout, '__init__', fail)
+    assert index.faststart_layout() is None
+    assert index.faststart_layout() is None
+    assert len(calls) == 1
+
+
+def test_not_mp4(tmp_path):
+    path = tmp_path / 'random.mp4'
+    path.write_bytes(os.urandom(1000))
+    with pytest.raises(MP4Error):
+        MP4Index(str(path))
+    assert mp4_index.keyframe_times(str(path)) == []
+
+
+def test_open_index_caches_result_and_failure(tmp_path, monkeypatch):
+    good = tmp_path / 'good.mp4'
+    good.write_bytes(build_mp4(moov_first=True)[0])
+    bad = tmp_path / 'bad.mp4'
+    bad.write_bytes(b'\0\0\0\x10junk' + b'x' * 100)
+
+    calls = []
+    original = mp4_index.read_top_level_boxes
+    monkeypatch.setattr(mp4_index, 'read_top_level_boxes',
+                        lambda f, size: calls.append(f.name) or original(f, size))
+
+    assert mp4_index.open_index(str(good)) is mp4_index.open_index(str(good))
+    for _ in range(3):
+        with pytest.raises(MP4Error):
+            mp4_index.open_index(str(bad))
+    assert sorted(calls) == sorted([str(good), str(bad)])
+
+    # 文件变化后重新解析
+    bad.write_bytes(build_mp4(moov_first=True)[0])
+    os.utime(bad, ns=(1, 1))
+    assert mp4_index.open_index(str(bad)).tracks
+
+
+def build_fragmented(fragments=4):
+    """分片MP4：每个片段2秒视频（50帧×512，timescale 12800）和86个AAC帧，最后有 mfra"""
+    def empty_trak(track_id, kind, timescale, entry, width=0, height=0):
+        tkhd = full(b'tkhd', 0, 3, struct.pack('>IIIII', 0, 0, track_id, 0, 0), b'\0' * 52,
+                    struct.pack('>II', width << 16, height << 16))
+        mdhd = full(b'mdhd', 0, 0, struct.pack('>IIII', 0, 0, timescale, 0), b'\0' * 4)
+        hdlr = full(b'hdlr', 0, 0, b'\0' * 4, kind, b'\0' * 12, b'x\0')
+        stbl = box(b'stbl', full(b'stsd', 0, 0, struct.pack('>I', 1), entry),
+                   full(b'stts', 0, 0, b'\0' * 4), full(b'stsc', 0, 0, b'\0' * 4),
+                   full(b'stsz', 0, 0, b'\0' * 8), full(b'stco', 0, 0, b'\0' * 4))
+        return box(b'trak', tkhd, box(b'mdia', mdhd, hdlr, box(b'minf', stbl)))
+
+    trex = b''.join(full(b'trex', 0, 0, struct.pack('>IIIII', track_id, 1, duration, 0, 0))
+                    for track_id, duration in ((1, 512), (2, 1024)))
+    moov = box(b'moov', full(b'mvhd', 0, 0, b'\0' * 96),
+               empty_trak(1, b'vide', 12800, AVC1, 640, 360), empty_trak(2, b'soun', 44100, MP4A),
+               box(b'mvex', trex))
+    data = box(b'ftyp', b'isom\0\0\2\0isomiso6') + moov
+    init_size = len(data)
+    offsets = []
+    for n in range(fragments):
+        # 视频 trun 带逐采样时长，音频用 tfhd 中的默认时长
+        trun = full(b'trun', 0, 0x301, struct.pack('>Ii', 50, 0),
+                    b''.join(struct.pack('>II', 512, 100) for _ in range(50)))
+        traf_video = box(b'traf', full(b'tfhd', 0, 0x20000, struct.pack('>I', 1)),
+                         full(b'tfdt', 1, 0, struct.pack('>Q', n * 50 * 512)), trun)
+        traf_audio = box(b'traf', full(b'tfhd', 0, 0x20008, struct.pack('>II', 2, 1024)),
+                         full(b'tfdt', 0, 0, struct.pack('>I', n * 86 * 1024)),
+                         full(b'trun', 0, 0x200, struct.pack('>I', 86) + struct.pack('>I', 10) * 86))
+        offsets.append(len(data))
+        data += box(b'moof', full(b'mfhd', 0, 0, struct.pack('>I', n + 1)), traf_video, traf_audio)
+        data += box(b'mdat', b'\0' * 5860)
+    media_end = len(data)
+    data += box(b'mfra', b'\0' * 8)
+    return data, init_size, offsets, media_end
+
+
+def test_fragment_map(tmp_path):
+    data, init_size, offsets, media_end = build_fragmented()
+    path = tmp_path / 'fragmented.mp4'
+    path.write_bytes(data)
+    fragments = FragmentMap(str(path))
+    assert fragments.mime == 'video/mp4; codecs="avc1.64001f,mp4a.40.2"'
+    assert fragments.init_size == init_size
+    assert [(f.start, f.end) for f in fragments.fragments] == [(0, 2), (2, 4), (4, 6), (6, 8)]
+    assert [f.offset for f in fragments.fragments] == offsets
+    # 最后一个片段不包括 mfra
+    last = fragments.fragments[-1]
+    assert last.offset + last.size == media_end
+    assert fragments.duration == 8
+
+    merged = fragments.segments(3)
+    assert [(s.start, s.end) for s in merged] == [(0, 4), (4, 8)]
+    assert merged[1].offset == offsets[2]
+    assert merged[1].offset + merged[1].size == media_end
+
+
+def test_plain_mp4_is_not_fragmented(faststart_file):
+    with pytest.raises(MP4Error):
+        FragmentMap(faststart_file[0])
+
+
+def _video_track(data):
+    """不写文件，直接从 moov 解析视频轨道"""
+    boxes = list(mp4_index.iter_boxes(data))
+    moov = next(b for b in boxes if b.type == b'moov')
+    moov_data = memoryview(data[moov.start:moov.start + moov.size])
+    trak = next(b for b in mp4_index.iter_boxes(moov_data, moov.header_size, moov.size)
+                if b.type == b'trak')
+    return mp4_index.Track(moov_data, trak)
@@ -0,0 +1,187 @@
+import json
+import threading
+import time
+
+import pytest
+from werkzeug.wsgi import FileWrapper
+
+import mp4_index
+import web_player
+from test_mp4_index import build_mp4
+
+
+@pytest.fixture
+def media_root(tmp_path, monkeypatch):
+    root = tmp_path / 'media'
+    root.mkdir()
+    monkeypatch.setattr(web_player, 'MEDIA_ROOTS', [str(root)])
+    monkeypatch.setattr(web_player, 'LIBRARY_DB', str(tmp_path / 'library.db'))
+    monkeypatch.setattr(web_player, 'PROGRESS_DB', str(tmp_path / 'progress.db'))
+    monkeypatch.setattr(web_player, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(web_player, '_library', None)
+    monkeypatch.setattr(web_player, '_progress_store', None)
+    monkeypatch.setattr(web_player, '_block_cache', None)
+    monkeypatch.setattr(web_player, '_sessions', {})
+    yield root
+    if web_player._progress_store is not None:
+        web_player._progress_store.close()
+
+
+@pytest.fixture
+def client(media_root):
+    return web_player.app.test_client()
+
+
+@pytest.fixture
+def moov_at_end(media_root):
+    """moov 在末尾的MP4，返回 (文件名, 虚拟faststart布局的全部字节)"""
+    path = media_root / 'clip.mp4'
+    path.write_bytes(build_mp4(moov_first=False)[0])
+    layout = mp4_index.open_index(str(path)).faststart_layout()
+    return 'clip.mp4', b''.join(layout.iter_range(str(path), 0, layout.size))
+
+
+def test_faststart_full_and_single_range(client, moov_at_end):
+    name, virtual = moov_at_end
+    response = client.get(f'/media/{name}')
+    assert response.status_code == 200
+    assert response.data == virtual
+    assert response.headers['ETag'].endswith('-faststart"')
+
+    response = client.get(f'/media/{name}', headers={'Range': 'bytes=30-429'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 30-429/{len(virtual)}'
+    assert response.data == virtual[30:430]
+
+
+def test_faststart_through_file_wrapper(client, moov_at_end):
+    """waitress 的 wsgi.file_wrapper 按 Content-Length 截断，不到末尾的区间也交给它发送"""
+    name, virtual = moov_at_end
+    wrapped = []
+
+    def wrapper(f, block_size):
+        wrapped.append(f)
+        return FileWrapper(f, block_size)
+
+    environ = {'wsgi.file_wrapper': wrapper, 'SERVER_SOFTWARE': 'waitress'}
+    response = client.get(f'/media/{name}', headers={'Range': 'bytes=100-'},
+                          environ_overrides=environ)
+    assert response.status_code == 206
+    assert response.data == virtual[100:]
+    response = client.get(f'/media/{name}', headers={'Range': 'bytes=10-59'},
+                          environ_overrides=environ)
+    assert response.data[:int(response.headers['Content-Length'])] == virtual[10:60]
+    assert len(wrapped) == 2
+
+
+def test_faststart_multipart(client, moov_at_end):
+    name, virtual = moov_at_end
+    response = client.get(f'/media/{name}', headers={'Range': 'bytes=0-9,200-299'})
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    assert int(response.headers['Content-Length']) == len(response.data)
+    boundary = response.mimetype_params['boundary'].encode('ascii')
+    parts = response.data.split(b'--' + boundary)
+    assert parts[-1] == b'--\r\n'
+    bodies = [part.split(b'\r\n\r\n', 1)[1][:-2] for part in parts[1:-1]]
+    assert bodies == [virtual[0:10], virtual[200:300]]
+    assert f'Content-Range: bytes 200-299/{len(virtual)}'.encode('ascii') in parts[2]
+
+
+def test_faststart_if_range(client, moov_at_end):
+    name, virtual = moov_at_end
+    etag = client.head(f'/media/{name}').headers['ETag']
+    response = client.get(f'/media/{name}', headers={'Range': 'bytes=0-99', 'If-Range': etag})
+    assert response.status_code == 206
+    assert response.data == virtual[:100]
+    # 文件已经变了（ETag 不符）时忽略 Range，返回整个文件
+    response = client.get(f'/media/{name}', headers={'Range': 'bytes=0-99', 'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert response.data == virtual
+
+
+def post_state(client, room, token, **state):
+    return client.post(f'/api/sessions/{room}/state', headers={'X-Session-Token': token},
+                       data=json.dumps(state), content_type='application/json')
+
+
+def test_session_state_validation(client):
+    data = client.post('/api/sessions').get_json()
+    room, token = data['room'], data['token']
+    assert post_state(client, room, token, position='5', rate=1).status_code == 400
+    assert post_state(client, room, token, position=5, rate=True).status_code == 400
+    assert post_state(client, room, token, position=float('nan'), rate=1).status_code == 400
+    assert post_state(client, room, token, position=5, rate=1, a=8, b=4).status_code == 400
+    assert post_state(client, 'NOROOM', token, position=5, rate=1).status_code == 404
+    assert post_state(client, room, 'wrong', position=5, rate=1).status_code == 403
+
+    response = post_state(client, room, token, file='clip.mp4', playing=1, position=5, rate=1)
+    assert response.status_code == 200
+    state = response.get_json()['state']
+    assert state['position'] == 5.0 and state['playing'] is True
+
+
+def test_progress_validation(client, media_root):
+    (media_root / 'a b.mp4').write_bytes(b'\0' * 16)
+    url = '/api/resume/a%2520b.mp4'
+    for body in ({'position': '5', 'speed': 1}, {'position': 5, 'speed': False},
+                 {'position': float('inf'), 'speed': 1}, {'position': 5, 'speed': 100}, [5]):
+        response = client.post(url, data=json.dumps(body))
+        assert response.status_code == 400
+
+    # sendBeacon 上报时 Content-Type 不是 application/json
+    response = client.post(url, data=json.dumps({'position': 5, 'speed': 1.5, 'a': 1, 'b': 4}),
+                           content_type='text/plain')
+    assert response.status_code == 200
+    progress = client.get('/api/resume/a%20b.mp4').get_json()['progress']
+    assert (progress['position'], progress['speed'], progress['b']) == (5.0, 1.5, 4.0)
+
+    assert client.post('/api/bookmarks/a%2520b.mp4', json={'name': 'x', 'a': 1}).status_code == 400
+    response = client.post('/api/bookmarks/a%2520b.mp4', json={'name': ' 副歌 ', 'a': 1, 'b': 4})
+    assert response.get_json()['bookmarks'] == [{'name': '副歌', 'a': 1.0, 'b': 4.0}]
+    assert client.get('/api/resume/missing.mp4').status_code == 404
+
+
+def test_seek_prefetch_is_bounded(monkeypatch, tmp_path):
+    release = threading.Event()
+
+    def prefetch(key):
+        release.wait(5)
+        with web_player._prefetch_lock:
+            web_player._prefetch_pending.discard(key)
+
+    monkeypatch.setattr(web_player, '_prefetch', prefetch)
+    monkeypatch.setattr(web_player, '_prefetch_pending', set())
+    limit = web_player.SEEK_PREFETCH_WORKERS + web_player.SEEK_PREFETCH_QUEUE
+    path = str(tmp_path / 'clip.mp4')
+    assert web_player.prefetch_range(path, 0, 100)
+    # 同一段正在预读时不重复提交
+    assert not web_player.prefetch_range(path, 0, 100)
+    assert all(web_player.prefetch_range(path, n * 100, 100) for n in range(1, limit))
+    # 已满时丢弃
+    assert not web_player.prefetch_range(path, limit * 100, 100)
+    release.set()
+    deadline = time.monotonic() + 5
+    while web_player._prefetch_pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert web_player.prefetch_range(path, limit * 100, 100)
+
+
+def test_session_followers_are_limited(client, monkeypatch):
+    """等待中的查询各占一个线程，名额满时新的跟随者明确失败，不降级为定期查询"""
+    monkeypatch.setattr(web_player, 'SESSION_WAIT_LIMIT', 2)
+    room = client.post('/api/sessions').get_json()['room']
+    other = client.post('/api/sessions').get_json()['room']
+
+    def poll(room, follower):
+        return client.get(f'/api/sessions/{room}/poll?follower={follower}')
+
+    assert poll(room, 'a').status_code == 200
+    assert poll(other, 'b').status_code == 200
+    response = poll(room, 'c')
+    assert response.status_code == 503
+    assert '最多2人' in response.get_json()['error']
+    # 已经在跟随的可以继续查询
+    data = poll(room, 'a').get_json()
+    assert set(data) == {'id', 'state'}
+    assert client.get(f'/api/sessions/{room}').get_json()['followers'] == 1
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+全能播放器 - 音频波形
+边解码边用 NumPy 计算多级 min/max 峰值金字塔，保存为紧凑的二进制文件：
+第0级每 samples_per_peak 个采样一对 (min, max)，之后每级把相邻 LEVEL_FACTOR 对合并为一对；
+显示时按可见时间范围和像素数选一级，缩放只读取需要的那一级
+"""
+
+import os
+import struct
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import media_tools
+from media_probe import wav_format, ProbeError, WAVE_FORMAT_PCM
+
+
+# ffmpeg 解码的采样率（单声道），以及第0级每秒的峰值对数（约4毫秒一对）
+DECODE_RATE = 16000
+PEAKS_PER_SECOND = 250
+
+# 相邻两级的倍数，以及最粗一级不少于的峰值对数
+LEVEL_FACTOR = 4
+MIN_LEVEL_PEAKS = 512
+
+# 每次从解码器读取的采样数
+CHUNK_SAMPLES = 64 * 1024
+
+# 解码失败时从 ffmpeg 错误输出末尾读取的字节数（取最后一行作为原因）
+STDERR_TAIL = 4096
+
+# 文件格式：头（魔数、版本、位深、级数、采样率、总采样数），
+# 每级一项（每对峰值的采样数、对数、数据偏移），然后依次是各级的 min,max 交错数据（小端）
+MAGIC = b'WFPK'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHIQ')
+LEVEL = struct.Struct('<IIQ')
+
+
+class WaveformError(Exception):
+    """无法生成或读取波形"""
+
+
+def can_build(path):
+    """本机能否为这个文件生成波形（没有 ffmpeg 时只支持16位PCM的WAV）"""
+    if numpy is None:
+        return False
+    if media_tools.FFMPEG is not None:
+        return True
+    return os.path.splitext(path)[1].lower() == '.wav'
+
+
+def _iter_wav(path):
+    """直接读取16位PCM WAV，多声道取平均：产生 (采样率, int16数组)"""
+    with open(path, 'rb') as f:
+        try:
+            wav = wav_format(f)
+        except (ProbeError, struct.error) as e:
+            raise WaveformError(str(e))
+        if wav.tag != WAVE_FORMAT_PCM or wav.bits != 16 or not wav.channels:
+            raise WaveformError('只支持16位PCM的WAV（其它格式需要 ffmpeg）')
+        f.seek(wav.data_offset)
+        frame = 2 * wav.channels
+        remaining = wav.data_size - wav.data_size % frame
+        while remaining > 0:
+            data = f.read(min(CHUNK_SAMPLES * frame, remaining))
+            if not data:
+                break
+            data = data[:len(data) - len(data) % frame]
+            remaining -= len(data)
+            samples = numpy.frombuffer(data, dtype='<i2')
+            if wav.channels > 1:
+                samples = samples.reshape(-1, wav.channels).mean(axis=1).astype(numpy.int16)
+            yield wav.sample_rate, samples
+
+
+def _iter_ffmpeg(path):
+    """通过 ffmpeg 管道边解码边读：产生 (采样率, int16数组)
+
+    错误输出写入临时文件而不是管道：损坏的文件可能产生大量错误信息，
+    管道写满后 ffmpeg 会阻塞，而这里要读完标准输出才去读错误输出。
+    """
+    with tempfile.TemporaryFile() as errors:
+        proc = media_tools.open_pcm(path, DECODE_RATE, stderr=errors)
+        try:
+            pending = b''
+            while True:
+                data = proc.stdout.read(CHUNK_SAMPLES * 2)
+                if not data:
+                    break
+                data = pending + data
+                usable = len(data) - len(data) % 2
+                pending = data[usable:]
+                yield DECODE_RATE, numpy.frombuffer(data[:usable], dtype='<i2')
+            if proc.wait() != 0:
+                size = errors.seek(0, os.SEEK_END)
+                errors.seek(max(size - STDERR_TAIL, 0))
+                error = errors.read().decode('utf-8', 'replace').strip()
+                raise WaveformError(error.splitlines()[-1] if error else 'ffmpeg 解码失败')
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+
+
+def _decode(path):
+    if media_tools.FFMPEG is not None:
+        return _iter_ffmpeg(path)
+    return _iter_wav(path)
+
+
+def compute_peaks(path):
+    """解码并计算第0级峰值，返回 (采样率, 每对采样数, 总采样数, mins, maxs)
+
+    每块解码结果按 samples_per_peak 分组后一次 reshape 求 min/max，
+    不足一组的尾部留到下一块，内存只与峰值数成正比。
+    """
+    sample_rate = samples_per_peak = None
+    carry = numpy.empty(0, dtype=numpy.int16)
+    mins, maxs = [], []
+    total = 0
+    for rate, samples in _decode(path):
+        if sample_rate is None:
+            sample_rate = rate
+            samples_per_peak = max(1, round(rate / PEAKS_PER_SECOND))
+        total += len(samples)
+        if len(carry):
+            samples = numpy.concatenate([carry, samples])
+        usable = len(samples) - len(samples) % samples_per_peak
+        if usable:
+            groups = samples[:usable].reshape(-1, samples_per_peak)
+            mins.append(groups.min(axis=1))
+            maxs.append(groups.max(axis=1))
+        carry = samples[usable:]
+    if sample_rate is None or total == 0:
+        raise WaveformError('没有音频')
+    if len(carry):
+        mins.append(carry.min(keepdims=True))
+        maxs.append(carry.max(keepdims=True))
+    return sample_rate, samples_per_peak, total, numpy.concatenate(mins), numpy.concatenate(maxs)
+
+
+def build_levels(mins, maxs, factor=LEVEL_FACTOR, min_peaks=MIN_LEVEL_PEAKS):
+    """由第0级逐级合并出金字塔 [(mins, maxs)]"""
+    levels = [(mins, maxs)]
+    while len(mins) >= min_peaks * factor:
+        pad = -len(mins) % factor
+        if pad:
+            # 用最后一个值补齐，不改变最后一组的 min/max
+            mins = numpy.concatenate([mins, numpy.repeat(mins[-1:], pad)])
+            maxs = numpy.concatenate([maxs, numpy.repeat(maxs[-1:], pad)])
+        mins = mins.reshape(-1, factor).min(axis=1)
+        maxs = maxs.reshape(-1, factor).max(axis=1)
+        levels.append((mins, maxs))
+    return levels
+
+
+def _quantize(mins, maxs, bits):
+    """int16 -> 交错的 min,max；8位时 min 向下、max 向上取整，波形只会略大不会被削掉"""
+    if bits == 8:
+        mins = numpy.right_shift(mins, 8).astype('<i1')
+        maxs = (-numpy.right_shift(-maxs.astype(numpy.int32), 8)).clip(-128, 127).astype('<i1')
+        dtype = '<i1'
+    else:
+        dtype = '<i2'
+    out = numpy.empty(len(mins) * 2, dtype=dtype)
+    out[0::2] = mins
+    out[1::2] = maxs
+    return out.tobytes()
+
+
+def build_waveform(src, dst, bits=8):
+    """生成 src 的波形文件 dst（bits 为 8 或 16）"""
+    if numpy is None:
+        raise WaveformError('需要安装 numpy')
+    sample_rate, samples_per_peak, total, mins, maxs = compute_peaks(src)
+    levels = build_levels(mins, maxs)
+    offset = HEADER.size + LEVEL.size * len(levels)
+    table = []
+    blobs = []
+    for i, (level_mins, level_maxs) in enumerate(levels):
+        blob = _quantize(level_mins, level_maxs, bits)
+        table.append(LEVEL.pack(samples_per_peak * LEVEL_FACTOR ** i, len(level_mins), offset))
+        blobs.append(blob)
+        offset += len(blob)
+    with open(dst, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, bits, len(levels), sample_rate, total))
+        f.writelines(table)
+        f.writelines(blobs)
+
+
+def read_header(path):
+    """{'bits', 'sample_rate', 'total_samples', 'duration', 'levels': [{samples_per_peak, count, offset}]}"""
+    with open(path, 'rb') as f:
+        data = f.read(HEADER.size)
+        if len(data) < HEADER.size:
+            raise WaveformError('波形文件不完整')
+        magic, version, bits, level_count, sample_rate, total = HEADER.unpack(data)
+        if magic != MAGIC or version != VERSION:
+            raise WaveformError('不是波形文件')
+        table = f.read(LEVEL.size * level_count)
+    levels = [dict(zip(('samples_per_peak', 'count', 'offset'),
+                       LEVEL.unpack_from(table, i * LEVEL.size))) for i in range(level_count)]
+    return {'bits': bits, 'sample_rate': sample_rate, 'total_samples': total,
+            'duration': total / sample_rate, 'levels': levels}
+
+
+def read_level(path, header, level):
+    """只读取第 level 级的数据（交错的 min,max 原始字节）"""
+    spec = header['levels'][level]
+    length = spec['count'] * 2 * header['bits'] // 8
+    with open(path, 'rb') as f:
+        f.seek(spec['offset'])
+        data = f.read(length)
+    if len(data) != length:
+        raise WaveformError('波形文件不完整')
+    return data
+
+
+def level_peaks(path, header, level):
+    """第 level 级的峰值，形状为 (对数, 2) 的数组，按 [-1, 1] 归一化"""
+    dtype = '<i1' if header['bits'] == 8 else '<i2'
+    scale = 128.0 if header['bits'] == 8 else 32768.0
+    peaks = numpy.frombuffer(read_level(path, header, level), dtype=dtype)
+    return peaks.reshape(-1, 2) / scale
+
+
+def choose_level(header, seconds, pixels):
+    """可见 seconds 秒、宽 pixels 像素时使用的级别：每个像素至少一对峰值的最粗一级"""
+    rate = header['sample_rate']
+    chosen = 0
+    for i, spec in enumerate(header['levels']):
+        if seconds * rate / spec['samples_per_peak'] >= pixels:
+            chosen = i
+    return chosen
+
+
+def column_peaks(peaks, samples_per_peak, sample_rate, start, end, pixels):
+    """把 [start, end) 秒内的峰值合并为每个像素一列，返回 (mins, maxs)，超出文件范围的列为0
+
+    放大到比这一级还细时，相邻几列显示同一对峰值。
+    """
+    mins = numpy.zeros(max(pixels, 0))
+    maxs = numpy.zeros(max(pixels, 0))
+    if not len(peaks) or pixels <= 0:
+        return mins, maxs
+    per_second = sample_rate / samples_per_peak
+    edges = numpy.floor(numpy.linspace(start * per_second, end * per_second, pixels + 1)).astype(int)
+    starts = edges[:-1]
+    inside = (starts >= 0) & (starts < len(peaks))
+    if inside.any():
+        index = starts[inside]
+        # 截到可见范围的末尾，最后一列不会一直合并到文件结尾
+        visible = peaks[:max(min(edges[-1], len(peaks)), index[-1] + 1)]
+        mins[inside] = numpy.minimum.reduceat(visible[:, 0], index)
+        maxs[inside] = numpy.maximum.reduceat(visible[:, 1], index)
+    return mins, maxs
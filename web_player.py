@@ -6,9 +6,42 @@
 支持AB循环、慢进/快进
 """
 
-from flask import Flask, render_template_string, request, jsonify
+from flask import Flask, request, jsonify, Response, abort
+from werkzeug.http import parse_range_header, is_resource_modified
+from datetime import datetime, timezone
+from collections import OrderedDict, deque
+import io
 import os
+import gzip
+import time
+import json
+import uuid
+import base64
+import hashlib
+import functools
+import math
+import mimetypes
+import atexit
+import argparse
+import threading
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from media_library import MediaLibrary, LibrarySnapshot
+from media_cache import DiskCache, BlockCache, file_fingerprint
+from media_shaper import BandwidthShaper
+from media_probe import MetadataProber
+from media_progress import PlaybackStore
+import media_tools
+import media_metrics
+import media_thumbs
+import mp4_index
+import waveform
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 
@@ -16,232 +49,2669 @@ app = Flask(__name__)
 VIDEO_EXTENSIONS = {'.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm', '.m4v'}
 AUDIO_EXTENSIONS = {'.mp3', '.wav', '.flac', '.aac', '.m4a', '.ogg', '.wma'}
 
-HTML_TEMPLATE = '''
-<!DOCTYPE html>
-<html lang="zh-CN">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no">
-    <title>全能播放器 - Web版</title>
-    <style>
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }
-        body {
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', 'PingFang SC', sans-serif;
-            background: #1a1a2e;
-            color: #fff;
-            min-height: 100vh;
-            padding: 10px;
-        }
-        .header {
-            text-align: center;
-            padding: 15px 0;
-            border-bottom: 1px solid #333;
-            margin-bottom: 15px;
-        }
-        .header h1 {
-            font-size: 20px;
-            color: #4CAF50;
-        }
-        .header p {
-            font-size: 12px;
-            color: #888;
-            margin-top: 5px;
-        }
-        .video-container {
-            background: #000;
-            border-radius: 10px;
-            overflow: hidden;
-            margin-bottom: 15px;
-            position: relative;
-        }
-        video, audio {
-            width: 100%;
-            display: block;
-        }
-        .controls {
-            background: #16213e;
-            border-radius: 10px;
-            padding: 15px;
-            margin-bottom: 15px;
-        }
-        .progress-container {
-            margin-bottom: 15px;
-        }
-        .time-display {
-            display: flex;
-            justify-content: space-between;
-            font-size: 12px;
-            color: #888;
-            margin-bottom: 5px;
-        }
-        input[type="range"] {
-            width: 100%;
-            height: 6px;
-            background: #333;
-            border-radius: 3px;
-            outline: none;
-            -webkit-appearance: none;
-        }
-        input[type="range"]::-webkit-slider-thumb {
-            -webkit-appearance: none;
-            width: 16px;
-            height: 16px;
-            background: #4CAF50;
-            border-radius: 50%;
-            cursor: pointer;
-        }
-        .btn-row {
-            display: flex;
-            gap: 10px;
-            margin-bottom: 15px;
-            flex-wrap: wrap;
-        }
-        button {
-            flex: 1;
-            min-width: 60px;
-            padding: 12px 8px;
-            border: none;
-            border-radius: 8px;
-            font-size: 14px;
-            font-weight: bold;
-            cursor: pointer;
-            transition: all 0.3s;
+# 媒体文件所在的根目录（可在命令行指定多个，递归扫描）
+MEDIA_ROOTS = ['.']
+
+# 扫描媒体库的线程数（NAS等慢速挂载可适当调大）
+SCAN_WORKERS = 8
+
+# 媒体库索引数据库
+DATA_DIR = os.path.join(os.path.expanduser('~'), '.web_player')
+LIBRARY_DB = os.path.join(DATA_DIR, 'library.db')
+
+# 播放进度和书签数据库，以及合并后的进度写入数据库的间隔（秒，崩溃时最多丢失这么久的进度）
+PROGRESS_DB = os.path.join(DATA_DIR, 'progress.db')
+PROGRESS_FLUSH_SECONDS = 2.0
+
+# 后台检查目录变化的间隔（秒）
+LIBRARY_REFRESH_INTERVAL = 10.0
+
+# 后台探测媒体信息（时长、编码、分辨率）的进程数（0 表示不探测）
+PROBE_WORKERS = 2
+
+# 生成文件（AB片段等）的磁盘缓存目录和容量
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+CLIP_CACHE_BYTES = 2 * 1024 ** 3
+
+# AB片段的最大长度（秒）
+MAX_CLIP_SECONDS = 600
+
+# 直接复制流截取片段时，A点之前最近的关键帧允许偏离的秒数
+CLIP_KEYFRAME_TOLERANCE = 0.1
+
+# 超过这个大小的视频，在支持HLS的浏览器上自动改用HLS分段播放（0 表示关闭）
+HLS_THRESHOLD_BYTES = 500 * 1024 ** 2
+
+# HLS片段的目标时长（秒，按关键帧对齐）和缓存容量
+HLS_SEGMENT_SECONDS = 6.0
+HLS_CACHE_BYTES = 10 * 1024 ** 3
+
+# 后台生成HLS片段的ffmpeg进程数，以及播放某片段时顺带预生成之后的片段数
+HLS_WORKERS = 2
+HLS_PREFETCH_SEGMENTS = 2
+
+# 切分还没完成时（202）建议客户端多久后再查（秒）
+HLS_PLAN_RETRY_SECONDS = 5
+
+# 浏览器无法直接播放的容器，通过ffmpeg转封装为分片MP4边转边播
+REMUX_EXTENSIONS = {'.mkv', '.avi', '.wmv', '.flv'}
+
+# 转封装结果的磁盘缓存容量（按文件内容指纹和转换方案缓存）
+REMUX_CACHE_BYTES = 20 * 1024 ** 3
+
+# MSE播放：片段表中每段的最短时长（秒，相邻的小片段合并为一段），
+# 以及在后台把普通MP4转封装为分片MP4的ffmpeg进程数
+MSE_SEGMENT_SECONDS = 2.0
+MSE_REMUX_WORKERS = 1
+
+# 自适应码率的转码档位（原文件作为最高一档 source，不高于原文件的档位才会生成）
+RENDITION_LADDER = [
+    {'name': '360p', 'height': 360, 'video_kbps': 800, 'audio_kbps': 96},
+    {'name': '720p', 'height': 720, 'video_kbps': 2500, 'audio_kbps': 128},
+]
+
+# 纯音频文件的转码档位（Opus）
+AUDIO_RENDITIONS = [{'name': 'opus', 'audio_kbps': 96}]
+
+# 同时运行的转码ffmpeg进程数，以及转码结果的缓存容量
+TRANSCODE_WORKERS = 1
+RENDITION_CACHE_BYTES = 20 * 1024 ** 3
+
+# 转码任务优先级（数值小的先执行）：用户正在打开的文件优先于后台预生成
+PRIORITY_OPEN = 0
+PRIORITY_BACKGROUND = 10
+
+# 后台生成（缩略图、波形、转封装）失败后多久内直接报告错误、不再重试（秒）
+GENERATION_RETRY_SECONDS = 10 * 60
+
+# 进度条预览缩略图：同时生成雪碧图的ffmpeg进程数，以及雪碧图的缓存容量
+THUMB_WORKERS = 2
+THUMB_CACHE_BYTES = 2 * 1024 ** 3
+
+# 音频波形：同时生成波形的进程数、每个峰值的位数（8 或 16）和缓存容量
+WAVEFORM_WORKERS = 1
+WAVEFORM_BITS = 8
+WAVEFORM_CACHE_BYTES = 1024 ** 3
+
+# 浏览器离线缓存（Service Worker）的容量：最近播放的媒体块、AB片段、缩略图和波形，超出后淘汰最久没用的
+OFFLINE_CACHE_BYTES = 500 * 1024 ** 2
+
+# 查询跳转位置时，在服务器端预读关键帧之后的字节数；
+# 预读的线程数和最多等待的预读数（超过时丢弃新的预读，拖动进度条时只会浪费磁盘带宽）
+SEEK_PREFETCH_BYTES = 2 * 1024 * 1024
+SEEK_PREFETCH_WORKERS = 2
+SEEK_PREFETCH_QUEUE = 8
+
+# 文件列表接口默认每页数量
+FILE_PAGE_SIZE = 100
+
+# 推送给页面的媒体库变化：保留最近的事件数（页面断线重连时按 Last-Event-ID 补发）
+EVENT_LOG_SIZE = 256
+
+# 每个事件流连接保持的秒数（到时结束，浏览器自动重连，不会长期占住服务器线程），
+# 以及同时保持的连接数上限（0 表示服务器线程数的一半）；超过上限的页面稍后重连
+EVENT_STREAM_SECONDS = 30
+EVENT_STREAM_LIMIT = 0
+EVENT_RETRY_MS = 3000
+
+# 同步播放房间：保留最近的事件数、没有跟随者时多久（秒）后删除房间，
+# 以及主持人的时间戳与服务器时钟允许相差的秒数（超过则改用收到请求的时间）
+SESSION_LOG_SIZE = 64
+SESSION_IDLE_SECONDS = 6 * 3600
+SESSION_CLOCK_TOLERANCE = 5.0
+
+# 跟随者用长轮询取主持人的状态（不保持事件流，也不占媒体库事件流的名额）：每次最多等待的秒数，
+# 所有房间合计的跟随者上限，以及多久没有查询算作已离开。
+# 等待中的查询各占一个 waitress 线程（waitress 不能把等待交给I/O线程），所以另外准备 SESSION_WAIT_LIMIT 个线程，
+# 同时也只接纳这么多跟随者：每个跟随者同时只有一个查询在等待，名额满时新的跟随者加入失败（503），不会降级为定期查询
+SESSION_POLL_SECONDS = 5
+SESSION_WAIT_LIMIT = 32
+SESSION_FOLLOWER_SECONDS = 15
+
+# 媒体流每次读取的块大小
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# 内存块缓存容量（多个客户端播放同一文件、反复AB循环时直接从内存发送，0 表示关闭），
+# 以及未命中时顺带预读的块数
+BLOCK_CACHE_BYTES = 256 * 1024 * 1024
+BLOCK_READ_AHEAD = 4
+
+# 带宽分配（Mbps，0 表示不限制）：所有客户端共享的总带宽和单个客户端的上限。
+# 开始播放或跳转后的第一个响应，开头这些字节算作播放急需的数据，优先于预读
+# （页面用 X-Prefetch: 1 请求头标明预读请求）
+SHAPE_TOTAL_MBPS = 0
+SHAPE_CLIENT_MBPS = 0
+SHAPE_CRITICAL_BYTES = 2 * 1024 * 1024
+
+# 生产服务器（waitress）：处理请求的线程数、最大连接数、空闲连接（keep-alive）超时秒数，
+# 以及每个连接的写缓冲上限（超过后应用线程等待客户端读取）
+# 文件和虚拟faststart布局的单段/整个响应交给 wsgi.file_wrapper 由I/O线程发送，同时播放的人数只受连接数限制；
+# 生成器响应体（多段Range、限速、首次观看的边转边播）要由处理线程推进到剩下的不超过写缓冲为止：
+# 多段Range一般只有几段小区间，很快释放线程；边转边播按ffmpeg的速度产出，整个转封装期间占用一个线程，
+# 所以同时首次观看（还没有缓存）的转封装流最多 SERVER_THREADS 个，再多的请求排队等待空闲线程
+SERVER_THREADS = 16
+# 限速时每个发送中的媒体响应占用一个线程（不能交给 wsgi.file_wrapper），没有指定 --threads 时用这么多线程
+SHAPED_SERVER_THREADS = 64
+SERVER_CONNECTION_LIMIT = 1000
+SERVER_KEEPALIVE_TIMEOUT = 120
+SERVER_WRITE_BUFFER = 16 * 1024 * 1024
+
+# 这些服务器的 wsgi.file_wrapper 会按 Content-Length 截断，不到文件末尾的区间也能交给它发送
+LENGTH_AWARE_SERVERS = ('waitress', 'gunicorn')
+
+# 多段Range请求合并后允许的最大段数，超过则返回整个文件
+MAX_RANGES = 16
+
+# 部分系统的mimetypes缺少这些格式
+MEDIA_MIMETYPES = {
+    '.mp4': 'video/mp4', '.m4v': 'video/mp4', '.mov': 'video/quicktime',
+    '.mkv': 'video/x-matroska', '.webm': 'video/webm', '.avi': 'video/x-msvideo',
+    '.wmv': 'video/x-ms-wmv', '.flv': 'video/x-flv',
+    '.mp3': 'audio/mpeg', '.wav': 'audio/wav', '.flac': 'audio/flac',
+    '.aac': 'audio/aac', '.m4a': 'audio/mp4', '.ogg': 'audio/ogg', '.wma': 'audio/x-ms-wma',
+}
+
+# 页面样式和脚本作为带内容哈希的静态资源发送（/assets/），浏览器可长期缓存
+PLAYER_CSS = '''
+* {
+    margin: 0;
+    padding: 0;
+    box-sizing: border-box;
+}
+body {
+    font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', 'PingFang SC', sans-serif;
+    background: #1a1a2e;
+    color: #fff;
+    min-height: 100vh;
+    padding: 10px;
+}
+.header {
+    text-align: center;
+    padding: 15px 0;
+    border-bottom: 1px solid #333;
+    margin-bottom: 15px;
+}
+.header h1 {
+    font-size: 20px;
+    color: #4CAF50;
+}
+.header p {
+    font-size: 12px;
+    color: #888;
+    margin-top: 5px;
+}
+.video-container {
+    background: #000;
+    border-radius: 10px;
+    overflow: hidden;
+    margin-bottom: 15px;
+    position: relative;
+}
+video, audio {
+    width: 100%;
+    display: block;
+}
+.controls {
+    background: #16213e;
+    border-radius: 10px;
+    padding: 15px;
+    margin-bottom: 15px;
+}
+.progress-container {
+    position: relative;
+    margin-bottom: 15px;
+}
+.thumb-preview {
+    display: none;
+    position: absolute;
+    bottom: 24px;
+    background: #000;
+    border: 2px solid #4CAF50;
+    border-radius: 4px;
+    overflow: hidden;
+    pointer-events: none;
+    z-index: 10;
+}
+.thumb-preview.active {
+    display: block;
+}
+.thumb-preview .thumb-image {
+    background-repeat: no-repeat;
+}
+.thumb-preview .thumb-time {
+    display: block;
+    text-align: center;
+    font-size: 12px;
+    padding: 2px 0;
+}
+.waveform {
+    display: none;
+    width: 100%;
+    height: 64px;
+    margin-bottom: 8px;
+    background: #0f1629;
+    border-radius: 4px;
+    cursor: pointer;
+}
+.waveform.active {
+    display: block;
+}
+.time-display {
+    display: flex;
+    justify-content: space-between;
+    font-size: 12px;
+    color: #888;
+    margin-bottom: 5px;
+}
+input[type="range"] {
+    width: 100%;
+    height: 6px;
+    background: #333;
+    border-radius: 3px;
+    outline: none;
+    -webkit-appearance: none;
+}
+input[type="range"]::-webkit-slider-thumb {
+    -webkit-appearance: none;
+    width: 16px;
+    height: 16px;
+    background: #4CAF50;
+    border-radius: 50%;
+    cursor: pointer;
+}
+.btn-row {
+    display: flex;
+    gap: 10px;
+    margin-bottom: 15px;
+    flex-wrap: wrap;
+}
+button {
+    flex: 1;
+    min-width: 60px;
+    padding: 12px 8px;
+    border: none;
+    border-radius: 8px;
+    font-size: 14px;
+    font-weight: bold;
+    cursor: pointer;
+    transition: all 0.3s;
+}
+.btn-green {
+    background: #4CAF50;
+    color: white;
+}
+.btn-green:hover {
+    background: #45a049;
+}
+.btn-red {
+    background: #f44336;
+    color: white;
+}
+.btn-red:hover {
+    background: #da190b;
+}
+.btn-orange {
+    background: #FF9800;
+    color: white;
+}
+.btn-orange:hover {
+    background: #e68900;
+}
+.btn-gray {
+    background: #607D8B;
+    color: white;
+}
+.btn-gray:hover {
+    background: #546E7A;
+}
+.speed-control {
+    background: #0f3460;
+    border-radius: 10px;
+    padding: 15px;
+    margin-bottom: 15px;
+}
+.speed-control h3 {
+    font-size: 14px;
+    margin-bottom: 10px;
+    color: #4CAF50;
+}
+.speed-buttons {
+    display: flex;
+    gap: 8px;
+    flex-wrap: wrap;
+}
+.speed-btn {
+    flex: 1;
+    min-width: 50px;
+    padding: 8px;
+    background: #1a1a2e;
+    border: 1px solid #4CAF50;
+    color: #4CAF50;
+    border-radius: 5px;
+}
+.speed-btn.active {
+    background: #4CAF50;
+    color: white;
+}
+.ab-status {
+    background: #0f3460;
+    border-radius: 10px;
+    padding: 15px;
+    text-align: center;
+}
+.ab-status h3 {
+    font-size: 14px;
+    margin-bottom: 10px;
+}
+.ab-status .status-text {
+    font-size: 16px;
+    font-weight: bold;
+    color: #4CAF50;
+}
+.file-section {
+    background: #16213e;
+    border-radius: 10px;
+    padding: 15px;
+    margin-bottom: 15px;
+}
+.file-section h3 {
+    font-size: 14px;
+    margin-bottom: 10px;
+    color: #4CAF50;
+}
+select, input[type="search"], input[type="text"] {
+    width: 100%;
+    padding: 10px;
+    background: #0f3460;
+    border: 1px solid #4CAF50;
+    color: white;
+    border-radius: 5px;
+    font-size: 14px;
+}
+.file-filter {
+    display: flex;
+    gap: 8px;
+    margin-bottom: 10px;
+}
+.file-filter select {
+    width: auto;
+}
+.playable-filter {
+    display: block;
+    font-size: 13px;
+    color: #aaa;
+    margin-bottom: 10px;
+}
+.file-more {
+    display: none;
+    width: 100%;
+    margin-top: 10px;
+}
+.file-more.active {
+    display: block;
+}
+.quality-select {
+    display: none;
+    margin-top: 10px;
+}
+.quality-select.active {
+    display: block;
+}
+.bookmark-row {
+    margin: 10px 0 0;
+}
+.bookmark-row select {
+    flex: 2;
+    min-width: 100px;
+}
+.session-section {
+    margin-top: 15px;
+}
+.session-section .btn-row {
+    margin: 10px 0 0;
+}
+.session-section input {
+    flex: 2;
+    min-width: 80px;
+}
+.session-section button {
+    display: none;
+}
+.session-section button.active {
+    display: block;
+}
+.offline-section {
+    display: none;
+    margin-top: 15px;
+}
+.offline-section.active {
+    display: block;
+}
+.offline-files {
+    margin: 10px 0;
+    font-size: 12px;
+    text-align: left;
+    color: #aaa;
+}
+.offline-files div {
+    overflow: hidden;
+    white-space: nowrap;
+    text-overflow: ellipsis;
+}
+.help-text {
+    background: #16213e;
+    border-radius: 10px;
+    padding: 15px;
+    font-size: 12px;
+    color: #888;
+    line-height: 1.6;
+}
+.help-text h3 {
+    color: #4CAF50;
+    margin-bottom: 10px;
+}
+.loop-indicator {
+    position: absolute;
+    top: 10px;
+    right: 10px;
+    background: rgba(76, 175, 80, 0.9);
+    color: white;
+    padding: 5px 10px;
+    border-radius: 5px;
+    font-size: 12px;
+    font-weight: bold;
+    display: none;
+}
+.loop-indicator.active {
+    display: block;
+}
+@media (max-width: 480px) {
+    button {
+        font-size: 12px;
+        padding: 10px 5px;
+    }
+    .speed-btn {
+        font-size: 12px;
+    }
+}
+'''
+
+PLAYER_JS = r'''
+const player = document.getElementById('mediaPlayer');
+const progressBar = document.getElementById('progressBar');
+const thumbPreview = document.getElementById('thumbPreview');
+const waveformCanvas = document.getElementById('waveform');
+const currentTimeEl = document.getElementById('currentTime');
+const durationEl = document.getElementById('duration');
+const playBtn = document.getElementById('playBtn');
+const abStatus = document.getElementById('abStatus');
+const loopIndicator = document.getElementById('loopIndicator');
+
+const fileSelect = document.getElementById('fileSelect');
+const fileSearch = document.getElementById('fileSearch');
+const fileSort = document.getElementById('fileSort');
+const fileMore = document.getElementById('fileMore');
+const playableOnly = document.getElementById('playableOnly');
+
+const clipBtn = document.getElementById('clipBtn');
+const qualitySelect = document.getElementById('qualitySelect');
+
+let pointA = null;
+let pointB = null;
+let isLooping = false;
+
+// AB循环调度：timeupdate 大约每250毫秒才触发一次，改为每帧检查
+// （有画面时用 requestVideoFrameCallback，纯音频或不支持时用 requestAnimationFrame），
+// 按播放速度预测越过B点的时刻，把跳转耗时也算进去提前跳回A点。
+// 每次循环的过冲（发起跳转时的位置 - B点，负数为提前）和跳转耗时记在 loopStats 里，可在控制台查看
+const LOOP_STATS_SIZE = 100;
+const MAX_SEEK_LATENCY = 0.25;
+const canFrameCallback = 'requestVideoFrameCallback' in HTMLVideoElement.prototype;
+const loopStats = [];
+let loopFrameHandle = null;
+let loopFrameIsVideo = false;
+let lastFrameTime = null;
+let frameStep = 1 / 30;
+let seekLatency = 0.05;
+let loopSeekStarted = null;
+
+// HLS：大视频分段播放，AB区间附近的片段定期预热
+const HLS_THRESHOLD = Number(document.body.dataset.hlsThreshold || 0);
+const VIDEO_EXTENSIONS = (document.body.dataset.videoExtensions || '').split(',');
+const REMUX_EXTENSIONS = (document.body.dataset.remuxExtensions || '').split(',').filter(Boolean);
+const HLS_WARM_INTERVAL = 60000;
+const canPlayHls = player.canPlayType('application/vnd.apple.mpegurl') !== '';
+let usingHls = false;
+let lastHlsWarm = 0;
+
+// 自适应码率：按实测带宽在原文件和服务器转码的低码率档位之间选择
+const TRANSCODE = document.body.dataset.transcode === '1';
+const THROUGHPUT_PROBE_BYTES = 512 * 1024;
+const THROUGHPUT_MAX_AGE = 60000;
+const RENDITION_POLL_INTERVAL = 10000;
+const BANDWIDTH_HEADROOM = 1.5;
+let renditions = [];
+let currentRendition = null;
+let renditionTimer = null;
+let throughputKbps = 0;
+let throughputTime = 0;
+
+// 进度条预览：服务器生成的缩略图雪碧图，拖动时只显示预览，松开才跳转
+const THUMB_POLL_INTERVAL = 3000;
+let thumbnails = null;
+let thumbnailTimer = null;
+let scrubbing = false;
+
+// 音频波形：服务器生成的多级峰值金字塔，按可见范围只下载需要的那一级；滚轮缩放，双击还原
+const WAVEFORM_POLL_INTERVAL = 3000;
+const WAVEFORM_MIN_SPAN = 1;
+let waveformInfo = null;
+let waveformLevels = new Map();
+let waveformTimer = null;
+let waveformView = null;
+
+// MSE播放：设置AB循环后改用 MediaSource，按服务器的片段表（时间 -> 字节）分段下载追加；
+// A-B区间的字节一次下载后固定在 SourceBuffer 中不清除，循环时不再访问网络，前后的片段在后台预取
+const MSE_SUPPORTED = 'MediaSource' in window;
+const MSE_AHEAD = 30;
+const MSE_NEIGHBOURS = 2;
+const MSE_BUFFER_BYTES = 96 * 1024 * 1024;
+const MSE_POLL_INTERVAL = 3000;
+let mse = null;
+let mseTimer = null;
+
+// 播放进度：每秒上报位置、速度和AB点（服务器合并后定期写入），重新打开文件时恢复；
+// 恢复之前不上报，免得把刚打开时的0秒写回去
+const RESUME_SAVE_INTERVAL = 1000;
+const RESUME_MIN_POSITION = 5;
+const bookmarkSelect = document.getElementById('bookmarkSelect');
+let resumePending = null;
+let resumeFile = null;
+let lastResumeSave = 0;
+let bookmarks = [];
+
+// 同步播放：主持人把播放状态（服务器时钟 time 时播放到 position）发到房间，跟随者通过长轮询收到后
+// 按估计的时钟偏差算出现在应在的位置；开始播放时先跳到稍后时刻的位置、到点再播放，
+// 之后按偏差微调播放速度，偏差太大才重新跳转
+const CLOCK_SAMPLES = 5;
+const CLOCK_RESYNC_INTERVAL = 60000;
+const SESSION_PUBLISH_DELAY = 30;
+const SESSION_HEARTBEAT = 5000;
+// 跟随者长轮询房间状态，出错后等待这么久（毫秒）再重试
+const SESSION_RETRY_DELAY = 3000;
+const SYNC_PREROLL = 0.3;
+const SYNC_TOLERANCE = 0.04;
+const SYNC_SEEK_THRESHOLD = 0.5;
+const SYNC_MAX_NUDGE = 0.1;
+const sessionStatus = document.getElementById('sessionStatus');
+const sessionCode = document.getElementById('sessionCode');
+let session = null;
+let clockOffset = 0;
+
+// 离线缓存：Service Worker 缓存页面和最近播放的媒体，定期询问用量，已缓存的文件在列表中标记 💾
+const OFFLINE_POLL_INTERVAL = 10000;
+const OFFLINE_LIST_SIZE = 5;
+const offlineSection = document.getElementById('offlineSection');
+const offlineStatus = document.getElementById('offlineStatus');
+const offlineFiles = document.getElementById('offlineFiles');
+let offlineUsage = null;
+
+// 片段循环：A-B区间作为独立小文件整段下载后本地循环
+let currentFile = null;
+let clipMode = false;
+let clipOffset = 0;
+let clipUrl = null;
+
+// 文件列表分页状态
+const FILE_PAGE_SIZE = 100;
+let fileCursor = null;
+let fileTotal = 0;
+let fileLoaded = 0;
+let fileRequest = 0;
+let fileVersion = null;
+
+// 服务器探测到的编码 -> 用来询问浏览器能否播放的MIME类型
+const CODEC_TYPES = {
+    h264: 'video/mp4; codecs="avc1.42E01E"',
+    hevc: 'video/mp4; codecs="hvc1.1.6.L93.B0"',
+    av1: 'video/mp4; codecs="av01.0.05M.08"',
+    vp9: 'video/webm; codecs="vp9"',
+    vp8: 'video/webm; codecs="vp8"',
+    mpeg4: 'video/mp4; codecs="mp4v.20.9"',
+    aac: 'audio/mp4; codecs="mp4a.40.2"',
+    mp3: 'audio/mpeg',
+    opus: 'audio/webm; codecs="opus"',
+    vorbis: 'audio/ogg; codecs="vorbis"',
+    flac: 'audio/flac',
+    alac: 'audio/mp4; codecs="alac"',
+    ac3: 'audio/mp4; codecs="ac-3"',
+    eac3: 'audio/mp4; codecs="ec-3"'
+};
+const codecSupport = {};
+
+// 格式化时间
+function formatTime(seconds) {
+    if (isNaN(seconds)) return '00:00';
+    const mins = Math.floor(seconds / 60);
+    const secs = Math.floor(seconds % 60);
+    return `${mins.toString().padStart(2, '0')}:${secs.toString().padStart(2, '0')}`;
+}
+
+// 分页获取文件列表（reset 为 true 时重新开始）
+async function fetchFiles(reset) {
+    const requestId = ++fileRequest;
+    const params = new URLSearchParams({
+        q: fileSearch.value.trim(),
+        sort: fileSort.value,
+        limit: FILE_PAGE_SIZE
+    });
+    if (!reset && fileCursor) params.set('cursor', fileCursor);
+    const response = await fetch(`/api/files?${params}`);
+    if (!response.ok || requestId !== fileRequest) return;
+    const data = await response.json();
+    if (reset) {
+        fileSelect.length = 1;
+        fileLoaded = 0;
+    }
+    const fragment = document.createDocumentFragment();
+    data.files.forEach(file => fragment.appendChild(fileOption(file)));
+    fileSelect.appendChild(fragment);
+    fileCursor = data.next;
+    fileTotal = data.total;
+    fileLoaded += data.files.length;
+    fileVersion = data.version;
+    updateFileCounts();
+}
+
+function fileOption(file) {
+    const option = new Option(file.name, file.name);
+    option.dataset.size = file.size;
+    option.dataset.mtime = file.mtime;
+    setFileMeta(option, file.meta);
+    return option;
+}
+
+// 按媒体信息更新选项的文字（时长、分辨率）和能否播放
+function setFileMeta(option, meta) {
+    const details = [];
+    if (meta && meta.duration) details.push(formatTime(meta.duration));
+    if (meta && meta.height) details.push(`${meta.width}×${meta.height}`);
+    if (meta && meta.error) details.push('无法读取');
+    option.dataset.label = details.length ? `${option.value}（${details.join(' · ')}）` : option.value;
+    applyOfflineMark(option);
+    option.dataset.playable = filePlayable(option.value, meta) ? '1' : '0';
+    applyPlayableFilter(option);
+}
+
+function codecPlayable(codec) {
+    if (!codec) return true;
+    if (!(codec in codecSupport)) {
+        const type = codec.startsWith('pcm_') ? 'audio/wav' : CODEC_TYPES[codec];
+        codecSupport[codec] = !!type && player.canPlayType(type) !== '';
+    }
+    return codecSupport[codec];
+}
+
+// 还没探测过的文件当作能播放；服务器转封装的格式总能播放
+function filePlayable(name, meta) {
+    if (!meta) return true;
+    if (meta.error) return false;
+    if (TRANSCODE && REMUX_EXTENSIONS.includes(fileExtension(name))) return true;
+    return codecPlayable(meta.vcodec) && codecPlayable(meta.acodec);
+}
+
+function applyPlayableFilter(option) {
+    const hide = playableOnly.checked && option.dataset.playable === '0' && !option.selected;
+    option.hidden = hide;
+    option.disabled = hide;
+}
+
+// 新探测到的媒体信息：就地更新已加载的选项
+function applyMetadata(data) {
+    const options = new Map(Array.from(fileSelect.options).slice(1).map(o => [o.value, o]));
+    data.files.forEach(file => {
+        const option = options.get(file.name);
+        if (option) setFileMeta(option, file.meta);
+    });
+    updateFileCounts();
+}
+
+function updateFileCounts() {
+    const hidden = Array.from(fileSelect.options).filter(o => o.hidden).length;
+    const note = hidden ? `，已隐藏 ${hidden} 个不能播放的` : '';
+    fileSelect.options[0].textContent = `-- 请选择媒体文件（共 ${fileTotal} 个${note}）--`;
+    fileMore.textContent = `加载更多（已显示 ${fileLoaded} / ${fileTotal}）`;
+    fileMore.classList.toggle('active', !!fileCursor);
+}
+
+// 注册 Service Worker（只在 localhost 或 HTTPS 下可用）
+function registerServiceWorker() {
+    if (!('serviceWorker' in navigator)) return;
+    navigator.serviceWorker.register('/sw.js').then(() => {
+        refreshOfflineUsage();
+        setInterval(refreshOfflineUsage, OFFLINE_POLL_INTERVAL);
+    }).catch(err => console.warn('Service Worker 注册失败:', err));
+    navigator.serviceWorker.addEventListener('controllerchange', refreshOfflineUsage);
+    window.addEventListener('online', refreshOfflineUsage);
+    window.addEventListener('offline', refreshOfflineUsage);
+}
+
+// 通过 MessageChannel 向 Service Worker 发消息，没有回应时得到 null
+function askServiceWorker(message) {
+    const worker = navigator.serviceWorker && navigator.serviceWorker.controller;
+    if (!worker) return Promise.resolve(null);
+    return new Promise(resolve => {
+        const channel = new MessageChannel();
+        const timer = setTimeout(() => resolve(null), 5000);
+        channel.port1.onmessage = e => {
+            clearTimeout(timer);
+            resolve(e.data);
+        };
+        worker.postMessage(message, [channel.port2]);
+    });
+}
+
+async function refreshOfflineUsage() {
+    const usage = await askServiceWorker({type: 'usage'});
+    if (usage) showOfflineUsage(usage);
+}
+
+function formatBytes(bytes) {
+    if (bytes >= 1024 ** 3) return `${(bytes / 1024 ** 3).toFixed(1)}GB`;
+    if (bytes >= 1024 ** 2) return `${(bytes / 1024 ** 2).toFixed(1)}MB`;
+    return `${Math.ceil(bytes / 1024)}KB`;
+}
+
+// 显示缓存用量和占用最多的几个文件（原文件缓存了多少），并标记列表中的文件
+function showOfflineUsage(usage) {
+    offlineUsage = usage;
+    offlineSection.classList.add('active');
+    const state = navigator.onLine ? '' : '（当前离线）';
+    offlineStatus.textContent = `${formatBytes(usage.total)} / ${formatBytes(usage.quota)}${state}`;
+    offlineFiles.textContent = '';
+    Object.entries(usage.files)
+        .sort((a, b) => b[1].bytes - a[1].bytes)
+        .slice(0, OFFLINE_LIST_SIZE)
+        .forEach(([name, info]) => {
+            const row = document.createElement('div');
+            const part = info.total ? `，原文件 ${Math.min(100, Math.round(info.media / info.total * 100))}%` : '';
+            row.textContent = `💾 ${name}（${formatBytes(info.bytes)}${part}）`;
+            offlineFiles.appendChild(row);
+        });
+    Array.from(fileSelect.options).slice(1).forEach(applyOfflineMark);
+}
+
+function applyOfflineMark(option) {
+    const cached = offlineUsage && offlineUsage.files[option.value];
+    option.textContent = (cached ? '💾 ' : '') + option.dataset.label;
+}
+
+async function clearOfflineCache() {
+    const usage = await askServiceWorker({type: 'clear'});
+    if (usage) showOfflineUsage(usage);
+}
+
+// 与服务器相同的排序：名称（不区分大小写）、最新在前、最大在前
+function compareFiles(a, b) {
+    const sort = fileSort.value;
+    if (sort === 'mtime' && a.mtime !== b.mtime) return b.mtime - a.mtime;
+    if (sort === 'size' && a.size !== b.size) return b.size - a.size;
+    const la = a.name.toLowerCase(), lb = b.name.toLowerCase();
+    if (la !== lb) return la < lb ? -1 : 1;
+    return a.name < b.name ? -1 : a.name > b.name ? 1 : 0;
+}
+
+function optionFile(option) {
+    return {name: option.value, size: Number(option.dataset.size), mtime: Number(option.dataset.mtime)};
+}
+
+// 列表中文件的版本（大小和修改时间），不在已加载的列表中时返回null
+function listedVersion(name) {
+    const option = Array.from(fileSelect.options).slice(1).find(o => o.value === name);
+    return option ? `${option.dataset.size}-${option.dataset.mtime}` : null;
+}
+
+// 按推送的媒体库变化就地修改文件列表：只插入落在已加载范围内的新文件，
+// 之后的页面由分页游标照常加载
+function applyLibraryChange(change) {
+    const needle = fileSearch.value.trim().toLowerCase();
+    const matches = name => !needle || name.toLowerCase().includes(needle);
+    const options = new Map(Array.from(fileSelect.options).slice(1).map(o => [o.value, o]));
+
+    change.removed.filter(matches).forEach(name => {
+        const option = options.get(name);
+        if (option) {
+            option.remove();
+            options.delete(name);
+            fileLoaded--;
         }
-        .btn-green {
-            background: #4CAF50;
-            color: white;
+        fileTotal--;
+    });
+    const insert = file => {
+        const loaded = Array.from(fileSelect.options).slice(1);
+        const before = loaded.find(o => compareFiles(file, optionFile(o)) < 0);
+        if (!before && fileCursor) return;
+        fileSelect.insertBefore(fileOption(file), before || null);
+        fileLoaded++;
+    };
+    change.updated.filter(file => matches(file.name)).forEach(file => {
+        const option = options.get(file.name);
+        if (!option) return;
+        // 大小或修改时间变了，排序位置可能也变了
+        const selected = option.selected;
+        option.remove();
+        fileLoaded--;
+        insert(file);
+        if (selected) fileSelect.value = file.name;
+    });
+    change.added.filter(file => matches(file.name)).forEach(file => {
+        insert(file);
+        fileTotal++;
+    });
+    fileVersion = change.version;
+    updateFileCounts();
+}
+
+// 订阅媒体库变化（新复制进来的文件几秒内出现，不用刷新页面）
+let libraryEvents = null;
+
+function watchLibrary() {
+    if (!window.EventSource || libraryEvents) return;
+    const events = libraryEvents = new EventSource('/api/events');
+    events.addEventListener('hello', e => {
+        if (fileVersion !== null && JSON.parse(e.data).version !== fileVersion) fetchFiles(true);
+    });
+    events.addEventListener('reset', () => fetchFiles(true));
+    events.addEventListener('library', e => applyLibraryChange(JSON.parse(e.data)));
+    events.addEventListener('metadata', e => applyMetadata(JSON.parse(e.data)));
+}
+
+// 跟随同步播放时不需要媒体库推送（播放哪个文件由主持人决定），不占服务器的事件流名额
+function unwatchLibrary() {
+    if (!libraryEvents) return;
+    libraryEvents.close();
+    libraryEvents = null;
+}
+
+function loadMoreFiles() {
+    if (fileCursor) fetchFiles(false);
+}
+
+// 搜索输入防抖
+let searchTimer = null;
+fileSearch.addEventListener('input', () => {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(() => fetchFiles(true), 250);
+});
+fileSort.addEventListener('change', () => fetchFiles(true));
+playableOnly.addEventListener('change', () => {
+    Array.from(fileSelect.options).slice(1).forEach(applyPlayableFilter);
+    updateFileCounts();
+});
+
+function fileExtension(filename) {
+    const dot = filename.lastIndexOf('.');
+    return dot >= 0 ? filename.slice(dot).toLowerCase() : '';
+}
+
+// 大视频在支持HLS的浏览器上改用HLS分段播放
+function shouldUseHls(filename, size) {
+    if (!HLS_THRESHOLD || !canPlayHls || size <= HLS_THRESHOLD) return false;
+    const ext = fileExtension(filename);
+    return VIDEO_EXTENSIONS.includes(ext) && !REMUX_EXTENSIONS.includes(ext);
+}
+
+// 文件的播放地址（浏览器无法直接播放的容器由服务器转封装为MP4）
+function mediaUrl(filename) {
+    const encodedFile = encodeURIComponent(filename);
+    if (currentRendition && currentRendition.url) return currentRendition.url;
+    if (usingHls) return `/hls/${encodedFile}/index.m3u8`;
+    if (REMUX_EXTENSIONS.includes(fileExtension(filename))) return `/remux/${encodedFile}`;
+    return `/media/${encodedFile}`;
+}
+
+// HLS播放列表是否已经可用；服务器还在后台切分（202）或切分失败时先用普通方式播放
+async function hlsReady(filename) {
+    try {
+        const response = await fetch(`/hls/${encodeURIComponent(filename)}/index.m3u8`);
+        return response.status === 200;
+    } catch (err) {
+        return false;
+    }
+}
+
+// 加载文件
+async function loadFile(filename) {
+    if (!filename) return;
+    saveResume(false);
+    resumeFile = null;
+    resumePending = filename;
+    bookmarks = [];
+    showBookmarks('');
+    exitClipMode(null);
+    clearAB();
+    stopMse();
+    currentFile = filename;
+    const option = fileSelect.selectedOptions[0];
+    usingHls = shouldUseHls(filename, Number(option ? option.dataset.size : 0))
+        && await hlsReady(filename);
+    if (filename !== currentFile) return;
+    renditions = [];
+    currentRendition = null;
+    await fetchRenditions(filename);
+    if (filename !== currentFile) return;
+    currentRendition = pickRendition();
+    updateQualityOptions();
+    player.src = mediaUrl(filename);
+    player.load();
+    fetchThumbnails(filename);
+    fetchWaveform(filename);
+}
+
+// 获取缩略图布局；还没生成时定期再查
+async function fetchThumbnails(filename) {
+    clearTimeout(thumbnailTimer);
+    thumbnails = null;
+    hideThumbnail();
+    if (!TRANSCODE || !VIDEO_EXTENSIONS.includes(fileExtension(filename))) return;
+    let data;
+    try {
+        const response = await fetch(`/api/thumbnails/${encodeURIComponent(filename)}`);
+        if (!response.ok) return;
+        data = await response.json();
+    } catch (err) {
+        return;
+    }
+    if (filename !== currentFile) return;
+    if (!data.ready) {
+        thumbnailTimer = setTimeout(() => fetchThumbnails(filename), THUMB_POLL_INTERVAL);
+        return;
+    }
+    // 先把整张图载入，之后显示预览不再有网络请求
+    const image = new Image();
+    image.onload = () => {
+        if (filename === currentFile) thumbnails = data;
+    };
+    image.src = data.url;
+}
+
+// 在进度条 fraction（0~1）处显示对应时间的缩略图
+function showThumbnail(fraction) {
+    const duration = player.duration;
+    if (!duration) return;
+    fraction = Math.min(Math.max(fraction, 0), 1);
+    const time = (clipMode ? clipOffset : 0) + fraction * duration;
+    const label = thumbPreview.querySelector('.thumb-time');
+    label.textContent = formatTime(time);
+    const image = thumbPreview.querySelector('.thumb-image');
+    if (thumbnails) {
+        const t = thumbnails;
+        const index = Math.min(Math.max(Math.round(time / t.interval), 0), t.count - 1);
+        image.style.width = `${t.tile_width}px`;
+        image.style.height = `${t.tile_height}px`;
+        image.style.backgroundImage = `url("${t.url}")`;
+        image.style.backgroundPosition =
+            `-${(index % t.columns) * t.tile_width}px -${Math.floor(index / t.columns) * t.tile_height}px`;
+        image.style.display = 'block';
+    } else {
+        image.style.display = 'none';
+    }
+    thumbPreview.classList.add('active');
+    const width = thumbPreview.offsetWidth;
+    const x = fraction * progressBar.offsetWidth - width / 2;
+    thumbPreview.style.left = `${Math.min(Math.max(x, 0), progressBar.offsetWidth - width)}px`;
+}
+
+function hideThumbnail() {
+    thumbPreview.classList.remove('active');
+}
+
+// 获取波形各级信息；还没生成时定期再查，本机无法生成（501）时不显示
+async function fetchWaveform(filename) {
+    clearTimeout(waveformTimer);
+    waveformInfo = null;
+    waveformLevels = new Map();
+    waveformView = null;
+    waveformCanvas.classList.remove('active');
+    let data;
+    try {
+        const response = await fetch(`/api/waveform/${encodeURIComponent(filename)}`);
+        if (!response.ok) return;
+        data = await response.json();
+    } catch (err) {
+        return;
+    }
+    if (filename !== currentFile) return;
+    if (!data.ready) {
+        waveformTimer = setTimeout(() => fetchWaveform(filename), WAVEFORM_POLL_INTERVAL);
+        return;
+    }
+    waveformInfo = data;
+    waveformCanvas.classList.add('active');
+    drawWaveform();
+}
+
+// 第 level 级的峰值（min,max 交错）；还没下载时开始下载并返回 null，下载完再重画
+function waveformLevel(level) {
+    const cached = waveformLevels.get(level);
+    if (cached !== undefined) return cached;
+    waveformLevels.set(level, null);
+    const info = waveformInfo;
+    fetch(`${info.url}&level=${level}`)
+        .then(response => response.ok ? response.arrayBuffer() : Promise.reject())
+        .then(buffer => {
+            if (info !== waveformInfo) return;
+            waveformLevels.set(level, info.bits === 8 ? new Int8Array(buffer) : new Int16Array(buffer));
+            drawWaveform();
+        })
+        .catch(() => waveformLevels.delete(level));
+    return null;
+}
+
+// 每个像素至少一对峰值的最粗一级
+function chooseWaveformLevel(seconds, pixels) {
+    let chosen = 0;
+    waveformInfo.levels.forEach((spec, i) => {
+        if (seconds * waveformInfo.sample_rate / spec.samples_per_peak >= pixels) chosen = i;
+    });
+    return chosen;
+}
+
+function waveformRange() {
+    return waveformView ? [waveformView.start, waveformView.end] : [0, waveformInfo.duration];
+}
+
+function drawWaveform() {
+    if (!waveformInfo) return;
+    const ratio = window.devicePixelRatio || 1;
+    const width = Math.round(waveformCanvas.clientWidth * ratio);
+    const height = Math.round(waveformCanvas.clientHeight * ratio);
+    if (!width || !height) return;
+    if (waveformCanvas.width !== width) waveformCanvas.width = width;
+    if (waveformCanvas.height !== height) waveformCanvas.height = height;
+    const ctx = waveformCanvas.getContext('2d');
+    ctx.clearRect(0, 0, width, height);
+
+    const [start, end] = waveformRange();
+    const x = time => (time - start) / (end - start) * width;
+    if (pointA !== null) {
+        const b = pointB !== null ? pointB : mediaTime();
+        ctx.fillStyle = 'rgba(255, 152, 0, 0.25)';
+        ctx.fillRect(x(pointA), 0, Math.max(x(b) - x(pointA), 1), height);
+    }
+
+    // 需要的一级还在下载时，先用已下载的其它级（优先较粗的）
+    const level = chooseWaveformLevel(end - start, width);
+    const order = [level];
+    for (let i = level + 1; i < waveformInfo.levels.length; i++) order.push(i);
+    for (let i = level - 1; i >= 0; i--) order.push(i);
+    waveformLevel(level);
+    const shown = order.find(i => waveformLevels.get(i));
+    if (shown !== undefined) {
+        const peaks = waveformLevels.get(shown);
+        const count = peaks.length / 2;
+        const perSecond = waveformInfo.sample_rate / waveformInfo.levels[shown].samples_per_peak;
+        const scale = (waveformInfo.bits === 8 ? 128 : 32768) / (height / 2);
+        const middle = height / 2;
+        ctx.fillStyle = '#4CAF50';
+        for (let px = 0; px < width; px++) {
+            const from = Math.floor((start + (end - start) * px / width) * perSecond);
+            if (from >= count) break;
+            const to = Math.min(Math.max(Math.floor((start + (end - start) * (px + 1) / width) * perSecond), from + 1), count);
+            let low = peaks[2 * from];
+            let high = peaks[2 * from + 1];
+            for (let i = from + 1; i < to; i++) {
+                low = Math.min(low, peaks[2 * i]);
+                high = Math.max(high, peaks[2 * i + 1]);
+            }
+            ctx.fillRect(px, middle - high / scale, 1, Math.max((high - low) / scale, 1));
         }
-        .btn-green:hover {
-            background: #45a049;
+    }
+
+    ctx.fillStyle = '#f44336';
+    ctx.fillRect(Math.round(x(mediaTime())), 0, Math.max(Math.round(ratio), 1), height);
+}
+
+// 波形上 clientX 处对应的时间
+function waveformTimeAt(clientX) {
+    const rect = waveformCanvas.getBoundingClientRect();
+    const [start, end] = waveformRange();
+    return start + Math.min(Math.max((clientX - rect.left) / rect.width, 0), 1) * (end - start);
+}
+
+// 以 center 为中心缩放可见范围（factor < 1 放大）
+function zoomWaveform(center, factor) {
+    const duration = waveformInfo.duration;
+    const [start, end] = waveformRange();
+    const span = Math.min(Math.max((end - start) * factor, WAVEFORM_MIN_SPAN), duration);
+    if (span >= duration) {
+        waveformView = null;
+    } else {
+        const newStart = Math.min(Math.max(center - (center - start) * span / (end - start), 0), duration - span);
+        waveformView = {start: newStart, end: newStart + span};
+    }
+    drawWaveform();
+}
+
+waveformCanvas.addEventListener('click', e => {
+    const time = waveformTimeAt(e.clientX);
+    if (clipMode) {
+        exitClipMode(time);
+    } else {
+        player.currentTime = time;
+    }
+    drawWaveform();
+});
+
+waveformCanvas.addEventListener('wheel', e => {
+    if (!waveformInfo) return;
+    e.preventDefault();
+    zoomWaveform(waveformTimeAt(e.clientX), e.deltaY < 0 ? 0.5 : 2);
+}, {passive: false});
+
+waveformCanvas.addEventListener('dblclick', () => {
+    waveformView = null;
+    drawWaveform();
+});
+
+window.addEventListener('resize', drawWaveform);
+
+// 下载文件开头一小段测量带宽（kbps，与上次结果平滑，一分钟内不重复测量）
+async function measureThroughput(filename) {
+    if (Date.now() - throughputTime < THROUGHPUT_MAX_AGE) return;
+    const started = performance.now();
+    try {
+        const response = await fetch(`/media/${encodeURIComponent(filename)}`, {
+            headers: {Range: `bytes=0-${THROUGHPUT_PROBE_BYTES - 1}`},
+            cache: 'no-store'
+        });
+        const bytes = (await response.arrayBuffer()).byteLength;
+        const seconds = (performance.now() - started) / 1000;
+        // 太小的文件测不准
+        if (bytes < THROUGHPUT_PROBE_BYTES / 4 || seconds <= 0) return;
+        const kbps = bytes * 8 / 1000 / seconds;
+        throughputKbps = throughputKbps ? (throughputKbps + kbps) / 2 : kbps;
+        throughputTime = Date.now();
+    } catch (err) {}
+}
+
+// 获取文件的档位列表（服务器同时在后台预生成缺少的档位）
+async function fetchRenditions(filename) {
+    clearTimeout(renditionTimer);
+    if (!TRANSCODE) return;
+    await measureThroughput(filename);
+    try {
+        const response = await fetch(`/api/renditions/${encodeURIComponent(filename)}`);
+        if (response.ok && filename === currentFile) {
+            renditions = (await response.json()).renditions;
         }
-        .btn-red {
-            background: #f44336;
-            color: white;
+    } catch (err) {}
+}
+
+// 选择播放的档位：带宽能承受的最高档位（或手动选择的档位）已生成则直接使用，
+// 否则提高它的转码优先级，暂时播放已生成的较低档位（或原文件），稍后再检查
+function pickRendition() {
+    if (!renditions.length) return null;
+    let target = renditions.find(r => r.name === qualitySelect.value);
+    if (!target) {
+        const fitting = renditions.filter(r => r.kbps * BANDWIDTH_HEADROOM <= throughputKbps);
+        target = !throughputKbps ? renditions.find(r => r.name === 'source')
+            : fitting.length ? fitting[fitting.length - 1] : renditions[0];
+    }
+    if (target.ready) return target;
+
+    fetch(`/api/renditions/${encodeURIComponent(currentFile)}`, {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({name: target.name})
+    }).catch(() => {});
+    renditionTimer = setTimeout(refreshRenditions, RENDITION_POLL_INTERVAL);
+    const ready = renditions.filter(r => r.ready && r.kbps <= target.kbps);
+    return ready.length ? ready[ready.length - 1] : renditions.find(r => r.name === 'source');
+}
+
+async function refreshRenditions() {
+    await fetchRenditions(currentFile);
+    switchRendition(pickRendition());
+}
+
+// 切换到另一个档位，从当前位置继续播放
+function switchRendition(rendition) {
+    if (!rendition || (currentRendition && currentRendition.name === rendition.name)) return;
+    currentRendition = rendition;
+    updateQualityOptions();
+    // 片段循环中不打断，退出时自动使用新档位；MSE播放只用于原画
+    if (clipMode || (mse && rendition.name === 'source')) return;
+    stopMse();
+    const resumeAt = player.currentTime;
+    const wasPlaying = !player.paused;
+    player.src = mediaUrl(currentFile);
+    player.addEventListener('loadedmetadata', () => {
+        player.currentTime = resumeAt;
+        if (wasPlaying) player.play();
+    }, {once: true});
+    player.load();
+}
+
+function renditionLabel(rendition) {
+    return rendition.name === 'source' ? '原画' : rendition.name;
+}
+
+// 更新画质选择框（只有原文件一档时隐藏）
+function updateQualityOptions() {
+    const selected = qualitySelect.value;
+    qualitySelect.length = 0;
+    const current = currentRendition ? `（${renditionLabel(currentRendition)}）` : '';
+    qualitySelect.add(new Option(`画质：自动${current}`, 'auto'));
+    renditions.slice().reverse().forEach(r => {
+        const pending = r.ready ? '' : '（生成中）';
+        qualitySelect.add(new Option(`画质：${renditionLabel(r)} ${r.kbps}kbps${pending}`, r.name));
+    });
+    qualitySelect.value = renditions.some(r => r.name === selected) ? selected : 'auto';
+    qualitySelect.classList.toggle('active', renditions.length > 1);
+}
+
+qualitySelect.addEventListener('change', () => {
+    clearTimeout(renditionTimer);
+    switchRendition(pickRendition());
+    updateQualityOptions();
+});
+
+// 让服务器提前生成AB区间附近的HLS片段
+function warmHls() {
+    if (!usingHls || pointA === null || pointB === null) return;
+    lastHlsWarm = Date.now();
+    fetch(`/api/hls/warm/${encodeURIComponent(currentFile)}`, {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({a: pointA, b: pointB})
+    }).catch(() => {});
+}
+
+// 让服务器预读A点所在关键帧附近的数据，循环跳回A点时更快
+function prefetchSeek(time) {
+    if (!currentFile) return;
+    fetch(`/api/seek/${encodeURIComponent(currentFile)}?t=${time.toFixed(3)}`).catch(() => {});
+}
+
+// 当前播放位置（片段循环时换算为原文件时间）
+function mediaTime() {
+    return player.currentTime + (clipMode ? clipOffset : 0);
+}
+
+// 切换片段循环
+async function toggleClipLoop() {
+    if (clipMode) {
+        exitClipMode(mediaTime());
+        return;
+    }
+    if (!currentFile || pointA === null || pointB === null) {
+        alert('请先设置A点和B点！');
+        return;
+    }
+    clipBtn.disabled = true;
+    clipBtn.textContent = '⏳ 生成片段...';
+    try {
+        const params = new URLSearchParams({a: pointA.toFixed(3), b: pointB.toFixed(3)});
+        // 带上文件版本：文件变了之后不会用到浏览器或离线缓存里的旧片段
+        const version = listedVersion(currentFile);
+        if (version) params.set('v', version);
+        const response = await fetch(`/clip/${encodeURIComponent(currentFile)}?${params}`);
+        if (!response.ok) {
+            const data = await response.json().catch(() => ({}));
+            throw new Error(data.error || response.statusText);
         }
-        .btn-red:hover {
-            background: #da190b;
+        const blob = await response.blob();
+        stopMse();
+        clipUrl = URL.createObjectURL(blob);
+        clipOffset = pointA;
+        clipMode = true;
+        player.src = clipUrl;
+        player.loop = true;
+        player.play();
+        clipBtn.textContent = '📦 退出片段循环';
+    } catch (err) {
+        alert('生成片段失败: ' + err.message);
+        clipBtn.textContent = '📦 片段循环';
+    } finally {
+        clipBtn.disabled = false;
+    }
+}
+
+// 设置AB循环后改用MSE播放（浏览器支持、原画、服务器能给出片段表时）；片段表还没生成时稍后再查
+async function enterMse(filename) {
+    clearTimeout(mseTimer);
+    if (!MSE_SUPPORTED || mse || clipMode || pointB === null) return;
+    if (currentRendition && currentRendition.name !== 'source') return;
+    let map;
+    try {
+        const response = await fetch(`/api/fragments/${encodeURIComponent(filename)}`);
+        if (!response.ok) return;
+        map = await response.json();
+    } catch (err) {
+        return;
+    }
+    if (filename !== currentFile || mse || clipMode || pointB === null) return;
+    if (!map.ready) {
+        mseTimer = setTimeout(() => enterMse(filename), MSE_POLL_INTERVAL);
+        return;
+    }
+    if (!MediaSource.isTypeSupported(map.mime)) return;
+    startMse(filename, map, player.currentTime, !player.paused);
+}
+
+function startMse(filename, map, resumeAt, play) {
+    stopMse();
+    const source = new MediaSource();
+    // loaded：已追加的段号 -> 字节数；pinned：AB区间及前后预取的段号，不会被清除
+    const state = {filename, map, source, buffer: null, loaded: new Map(), pinned: [],
+                   fetching: false, ended: false, chain: Promise.resolve()};
+    mse = state;
+    const objectUrl = URL.createObjectURL(source);
+    player.src = objectUrl;
+    source.addEventListener('sourceopen', async () => {
+        URL.revokeObjectURL(objectUrl);
+        if (mse !== state) return;
+        try {
+            state.buffer = source.addSourceBuffer(map.mime);
+            source.duration = map.duration;
+            await mseAppend(state, await fetchRange(map.url, 0, map.init));
+        } catch (err) {
+            mseFailed(state, err);
+            return;
         }
-        .btn-orange {
-            background: #FF9800;
-            color: white;
+        player.currentTime = resumeAt;
+        if (play) player.play();
+        pinMse();
+    }, {once: true});
+}
+
+// 停止MSE播放（之后由调用者设置新的播放地址）
+function stopMse() {
+    clearTimeout(mseTimer);
+    mse = null;
+}
+
+// MSE出错时回到普通播放，从当前位置继续
+function mseFailed(state, err) {
+    if (mse !== state) return;
+    console.warn('MSE播放失败，改用普通播放:', err);
+    const resumeAt = player.currentTime;
+    const wasPlaying = !player.paused;
+    stopMse();
+    player.src = mediaUrl(state.filename);
+    player.addEventListener('loadedmetadata', () => {
+        player.currentTime = resumeAt;
+        if (wasPlaying) player.play();
+    }, {once: true});
+    player.load();
+}
+
+// 播放器已有足够数据继续播放时，标明是预读（服务器限速时让开始播放、跳转的请求优先）
+async function fetchRange(url, offset, size) {
+    const headers = {Range: `bytes=${offset}-${offset + size - 1}`};
+    if (player.readyState >= HTMLMediaElement.HAVE_FUTURE_DATA) headers['X-Prefetch'] = '1';
+    const response = await fetch(url, {headers});
+    if (!response.ok) throw new Error(`HTTP ${response.status}`);
+    return response.arrayBuffer();
+}
+
+// SourceBuffer 同时只能执行一个操作：追加和删除按顺序排队，完成（updateend）后再执行下一个
+function mseOperate(state, op) {
+    const result = state.chain.then(() => new Promise((resolve, reject) => {
+        const buffer = state.buffer;
+        const finish = error => {
+            buffer.removeEventListener('updateend', onEnd);
+            buffer.removeEventListener('error', onError);
+            error ? reject(error) : resolve();
+        };
+        const onEnd = () => finish(null);
+        const onError = () => finish(new Error('SourceBuffer 出错'));
+        buffer.addEventListener('updateend', onEnd);
+        buffer.addEventListener('error', onError);
+        try {
+            op(buffer);
+        } catch (err) {
+            finish(err);
         }
-        .btn-orange:hover {
-            background: #e68900;
+    }));
+    state.chain = result.catch(() => {});
+    return result;
+}
+
+async function mseAppend(state, data) {
+    try {
+        await mseOperate(state, buffer => buffer.appendBuffer(data));
+    } catch (err) {
+        if (err.name !== 'QuotaExceededError') throw err;
+        // 浏览器的缓冲区满了：先清掉离播放位置最远的段再追加一次
+        await evictMse(state, 0);
+        await mseOperate(state, buffer => buffer.appendBuffer(data));
+    }
+}
+
+// 与 [start, end] 相交的段号
+function mseSegmentsBetween(map, start, end) {
+    const indices = [];
+    map.segments.forEach((seg, i) => {
+        if (seg[1] > start && seg[0] <= end) indices.push(i);
+    });
+    return indices;
+}
+
+// 固定AB区间（以及前后各 MSE_NEIGHBOURS 段）并开始下载
+function pinMse() {
+    const state = mse;
+    if (!state) return;
+    state.pinned = [];
+    if (pointA !== null && pointB !== null) {
+        const indices = mseSegmentsBetween(state.map, pointA, pointB);
+        if (indices.length) {
+            const first = Math.max(indices[0] - MSE_NEIGHBOURS, 0);
+            const last = Math.min(indices[indices.length - 1] + MSE_NEIGHBOURS, state.map.segments.length - 1);
+            // AB区间在前，前后的预取段在后
+            state.pinned = indices.concat(
+                Array.from({length: indices[0] - first}, (_, k) => indices[0] - 1 - k),
+                Array.from({length: last - indices[indices.length - 1]}, (_, k) => indices[indices.length - 1] + 1 + k));
         }
-        .btn-gray {
-            background: #607D8B;
-            color: white;
+    }
+    fillMse();
+}
+
+// 段 i 是否还在缓冲区中（浏览器可能自行清除过）
+function mseBuffered(state, i) {
+    const seg = state.map.segments[i];
+    const middle = (seg[0] + seg[1]) / 2;
+    const ranges = state.buffer.buffered;
+    for (let k = 0; k < ranges.length; k++) {
+        if (ranges.start(k) <= middle && middle <= ranges.end(k)) return true;
+    }
+    return false;
+}
+
+// 下一批要下载的段：AB区间（一次下载整段连续字节），再是播放位置之后 MSE_AHEAD 秒，最后是前后预取段
+function mseNextRun(state) {
+    const time = player.currentTime;
+    let aheadEnd = time + MSE_AHEAD;
+    if (isLooping && pointB !== null && time >= pointA && time < pointB) aheadEnd = Math.min(aheadEnd, pointB);
+    const core = state.pinned.filter(i => pointA !== null && state.map.segments[i][1] > pointA
+                                          && state.map.segments[i][0] <= pointB);
+    const ahead = mseSegmentsBetween(state.map, time, aheadEnd);
+    for (const list of [core, ahead, state.pinned]) {
+        const start = list.findIndex(i => !state.loaded.has(i));
+        if (start < 0) continue;
+        const run = [list[start]];
+        for (let k = start + 1; k < list.length && list[k] === run[run.length - 1] + 1
+             && !state.loaded.has(list[k]); k++) {
+            run.push(list[k]);
         }
-        .btn-gray:hover {
-            background: #546E7A;
+        return run;
+    }
+    return null;
+}
+
+// 按需下载并追加片段；播放位置变化、追加完成后都会调用
+async function fillMse() {
+    const state = mse;
+    if (!state || !state.buffer || state.fetching) return;
+    for (const i of state.loaded.keys()) {
+        if (!mseBuffered(state, i)) state.loaded.delete(i);
+    }
+    const run = mseNextRun(state);
+    if (!run) {
+        const last = state.map.segments.length - 1;
+        if (!state.ended && state.loaded.has(last)) {
+            // 最后一段已追加：结束流，播放到结尾才会触发 ended（之后再追加会自动重新打开）；
+            // endOfStream 不触发 updateend，不经过 mseOperate
+            state.ended = true;
+            state.chain = state.chain.then(() => {
+                if (mse === state && state.source.readyState === 'open') state.source.endOfStream();
+            }).catch(() => {});
         }
-        .speed-control {
-            background: #0f3460;
-            border-radius: 10px;
-            padding: 15px;
-            margin-bottom: 15px;
+        return;
+    }
+    const first = state.map.segments[run[0]];
+    const last = state.map.segments[run[run.length - 1]];
+    state.fetching = true;
+    try {
+        const data = await fetchRange(state.map.url, first[2], last[2] + last[3] - first[2]);
+        if (mse !== state) return;
+        state.ended = false;
+        await mseAppend(state, data);
+        run.forEach(i => state.loaded.set(i, state.map.segments[i][3]));
+        await evictMse(state, MSE_BUFFER_BYTES);
+    } catch (err) {
+        mseFailed(state, err);
+        return;
+    } finally {
+        state.fetching = false;
+    }
+    if (mse !== state) return;
+    updateABStatus();
+    fillMse();
+}
+
+// 缓冲超过 limit 字节时，从离播放位置最远的段开始清除（固定的段和播放位置之后的段除外）
+async function evictMse(state, limit) {
+    let total = 0;
+    state.loaded.forEach(size => total += size);
+    if (total <= limit) return;
+    const time = player.currentTime;
+    const keep = new Set(state.pinned.concat(mseSegmentsBetween(state.map, time, time + MSE_AHEAD)));
+    const distance = i => Math.abs((state.map.segments[i][0] + state.map.segments[i][1]) / 2 - time);
+    const candidates = [...state.loaded.keys()].filter(i => !keep.has(i)).sort((x, y) => distance(y) - distance(x));
+    for (const i of candidates) {
+        if (total <= limit) break;
+        const seg = state.map.segments[i];
+        // 与相邻的保留段交界处留一点余量，不误删它们的音频帧
+        const start = keep.has(i - 1) ? seg[0] + 0.5 : seg[0];
+        const end = keep.has(i + 1) ? seg[1] - 0.5 : seg[1];
+        if (end > start) await mseOperate(state, buffer => buffer.remove(start, end));
+        total -= state.loaded.get(i);
+        state.loaded.delete(i);
+    }
+}
+
+player.addEventListener('seeking', fillMse);
+
+// 退出片段循环，恢复原文件并从 resumeAt 秒继续播放（null 表示不恢复，由调用者加载新文件）
+function exitClipMode(resumeAt) {
+    if (!clipMode) return;
+    clipMode = false;
+    player.loop = false;
+    URL.revokeObjectURL(clipUrl);
+    clipUrl = null;
+    clipBtn.textContent = '📦 片段循环';
+    if (resumeAt === null) return;
+    player.src = mediaUrl(currentFile);
+    player.addEventListener('loadedmetadata', () => {
+        player.currentTime = resumeAt;
+        player.play();
+    }, {once: true});
+    player.load();
+}
+
+// 播放控制
+function togglePlay() {
+    if (player.paused) {
+        player.play();
+        playBtn.textContent = '⏸️ 暂停';
+    } else {
+        player.pause();
+        playBtn.textContent = '▶️ 播放';
+    }
+}
+
+// 快进/快退
+function skip(seconds) {
+    player.currentTime += seconds;
+}
+
+// 设置A点
+function setPointA() {
+    const time = mediaTime();
+    exitClipMode(time);
+    pointA = time;
+    prefetchSeek(time);
+    updateABStatus();
+    publishSession();
+    saveResume(false);
+}
+
+// 设置B点
+function setPointB() {
+    if (pointA === null) {
+        alert('请先设置A点！');
+        return;
+    }
+    const time = mediaTime();
+    if (time <= pointA) {
+        alert('B点必须在A点之后！');
+        return;
+    }
+    exitClipMode(time);
+    pointB = time;
+    startABLoop();
+    publishSession();
+    saveResume(false);
+}
+
+// A、B点都已设置：开始循环（B点附近逐帧检查，A-B区间改用MSE固定在内存中）
+function startABLoop() {
+    isLooping = true;
+    updateABStatus();
+    loopIndicator.classList.add('active');
+    warmHls();
+    scheduleLoopCheck();
+    if (mse) {
+        pinMse();
+    } else {
+        enterMse(currentFile);
+    }
+}
+
+// 清除AB点
+function clearAB() {
+    exitClipMode(pointA);
+    pointA = null;
+    pointB = null;
+    isLooping = false;
+    cancelLoopCheck();
+    clearTimeout(mseTimer);
+    if (mse) mse.pinned = [];
+    updateABStatus();
+    loopIndicator.classList.remove('active');
+    publishSession();
+    saveResume(false);
+}
+
+// 更新AB状态显示
+function updateABStatus() {
+    if (pointA === null) {
+        abStatus.textContent = '未设置';
+        abStatus.style.color = '#888';
+    } else if (pointB === null) {
+        abStatus.textContent = `A点: ${formatTime(pointA)} | 请设置B点`;
+        abStatus.style.color = '#FF9800';
+    } else {
+        abStatus.textContent = `循环: ${formatTime(pointA)} - ${formatTime(pointB)}`;
+        if (mse && mse.pinned.length && mse.pinned.every(i => mse.loaded.has(i))) {
+            abStatus.textContent += ' | 已在内存中';
         }
-        .speed-control h3 {
-            font-size: 14px;
-            margin-bottom: 10px;
-            color: #4CAF50;
+        const last = loopStats[loopStats.length - 1];
+        if (last) {
+            const ms = Math.round(last.overshoot * 1000);
+            abStatus.textContent += ` | 第${loopStats.length}次 过冲 ${ms >= 0 ? '+' : ''}${ms}ms`;
         }
-        .speed-buttons {
-            display: flex;
-            gap: 8px;
-            flex-wrap: wrap;
+        abStatus.style.color = '#4CAF50';
+    }
+    drawWaveform();
+}
+
+// 在下一帧检查是否到达B点（暂停、片段循环或没有AB区间时不检查）
+function scheduleLoopCheck() {
+    cancelLoopCheck();
+    if (!isLooping || clipMode || pointB === null || player.paused) return;
+    loopFrameIsVideo = canFrameCallback && player.videoWidth > 0;
+    if (loopFrameIsVideo) {
+        loopFrameHandle = player.requestVideoFrameCallback((now, metadata) => checkLoop(metadata.mediaTime));
+    } else {
+        loopFrameHandle = requestAnimationFrame(() => checkLoop(player.currentTime));
+    }
+}
+
+function cancelLoopCheck() {
+    if (loopFrameHandle === null) return;
+    if (loopFrameIsVideo) {
+        player.cancelVideoFrameCallback(loopFrameHandle);
+    } else {
+        cancelAnimationFrame(loopFrameHandle);
+    }
+    loopFrameHandle = null;
+}
+
+// time：当前显示的帧（或音频）位置
+function checkLoop(time) {
+    loopFrameHandle = null;
+    if (!isLooping || clipMode || pointB === null) return;
+    // 相邻两帧之间前进的媒体时间，已包含播放速度
+    if (lastFrameTime !== null && time > lastFrameTime && time - lastFrameTime < 0.5) {
+        frameStep = frameStep * 0.9 + (time - lastFrameTime) * 0.1;
+    }
+    lastFrameTime = time;
+    // 下一帧就会越过B点，或跳转期间会越过B点：现在就跳（提前量不超过区间的一半）
+    const lead = Math.min(frameStep + seekLatency * player.playbackRate, (pointB - pointA) / 2);
+    if (time + lead >= pointB) {
+        loopToA(time);
+    } else {
+        scheduleLoopCheck();
+    }
+}
+
+function loopToA(time) {
+    loopStats.push({overshoot: time - pointB, rate: player.playbackRate, seek: null});
+    if (loopStats.length > LOOP_STATS_SIZE) loopStats.shift();
+    loopSeekStarted = performance.now();
+    lastFrameTime = null;
+    player.currentTime = pointA;
+    if (Date.now() - lastHlsWarm > HLS_WARM_INTERVAL) warmHls();
+    updateABStatus();
+    scheduleLoopCheck();
+}
+
+// 测量循环跳转的耗时（平滑），下次提前这么多发起跳转
+player.addEventListener('seeked', () => {
+    if (loopSeekStarted === null) return;
+    const latency = (performance.now() - loopSeekStarted) / 1000;
+    loopSeekStarted = null;
+    seekLatency = Math.min(seekLatency * 0.7 + latency * 0.3, MAX_SEEK_LATENCY);
+    const last = loopStats[loopStats.length - 1];
+    if (last) last.seek = latency;
+});
+
+// 跟随同步播放时进度由主持人决定，不保存也不恢复
+function resumeAllowed() {
+    return !(session && !session.token);
+}
+
+// 上报播放进度；页面关闭时用 sendBeacon，不会被中断
+function saveResume(beacon) {
+    if (!resumeFile || resumeFile !== currentFile || !resumeAllowed()) return;
+    lastResumeSave = Date.now();
+    const url = `/api/resume/${encodeURIComponent(resumeFile)}`;
+    const rate = session && session.state ? session.state.rate : player.playbackRate;
+    const body = JSON.stringify({position: mediaTime(), speed: rate, a: pointA, b: pointB});
+    if (beacon && navigator.sendBeacon) {
+        navigator.sendBeacon(url, body);
+        return;
+    }
+    fetch(url, {method: 'POST', headers: {'Content-Type': 'application/json'}, body, keepalive: true})
+        .catch(() => {});
+}
+
+// 打开文件后恢复上次的位置、速度和AB点，并载入书签
+async function restoreResume(filename) {
+    let data;
+    try {
+        const response = await fetch(`/api/resume/${encodeURIComponent(filename)}`);
+        if (!response.ok) throw new Error(response.status);
+        data = await response.json();
+    } catch (err) {
+        data = {progress: null, bookmarks: []};
+    }
+    if (filename !== currentFile) return;
+    bookmarks = data.bookmarks;
+    showBookmarks('');
+    const progress = data.progress;
+    if (progress && resumeAllowed()) {
+        setSpeed(progress.speed);
+        const end = player.duration || Infinity;
+        if (progress.position >= RESUME_MIN_POSITION && progress.position < end - RESUME_MIN_POSITION) {
+            player.currentTime = progress.position;
         }
-        .speed-btn {
-            flex: 1;
-            min-width: 50px;
-            padding: 8px;
-            background: #1a1a2e;
-            border: 1px solid #4CAF50;
-            color: #4CAF50;
-            border-radius: 5px;
+        if (progress.a !== null) {
+            pointA = progress.a;
+            pointB = progress.b;
+            if (pointB !== null) {
+                startABLoop();
+            } else {
+                updateABStatus();
+            }
+            publishSession();
         }
-        .speed-btn.active {
-            background: #4CAF50;
-            color: white;
+    }
+    resumeFile = filename;
+}
+
+// 打开页面时载入最近播放的文件（不自动播放）
+async function restoreRecent() {
+    try {
+        const response = await fetch('/api/resume');
+        const data = await response.json();
+        if (!data.file || currentFile || session) return;
+        const name = data.file.name;
+        if (!Array.from(fileSelect.options).some(o => o.value === name)) {
+            fileSelect.add(fileOption(data.file));
         }
-        .ab-status {
-            background: #0f3460;
-            border-radius: 10px;
-            padding: 15px;
-            text-align: center;
+        fileSelect.value = name;
+        loadFile(name);
+    } catch (err) {}
+}
+
+function showBookmarks(selected) {
+    bookmarkSelect.length = 1;
+    bookmarks.forEach(mark => {
+        const text = `${mark.name}（${formatTime(mark.a)} - ${formatTime(mark.b)}）`;
+        bookmarkSelect.add(new Option(text, mark.name));
+    });
+    bookmarkSelect.options[0].textContent = bookmarks.length ? `-- 书签（${bookmarks.length}）--` : '-- 书签 --';
+    bookmarkSelect.value = selected;
+}
+
+async function bookmarkRequest(method, query, body) {
+    const response = await fetch(`/api/bookmarks/${encodeURIComponent(currentFile)}${query}`, {
+        method,
+        headers: body ? {'Content-Type': 'application/json'} : {},
+        body: body ? JSON.stringify(body) : undefined
+    });
+    const data = await response.json();
+    if (!response.ok) throw new Error(data.error);
+    return data.bookmarks;
+}
+
+// 把当前的A-B区间保存为书签
+async function saveBookmark() {
+    if (!currentFile || pointA === null || pointB === null) {
+        alert('请先设置A点和B点！');
+        return;
+    }
+    const name = prompt('书签名称', `${formatTime(pointA)} - ${formatTime(pointB)}`);
+    if (!name || !name.trim()) return;
+    const filename = currentFile;
+    try {
+        const marks = await bookmarkRequest('POST', '', {name: name.trim(), a: pointA, b: pointB});
+        if (filename !== currentFile) return;
+        bookmarks = marks;
+        showBookmarks(name.trim());
+    } catch (err) {
+        alert(`保存书签失败: ${err.message}`);
+    }
+}
+
+// 选择书签：设置AB点并跳到A点
+function applyBookmark(name) {
+    const mark = bookmarks.find(m => m.name === name);
+    if (!mark) return;
+    exitClipMode(mark.a);
+    pointA = mark.a;
+    pointB = mark.b;
+    player.currentTime = mark.a;
+    startABLoop();
+    publishSession();
+    saveResume(false);
+}
+
+async function deleteBookmark() {
+    const name = bookmarkSelect.value;
+    if (!currentFile || !name) return;
+    const filename = currentFile;
+    try {
+        const marks = await bookmarkRequest('DELETE', `?name=${encodeURIComponent(name)}`);
+        if (filename !== currentFile) return;
+        bookmarks = marks;
+        showBookmarks('');
+    } catch (err) {
+        alert(`删除书签失败: ${err.message}`);
+    }
+}
+
+// 本机时钟（秒），以及按估计的偏差换算的服务器时钟
+function localNow() {
+    return (performance.timeOrigin + performance.now()) / 1000;
+}
+
+function serverNow() {
+    return localNow() + clockOffset;
+}
+
+// 估计与服务器的时钟偏差：取往返最快的一次，假设去程和回程各占一半
+async function estimateClockOffset() {
+    let best = null;
+    for (let i = 0; i < CLOCK_SAMPLES; i++) {
+        try {
+            const sent = localNow();
+            const response = await fetch('/api/time', {cache: 'no-store'});
+            const data = await response.json();
+            const received = localNow();
+            if (!best || received - sent < best.rtt) {
+                best = {rtt: received - sent, offset: data.time - (sent + received) / 2};
+            }
+        } catch (err) {}
+    }
+    if (best) clockOffset = best.offset;
+    return best;
+}
+
+function showSessionStatus(text, color) {
+    sessionStatus.textContent = text;
+    sessionStatus.style.color = color || '#4CAF50';
+}
+
+function setSessionButtons(joined) {
+    document.getElementById('sessionCreate').classList.toggle('active', !joined);
+    document.getElementById('sessionJoin').classList.toggle('active', !joined);
+    document.getElementById('sessionLeave').classList.toggle('active', joined);
+    sessionCode.disabled = joined;
+}
+
+// 创建房间，本机作为主持人
+async function createSession() {
+    leaveSession();
+    let data;
+    try {
+        const response = await fetch('/api/sessions', {method: 'POST'});
+        data = await response.json();
+        if (!response.ok) throw new Error(data.error);
+    } catch (err) {
+        showSessionStatus('创建房间失败', '#f44336');
+        return;
+    }
+    // 地址栏显示可分享的链接；主持人刷新页面后凭本标签页保存的令牌继续主持
+    sessionStorage.setItem(`session-token-${data.room}`, data.token);
+    history.replaceState(null, '', `?room=${data.room}`);
+    await leadSession(data.room, data.token);
+}
+
+async function leadSession(room, token) {
+    session = {room, token, publishTimer: null, heartbeat: null, clockTimer: null,
+               poll: null, state: null, startTimer: null};
+    sessionCode.value = room;
+    setSessionButtons(true);
+    showSessionStatus(`房间 ${room}：主持中`);
+    await estimateClockOffset();
+    if (!session || session.room !== room) return;
+    session.clockTimer = setInterval(estimateClockOffset, CLOCK_RESYNC_INTERVAL);
+    session.heartbeat = setInterval(sendSessionState, SESSION_HEARTBEAT);
+    sendSessionState();
+}
+
+// 加入房间，跟随主持人播放
+async function joinSession(code) {
+    const room = (code || '').trim().toUpperCase();
+    if (!room) return;
+    leaveSession();
+    try {
+        const response = await fetch(`/api/sessions/${encodeURIComponent(room)}`);
+        if (!response.ok) throw new Error((await response.json()).error);
+    } catch (err) {
+        showSessionStatus(`无法加入房间 ${room}`, '#f44336');
+        return;
+    }
+    unwatchLibrary();
+    const follower = Math.random().toString(36).slice(2, 12);
+    session = {room, token: null, publishTimer: null, heartbeat: null, clockTimer: null,
+               poll: null, state: null, startTimer: null, follower, status: ''};
+    const current = session;
+    history.replaceState(null, '', `?room=${room}`);
+    sessionCode.value = room;
+    setSessionButtons(true);
+    showSessionStatus(`房间 ${room}：正在校准时钟...`, '#FF9800');
+    const clock = await estimateClockOffset();
+    if (session !== current) return;
+    session.clockTimer = setInterval(estimateClockOffset, CLOCK_RESYNC_INTERVAL);
+    const rtt = clock ? ` · 往返 ${Math.round(clock.rtt * 1000)}ms` : '';
+    session.status = `房间 ${room}：跟随中${rtt}`;
+    showSessionStatus(session.status);
+    pollSession(current);
+}
+
+// 跟随者：长轮询主持人的状态。服务器的跟随者名额已满（503）时退出房间并说明原因
+async function pollSession(current) {
+    const room = encodeURIComponent(current.room);
+    let since = null;
+    while (session === current) {
+        const params = new URLSearchParams({follower: current.follower});
+        if (since !== null) params.set('since', since);
+        current.poll = new AbortController();
+        let data = null;
+        let failed = false;
+        try {
+            const response = await fetch(`/api/sessions/${room}/poll?${params}`,
+                                         {cache: 'no-store', signal: current.poll.signal});
+            data = await response.json();
+            if (response.status === 503) {
+                leaveSession();
+                showSessionStatus(`无法跟随房间 ${current.room}：${data.error}`, '#f44336');
+                return;
+            }
+            if (!response.ok) throw new Error(data.error);
+        } catch (err) {
+            if (session !== current) return;
+            failed = true;
+            showSessionStatus(`房间 ${current.room}：${err.message || '连接中断'}，稍后重试`, '#f44336');
         }
-        .ab-status h3 {
-            font-size: 14px;
-            margin-bottom: 10px;
+        if (session !== current) return;
+        if (failed) {
+            await new Promise(resolve => setTimeout(resolve, SESSION_RETRY_DELAY));
+            continue;
         }
-        .ab-status .status-text {
-            font-size: 16px;
-            font-weight: bold;
-            color: #4CAF50;
+        since = data.id;
+        if (data.state) applySessionState(data.state);
+        showSessionStatus(current.status);
+    }
+}
+
+function leaveSession() {
+    if (!session) return;
+    clearTimeout(session.publishTimer);
+    clearTimeout(session.startTimer);
+    clearInterval(session.heartbeat);
+    clearInterval(session.clockTimer);
+    if (session.poll) session.poll.abort();
+    if (!session.token) watchLibrary();
+    if (!session.token && session.state) player.playbackRate = session.state.rate;
+    sessionStorage.removeItem(`session-token-${session.room}`);
+    history.replaceState(null, '', location.pathname);
+    session = null;
+    setSessionButtons(false);
+    showSessionStatus('未加入', '#888');
+}
+
+// 主持人：播放状态变化后稍等合并，再发到房间
+function publishSession() {
+    if (!session || !session.token) return;
+    clearTimeout(session.publishTimer);
+    session.publishTimer = setTimeout(sendSessionState, SESSION_PUBLISH_DELAY);
+}
+
+async function sendSessionState() {
+    if (!session || !session.token) return;
+    const {room, token} = session;
+    // 缓冲中（或跳转中）算作暂停，恢复播放时再发一次
+    const playing = !player.paused && !player.seeking && player.readyState >= HTMLMediaElement.HAVE_FUTURE_DATA;
+    const state = {file: currentFile, playing, position: mediaTime(), time: serverNow(),
+                   rate: player.playbackRate, a: pointA, b: pointB};
+    try {
+        const response = await fetch(`/api/sessions/${room}/state`, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json', 'X-Session-Token': token},
+            body: JSON.stringify(state)
+        });
+        const data = await response.json();
+        if (!session || session.room !== room) return;
+        if (response.ok) {
+            showSessionStatus(`房间 ${room}：主持中 · ${data.followers} 人跟随`);
+        } else {
+            showSessionStatus(`房间 ${room}：${data.error}`, '#f44336');
         }
-        .file-section {
-            background: #16213e;
-            border-radius: 10px;
-            padding: 15px;
-            margin-bottom: 15px;
+    } catch (err) {}
+}
+
+// 状态 state 下，服务器时刻 at 应播放到的位置（AB循环时折回A点之后）
+function expectedPosition(state, at) {
+    let position = state.position + (state.playing ? (at - state.time) * state.rate : 0);
+    if (state.a !== null && state.b !== null && position >= state.b) {
+        position = state.a + (position - state.a) % (state.b - state.a);
+    }
+    return player.duration ? Math.min(position, player.duration) : position;
+}
+
+// 跟随者：与应在位置的偏差（秒，正数为落后）；AB循环时按区间长度折算，跨过B点不算偏差
+function syncDrift(state) {
+    let drift = expectedPosition(state, serverNow()) - mediaTime();
+    if (state.a !== null && state.b !== null) {
+        const span = state.b - state.a;
+        drift -= Math.round(drift / span) * span;
+    }
+    return drift;
+}
+
+// 跟随者：应用主持人的状态
+async function applySessionState(state) {
+    if (!session || session.token) return;
+    session.state = state;
+    if (state.file && state.file !== currentFile) {
+        fileSelect.value = state.file;
+        const loaded = new Promise(resolve => player.addEventListener('loadedmetadata', resolve, {once: true}));
+        await loadFile(state.file);
+        await loaded;
+        if (!session || session.state !== state) return;
+    }
+    if (clipMode) {
+        exitClipMode(null);
+        player.src = mediaUrl(currentFile);
+        player.load();
+    }
+    if (state.a !== pointA || state.b !== pointB) {
+        if (state.a === null) {
+            clearAB();
+        } else {
+            pointA = state.a;
+            pointB = state.b;
+            if (pointB !== null) {
+                startABLoop();
+            } else {
+                updateABStatus();
+            }
         }
-        .file-section h3 {
-            font-size: 14px;
-            margin-bottom: 10px;
-            color: #4CAF50;
+    }
+    setSpeed(state.rate);
+    // 已经在跟着播放且偏差不大时只调速度，不打断播放
+    if (state.playing && !player.paused && session.startTimer === null &&
+        Math.abs(syncDrift(state)) <= SYNC_SEEK_THRESHOLD) {
+        return;
+    }
+    syncPlayback();
+}
+
+// 跟随者：暂停时停在主持人的位置；播放时跳到稍后时刻应在的位置，到点再开始播放
+function syncPlayback() {
+    clearTimeout(session.startTimer);
+    session.startTimer = null;
+    const state = session.state;
+    if (!state.playing) {
+        player.pause();
+        player.currentTime = expectedPosition(state, serverNow());
+        return;
+    }
+    const startAt = serverNow() + SYNC_PREROLL + seekLatency;
+    player.pause();
+    player.currentTime = expectedPosition(state, startAt);
+    session.startTimer = setTimeout(() => {
+        session.startTimer = null;
+        player.play();
+    }, Math.max(startAt - serverNow(), 0) * 1000);
+}
+
+// 跟随者：播放中按偏差微调速度，偏差太大时重新跳转
+function followSession() {
+    if (!session || session.token || !session.state || session.startTimer !== null) return;
+    const state = session.state;
+    if (!state.playing || player.paused || player.seeking) return;
+    const drift = syncDrift(state);
+    if (Math.abs(drift) > SYNC_SEEK_THRESHOLD) {
+        syncPlayback();
+    } else if (Math.abs(drift) > SYNC_TOLERANCE) {
+        player.playbackRate = state.rate * (1 + Math.max(-SYNC_MAX_NUDGE, Math.min(drift, SYNC_MAX_NUDGE)));
+    } else if (player.playbackRate !== state.rate) {
+        player.playbackRate = state.rate;
+    }
+}
+
+// 设置播放速度
+function setSpeed(speed) {
+    player.playbackRate = speed;
+    document.querySelectorAll('.speed-btn').forEach(btn => {
+        btn.classList.remove('active');
+        if (btn.textContent === speed + 'x') {
+            btn.classList.add('active');
         }
-        select {
-            width: 100%;
-            padding: 10px;
-            background: #0f3460;
-            border: 1px solid #4CAF50;
-            color: white;
-            border-radius: 5px;
-            font-size: 14px;
+    });
+}
+
+// 监听播放进度
+player.addEventListener('timeupdate', () => {
+    followSession();
+    if (Date.now() - lastResumeSave > RESUME_SAVE_INTERVAL) saveResume(false);
+    // 更新进度条
+    const progress = (player.currentTime / player.duration) * 100;
+    if (!scrubbing) progressBar.value = progress || 0;
+    currentTimeEl.textContent = formatTime(mediaTime());
+    durationEl.textContent = formatTime(clipMode ? pointB : player.duration);
+
+    // AB循环由 scheduleLoopCheck 每帧检查；这里只在后台标签页（不执行帧回调）时兜底，
+    // 片段循环时由 player.loop 完成
+    if (!clipMode && isLooping && pointB !== null && player.currentTime >= pointB) {
+        loopToA(player.currentTime);
+    }
+    fillMse();
+
+    // 放大时可见范围跟随播放位置
+    if (waveformView) {
+        const time = mediaTime();
+        const span = waveformView.end - waveformView.start;
+        if (time < waveformView.start || time > waveformView.end) {
+            const start = Math.min(Math.max(time - span * 0.1, 0), waveformInfo.duration - span);
+            waveformView = {start, end: start + span};
         }
-        .help-text {
-            background: #16213e;
-            border-radius: 10px;
-            padding: 15px;
-            font-size: 12px;
-            color: #888;
-            line-height: 1.6;
+    }
+    drawWaveform();
+});
+
+// 进度条拖动：有缩略图时拖动中只显示预览，松开后跳转一次；没有时边拖边跳转
+function seekToProgress() {
+    player.currentTime = (progressBar.value / 100) * player.duration;
+}
+
+progressBar.addEventListener('input', () => {
+    if (!thumbnails) {
+        seekToProgress();
+        return;
+    }
+    scrubbing = true;
+    showThumbnail(progressBar.value / 100);
+});
+
+progressBar.addEventListener('change', () => {
+    if (scrubbing) seekToProgress();
+    scrubbing = false;
+    hideThumbnail();
+});
+
+// 鼠标悬停在进度条上时预览该位置
+progressBar.addEventListener('pointermove', e => {
+    if (scrubbing || e.pointerType === 'touch' || !thumbnails) return;
+    const rect = progressBar.getBoundingClientRect();
+    showThumbnail((e.clientX - rect.left) / rect.width);
+});
+
+progressBar.addEventListener('pointerleave', () => {
+    if (!scrubbing) hideThumbnail();
+});
+
+// 播放状态监听
+player.addEventListener('play', () => {
+    playBtn.textContent = '⏸️ 暂停';
+    scheduleLoopCheck();
+});
+
+player.addEventListener('pause', () => {
+    playBtn.textContent = '▶️ 播放';
+    cancelLoopCheck();
+});
+
+// 切换文件或画质档位后画面尺寸和帧间隔可能变化，重新开始逐帧检查
+player.addEventListener('loadeddata', () => {
+    lastFrameTime = null;
+    scheduleLoopCheck();
+});
+
+player.addEventListener('ended', () => {
+    playBtn.textContent = '▶️ 播放';
+});
+
+// 主持人：播放、暂停、缓冲、跳转（AB循环自己的跳转除外）和速度变化都同步到房间
+let loopSeeking = false;
+player.addEventListener('seeking', () => {
+    loopSeeking = loopSeekStarted !== null;
+});
+player.addEventListener('seeked', () => {
+    if (!loopSeeking) publishSession();
+});
+['play', 'pause', 'playing', 'waiting', 'ratechange', 'loadeddata'].forEach(name => {
+    player.addEventListener(name, publishSession);
+});
+
+// 暂停和改速度时立即上报进度，关闭页面前再上报一次
+player.addEventListener('pause', () => saveResume(false));
+player.addEventListener('ratechange', () => saveResume(false));
+window.addEventListener('pagehide', () => saveResume(true));
+
+// 每次打开文件后只恢复一次进度（切换画质档位、MSE等也会重新载入）
+player.addEventListener('loadedmetadata', () => {
+    if (resumePending !== currentFile) return;
+    resumePending = null;
+    restoreResume(currentFile);
+});
+
+// 键盘快捷键
+document.addEventListener('keydown', (e) => {
+    if (e.target === fileSearch || e.target === sessionCode) return;
+    if (e.code === 'Space') {
+        e.preventDefault();
+        togglePlay();
+    } else if (e.code === 'ArrowLeft') {
+        skip(-5);
+    } else if (e.code === 'ArrowRight') {
+        skip(5);
+    } else if (e.code === 'KeyA') {
+        setPointA();
+    } else if (e.code === 'KeyB') {
+        setPointB();
+    }
+});
+
+const firstPage = fetchFiles(true);
+registerServiceWorker();
+sessionCode.addEventListener('keydown', e => {
+    if (e.key === 'Enter') joinSession(sessionCode.value);
+});
+const sessionRoom = new URLSearchParams(location.search).get('room');
+const sessionToken = sessionRoom && sessionStorage.getItem(`session-token-${sessionRoom}`);
+if (sessionRoom && !sessionToken) {
+    // 跟随者不打开媒体库推送；加入失败时再打开
+    joinSession(sessionRoom).then(() => {
+        if (!session) watchLibrary();
+    });
+} else {
+    watchLibrary();
+    if (sessionRoom) {
+        leadSession(sessionRoom, sessionToken);
+    } else {
+        firstPage.then(restoreRecent);
+    }
+}
+'''
+
+# Service Worker（/sw.js）：离线缓存页面和最近播放的媒体，配置（外壳缓存名、预缓存的URL、容量）在发送时加在开头。
+# Cache API 不能保存206响应，媒体按固定大小的块保存为完整响应，Range 请求由缓存的块拼出206
+SERVICE_WORKER_JS = r'''
+const MEDIA_CACHE = 'player-media-v1';
+const INDEX_KEY = '/__offline-index__';
+const BLOCK_SIZE = 1024 * 1024;
+const MAX_RESPONSE_BLOCKS = 4;
+const EVICT_TO = 0.9;
+const INDEX_SAVE_DELAY = 2000;
+
+// 按块缓存、支持Range的路径；整个缓存（缓存优先）的路径；网络优先、离线时用缓存的接口
+const RANGE_PREFIXES = ['/media/', '/fragments/', '/rendition/'];
+const WHOLE_PREFIXES = ['/clip/', '/thumbnails/', '/waveform/'];
+const FRESH_PREFIXES = ['/api/files', '/api/thumbnails/', '/api/waveform/', '/api/fragments/',
+                        '/api/renditions/'];
+const FILE_PREFIXES = [...RANGE_PREFIXES, ...WHOLE_PREFIXES, '/hls/', ...FRESH_PREFIXES.slice(1)];
+
+// 媒体缓存的索引 {缓存URL: {size, used, file, url, etag, total}}，按 used 淘汰最久没用的
+let indexPromise = null;
+let savePending = null;
+
+self.addEventListener('install', event => {
+    event.waitUntil(caches.open(SHELL_CACHE)
+        .then(cache => cache.addAll(SHELL_URLS))
+        .then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil((async () => {
+        const names = await caches.keys();
+        await Promise.all(names.filter(name => name.startsWith('player-shell-') && name !== SHELL_CACHE)
+            .map(name => caches.delete(name)));
+        await self.clients.claim();
+    })());
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    // 测速等不要缓存的请求直接访问网络
+    if (request.method !== 'GET' || request.cache === 'no-store') return;
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin) return;
+    const path = url.pathname;
+    const startsWith = prefixes => prefixes.some(prefix => path.startsWith(prefix));
+
+    let handled = null;
+    if (request.mode === 'navigate' && path === '/') {
+        handled = networkFirst(request, SHELL_CACHE, false);
+    } else if (path.startsWith('/assets/')) {
+        handled = caches.match(request, {cacheName: SHELL_CACHE}).then(cached => cached || fetch(request));
+    } else if (startsWith(RANGE_PREFIXES)) {
+        if (request.headers.has('Range')) handled = rangeResponse(request);
+    } else if (path.startsWith('/clip/') && !url.searchParams.has('v')) {
+        // 没有版本的片段地址，文件变了之后内容也会变：网络优先
+        handled = networkFirst(request, MEDIA_CACHE, true);
+    } else if (startsWith(WHOLE_PREFIXES) || (path.startsWith('/hls/') && path.endsWith('.ts'))) {
+        handled = cacheFirst(request);
+    } else if (startsWith(FRESH_PREFIXES) || (path.startsWith('/hls/') && path.endsWith('.m3u8'))) {
+        handled = networkFirst(request, MEDIA_CACHE, true);
+    }
+    if (!handled) return;
+    event.respondWith(handled);
+    event.waitUntil(handled.catch(() => null).then(() => savePending));
+});
+
+self.addEventListener('message', event => {
+    const port = event.ports[0];
+    if (!port) return;
+    const message = event.data || {};
+    event.waitUntil((async () => {
+        if (message.type === 'clear') await clearMedia();
+        port.postMessage(await usage());
+    })());
+});
+
+// 媒体名：/media/<文件>、/hls/<文件>/3.ts 等路径中的文件部分
+function fileOf(url) {
+    const path = new URL(url).pathname;
+    const prefix = FILE_PREFIXES.find(prefix => path.startsWith(prefix));
+    if (!prefix) return null;
+    let rest = path.slice(prefix.length);
+    if (prefix === '/hls/') rest = rest.replace(/\/(index\.m3u8|\d+\.ts)$/, '');
+    try {
+        return decodeURIComponent(rest);
+    } catch (err) {
+        return null;
+    }
+}
+
+// 载入索引，顺带丢掉索引和缓存对不上的项（Service Worker 可能在保存索引前被停止）
+function loadIndex() {
+    if (!indexPromise) {
+        indexPromise = (async () => {
+            const cache = await caches.open(MEDIA_CACHE);
+            let entries = {};
+            const saved = await cache.match(INDEX_KEY);
+            if (saved) {
+                try {
+                    entries = await saved.json();
+                } catch (err) {}
+            }
+            const present = new Set();
+            for (const request of await cache.keys()) {
+                if (new URL(request.url).pathname === INDEX_KEY) continue;
+                present.add(request.url);
+                if (!(request.url in entries)) await cache.delete(request);
+            }
+            Object.keys(entries).forEach(key => {
+                if (!present.has(key)) delete entries[key];
+            });
+            return entries;
+        })();
+    }
+    return indexPromise;
+}
+
+// 延迟合并保存索引，返回保存完成的 Promise
+function saveIndex() {
+    if (!savePending) {
+        savePending = new Promise(resolve => setTimeout(resolve, INDEX_SAVE_DELAY)).then(async () => {
+            savePending = null;
+            const entries = await loadIndex();
+            const cache = await caches.open(MEDIA_CACHE);
+            await cache.put(INDEX_KEY, new Response(JSON.stringify(entries),
+                                                    {headers: {'Content-Type': 'application/json'}}));
+        }).catch(() => { savePending = null; });
+    }
+    return savePending;
+}
+
+async function touch(key) {
+    const entries = await loadIndex();
+    if (entries[key]) {
+        entries[key].used = Date.now();
+        saveIndex();
+    }
+}
+
+function keepHeaders(response) {
+    const headers = {};
+    ['Content-Type', 'ETag', 'Last-Modified'].forEach(name => {
+        const value = response.headers.get(name);
+        if (value) headers[name] = value;
+    });
+    return headers;
+}
+
+// 保存一项并计入索引，超出容量时淘汰最久没用的项
+async function store(key, blob, headers, info) {
+    const entries = await loadIndex();
+    const cache = await caches.open(MEDIA_CACHE);
+    try {
+        await cache.put(key, new Response(blob, {headers}));
+    } catch (err) {
+        // 浏览器的存储配额不够：先腾出空间，这一项不缓存
+        await evict(QUOTA * EVICT_TO - blob.size);
+        return;
+    }
+    entries[key] = Object.assign({size: blob.size, used: Date.now()}, info);
+    saveIndex();
+    await evict(QUOTA);
+}
+
+async function evict(limit) {
+    const entries = await loadIndex();
+    let total = Object.values(entries).reduce((sum, entry) => sum + entry.size, 0);
+    if (total <= limit) return;
+    const target = Math.min(limit, QUOTA * EVICT_TO);
+    const cache = await caches.open(MEDIA_CACHE);
+    const oldest = Object.keys(entries).sort((a, b) => entries[a].used - entries[b].used);
+    for (const key of oldest) {
+        if (total <= target) break;
+        if (!entries[key]) continue;
+        total -= entries[key].size;
+        delete entries[key];
+        await cache.delete(key);
+    }
+    saveIndex();
+}
+
+// 文件内容变了（ETag 不同）：丢掉这个文件的所有缓存
+async function purgeFile(file) {
+    const entries = await loadIndex();
+    const cache = await caches.open(MEDIA_CACHE);
+    for (const key of Object.keys(entries)) {
+        if (entries[key].file !== file) continue;
+        delete entries[key];
+        await cache.delete(key);
+    }
+    saveIndex();
+}
+
+async function clearMedia() {
+    await caches.delete(MEDIA_CACHE);
+    indexPromise = Promise.resolve({});
+    saveIndex();
+}
+
+async function usage() {
+    const entries = await loadIndex();
+    const files = {};
+    let total = 0;
+    Object.values(entries).forEach(entry => {
+        total += entry.size;
+        if (!entry.file) return;
+        const info = files[entry.file] || (files[entry.file] = {bytes: 0, media: 0, total: 0});
+        info.bytes += entry.size;
+        if (entry.url && new URL(entry.url).pathname.startsWith('/media/')) {
+            info.media += entry.size;
+            info.total = entry.total;
         }
-        .help-text h3 {
-            color: #4CAF50;
-            margin-bottom: 10px;
+    });
+    return {total, quota: QUOTA, files};
+}
+
+// 整个缓存：AB片段、缩略图、波形、HLS片段（URL中带版本，内容不会变；没有版本的片段走网络优先）
+async function cacheFirst(request) {
+    const cache = await caches.open(MEDIA_CACHE);
+    const cached = await cache.match(request.url);
+    if (cached) {
+        await touch(request.url);
+        return cached;
+    }
+    const response = await fetch(request);
+    if (response.status !== 200) return response;
+    const blob = await response.blob();
+    const headers = keepHeaders(response);
+    await store(request.url, blob, headers, {file: fileOf(request.url), url: request.url});
+    return new Response(blob, {headers});
+}
+
+// 网络优先：在线时总是最新的，离线时用上次的结果
+async function networkFirst(request, cacheName, counted) {
+    const key = counted ? request.url : '/';
+    try {
+        const response = await fetch(request);
+        if (response.status === 200) {
+            const blob = await response.clone().blob();
+            if (counted) {
+                await store(key, blob, keepHeaders(response), {file: fileOf(request.url), url: request.url});
+            } else {
+                const cache = await caches.open(cacheName);
+                await cache.put(key, new Response(blob, {headers: keepHeaders(response)}));
+            }
         }
-        .loop-indicator {
-            position: absolute;
-            top: 10px;
-            right: 10px;
-            background: rgba(76, 175, 80, 0.9);
-            color: white;
-            padding: 5px 10px;
-            border-radius: 5px;
-            font-size: 12px;
-            font-weight: bold;
-            display: none;
+        return response;
+    } catch (err) {
+        const cached = await caches.match(key, {cacheName});
+        if (!cached) {
+            return new Response(JSON.stringify({error: '离线，且没有缓存'}),
+                                {status: 503, headers: {'Content-Type': 'application/json'}});
         }
-        .loop-indicator.active {
-            display: block;
+        if (counted) await touch(key);
+        return cached;
+    }
+}
+
+function blockKey(url, n) {
+    return `${url}${url.includes('?') ? '&' : '?'}__block=${n}`;
+}
+
+// Range 请求：先用缓存的块，缺的块一次从网络取回并缓存；每次最多返回 MAX_RESPONSE_BLOCKS 块，
+// 浏览器会接着请求后面的部分。离线时只要开头的块在缓存里就能播放
+async function rangeResponse(request, retried) {
+    const url = request.url;
+    const match = /^bytes=(\d+)-(\d*)$/.exec(request.headers.get('Range').trim());
+    if (!match) return fetch(request);
+    const start = Number(match[1]);
+    const first = Math.floor(start / BLOCK_SIZE);
+    let last = first + MAX_RESPONSE_BLOCKS - 1;
+    if (match[2]) last = Math.min(last, Math.floor(Number(match[2]) / BLOCK_SIZE));
+
+    const entries = await loadIndex();
+    const cache = await caches.open(MEDIA_CACHE);
+    const blocks = [];
+    let meta = null;
+    let type = null;
+    for (let n = first; n <= last; n++) {
+        const key = blockKey(url, n);
+        const cached = entries[key] && await cache.match(key);
+        if (!cached) break;
+        meta = entries[key];
+        type = cached.headers.get('Content-Type');
+        blocks.push(await cached.arrayBuffer());
+        entries[key].used = Date.now();
+        if (n === Math.ceil(meta.total / BLOCK_SIZE) - 1) last = n;
+    }
+    if (blocks.length) saveIndex();
+    if (meta && start >= meta.total) {
+        return new Response(null, {status: 416, headers: {'Content-Range': `bytes */${meta.total}`}});
+    }
+
+    if (blocks.length <= last - first) {
+        const from = (first + blocks.length) * BLOCK_SIZE;
+        let response;
+        const headers = {Range: `bytes=${from}-${(last + 1) * BLOCK_SIZE - 1}`};
+        // 页面标明的预读请求，取块时也标明
+        if (request.headers.get('X-Prefetch')) headers['X-Prefetch'] = request.headers.get('X-Prefetch');
+        try {
+            response = await fetch(url, {headers});
+        } catch (err) {
+            if (!blocks.length) throw err;
+            response = null;
         }
-        @media (max-width: 480px) {
-            button {
-                font-size: 12px;
-                padding: 10px 5px;
+        if (response && response.status !== 206) {
+            if (!blocks.length) return response;
+        } else if (response) {
+            const range = /bytes (\d+)-(\d+)\/(\d+)/.exec(response.headers.get('Content-Range') || '');
+            const etag = response.headers.get('ETag');
+            if (meta && meta.etag !== etag && !retried) {
+                await purgeFile(meta.file);
+                return rangeResponse(request, true);
             }
-            .speed-btn {
-                font-size: 12px;
+            if (range && Number(range[1]) === from) {
+                const total = Number(range[3]);
+                const data = await response.arrayBuffer();
+                type = response.headers.get('Content-Type');
+                meta = {file: fileOf(url), url, etag, total};
+                // 只缓存完整的块（文件末尾的最后一块除外）
+                for (let offset = 0; offset < data.byteLength; offset += BLOCK_SIZE) {
+                    const block = data.slice(offset, offset + BLOCK_SIZE);
+                    if (block.byteLength < BLOCK_SIZE && from + offset + block.byteLength < total) break;
+                    blocks.push(block);
+                    await store(blockKey(url, first + blocks.length - 1), new Blob([block]),
+                                {'Content-Type': type}, meta);
+                }
             }
         }
-    </style>
+    }
+    if (!meta || !blocks.length) return fetch(request);
+
+    const skip = start - first * BLOCK_SIZE;
+    const available = blocks.reduce((sum, block) => sum + block.byteLength, 0);
+    let end = first * BLOCK_SIZE + available - 1;
+    if (match[2]) end = Math.min(end, Number(match[2]));
+    if (start > end) return fetch(request);
+    const body = new Blob(blocks).slice(skip, skip + end - start + 1);
+    const headers = {
+        'Content-Range': `bytes ${start}-${end}/${meta.total}`,
+        'Content-Length': String(body.size),
+        'Accept-Ranges': 'bytes',
+    };
+    if (type) headers['Content-Type'] = type;
+    if (meta.etag) headers['ETag'] = meta.etag;
+    return new Response(body, {status: 206, headers});
+}
+'''
+
+HTML_TEMPLATE = '''
+<!DOCTYPE html>
+<html lang="zh-CN">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no">
+    <title>全能播放器 - Web版</title>
+    <link rel="stylesheet" href="{{ css_url }}">
 </head>
-<body>
+<body data-hls-threshold="{{ hls_threshold }}" data-video-extensions="{{ video_extensions }}"
+      data-remux-extensions="{{ remux_extensions }}" data-transcode="{{ transcode }}">
     <div class="header">
         <h1>🎬 全能播放器</h1>
         <p>支持AB循环 | 慢进/快进</p>
@@ -258,6 +2728,11 @@ HTML_TEMPLATE = '''
                 <span id="currentTime">00:00</span>
                 <span id="duration">00:00</span>
             </div>
+            <div class="thumb-preview" id="thumbPreview">
+                <div class="thumb-image"></div>
+                <span class="thumb-time"></span>
+            </div>
+            <canvas class="waveform" id="waveform"></canvas>
             <input type="range" id="progressBar" min="0" max="100" value="0" step="0.1">
         </div>
 
@@ -267,6 +2742,10 @@ HTML_TEMPLATE = '''
             <button class="btn-gray" onclick="clearAB()">清除</button>
         </div>
 
+        <div class="btn-row">
+            <button class="btn-gray" onclick="toggleClipLoop()" id="clipBtn">📦 片段循环</button>
+        </div>
+
         <div class="btn-row">
             <button class="btn-orange" onclick="skip(-5)">⏪ 5秒</button>
             <button class="btn-green" onclick="togglePlay()" id="playBtn">▶️ 播放</button>
@@ -286,17 +2765,54 @@ HTML_TEMPLATE = '''
 
     <div class="file-section">
         <h3>📁 选择文件</h3>
+        <div class="file-filter">
+            <input type="search" id="fileSearch" placeholder="搜索文件名...">
+            <select id="fileSort">
+                <option value="name">按名称</option>
+                <option value="mtime">最新</option>
+                <option value="size">最大</option>
+            </select>
+        </div>
+        <label class="playable-filter">
+            <input type="checkbox" id="playableOnly"> 只显示能播放的文件
+        </label>
         <select id="fileSelect" onchange="loadFile(this.value)">
             <option value="">-- 请选择媒体文件 --</option>
-            {% for file in files %}
-            <option value="{{ file }}">{{ file }}</option>
-            {% endfor %}
+        </select>
+        <button class="btn-gray file-more" id="fileMore" onclick="loadMoreFiles()">加载更多</button>
+        <select class="quality-select" id="qualitySelect">
+            <option value="auto">画质：自动</option>
         </select>
     </div>
 
     <div class="ab-status">
         <h3>🔁 AB循环状态</h3>
         <div class="status-text" id="abStatus">未设置</div>
+        <div class="btn-row bookmark-row">
+            <select id="bookmarkSelect" onchange="applyBookmark(this.value)">
+                <option value="">-- 书签 --</option>
+            </select>
+            <button class="btn-gray" onclick="saveBookmark()">🔖 保存</button>
+            <button class="btn-gray" onclick="deleteBookmark()">删除</button>
+        </div>
+    </div>
+
+    <div class="ab-status session-section">
+        <h3>👥 同步播放</h3>
+        <div class="status-text" id="sessionStatus">未加入</div>
+        <div class="btn-row">
+            <button class="btn-green active" id="sessionCreate" onclick="createSession()">创建房间</button>
+            <input type="text" id="sessionCode" placeholder="房间号" maxlength="6">
+            <button class="btn-gray active" id="sessionJoin" onclick="joinSession(sessionCode.value)">加入</button>
+            <button class="btn-red" id="sessionLeave" onclick="leaveSession()">退出</button>
+        </div>
+    </div>
+
+    <div class="ab-status offline-section" id="offlineSection">
+        <h3>📴 离线缓存</h3>
+        <div class="status-text" id="offlineStatus"></div>
+        <div class="offline-files" id="offlineFiles"></div>
+        <button class="btn-gray" onclick="clearOfflineCache()">清空离线缓存</button>
     </div>
 
     <div class="help-text" style="margin-top: 15px;">
@@ -306,182 +2822,1777 @@ HTML_TEMPLATE = '''
         <p>3. 播放到终点位置，点击"设置B点"</p>
         <p>4. 自动开始AB循环播放</p>
         <p>5. 点击下方速度按钮调节播放速度</p>
+        <p>6. 网络不稳时点击"片段循环"，只下载A-B片段在本地循环</p>
+        <p>7. 画质默认按网速自动选择，低码率档位在后台生成后自动切换</p>
+        <p>8. 文件列表会显示时长和分辨率，勾选"只显示能播放的文件"隐藏本浏览器放不了的文件</p>
+        <p>9. 鼠标悬停或拖动进度条时显示该位置的画面预览，松开后才跳转</p>
+        <p>10. 进度条上方显示音频波形：点击跳转，滚轮缩放，双击还原</p>
+        <p>11. 设置AB循环后，A-B区间只下载一次并保存在内存中，循环时不再访问网络</p>
+        <p>12. 同步播放：一台设备创建房间，其它设备输入房间号（或打开分享的链接）加入，自动跟随播放、暂停、跳转、速度和AB循环</p>
+        <p>13. 每个文件的播放位置、速度和AB点自动保存，重新打开时继续；设置好AB点后点"保存"可存为书签，以后从书签列表选择</p>
+        <p>14. 最近播放的部分和AB片段会缓存在浏览器中（💾），断网后仍可播放（需通过 localhost 或 HTTPS 访问）</p>
     </div>
 
-    <script>
-        const player = document.getElementById('mediaPlayer');
-        const progressBar = document.getElementById('progressBar');
-        const currentTimeEl = document.getElementById('currentTime');
-        const durationEl = document.getElementById('duration');
-        const playBtn = document.getElementById('playBtn');
-        const abStatus = document.getElementById('abStatus');
-        const loopIndicator = document.getElementById('loopIndicator');
-
-        let pointA = null;
-        let pointB = null;
-        let isLooping = false;
-
-        // 格式化时间
-        function formatTime(seconds) {
-            if (isNaN(seconds)) return '00:00';
-            const mins = Math.floor(seconds / 60);
-            const secs = Math.floor(seconds % 60);
-            return `${mins.toString().padStart(2, '0')}:${secs.toString().padStart(2, '0')}`;
-        }
+    <script src="{{ js_url }}"></script>
+</body>
+</html>
+'''
 
-        // 加载文件
-        function loadFile(filename) {
-            if (!filename) return;
-            const encodedFile = encodeURIComponent(filename);
-            player.src = `/media/${encodedFile}`;
-            player.load();
-            clearAB();
-        }
+# 运行指标（/metrics，Prometheus文本格式）
+REQUEST_SECONDS = media_metrics.Histogram(
+    'web_player_request_duration_seconds', '从收到请求到返回响应头的耗时', ('route',))
+MEDIA_TTFB_SECONDS = media_metrics.Histogram(
+    'web_player_media_ttfb_seconds', '媒体响应从收到请求到发出第一个字节的耗时', ('route',))
+BYTES_SERVED = media_metrics.Counter(
+    'web_player_bytes_served_total', '按文件统计的媒体发送字节数', ('file',))
+ACTIVE_STREAMS = media_metrics.Gauge(
+    'web_player_active_streams', '正在发送的媒体响应数', ('route',))
+PROBED_FILES = media_metrics.Counter(
+    'web_player_probed_files_total', '探测过媒体信息的文件数', ('result',))
+SCAN_SECONDS = media_metrics.Histogram(
+    'web_player_library_scan_seconds', '媒体库扫描耗时',
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0))
 
-        // 播放控制
-        function togglePlay() {
-            if (player.paused) {
-                player.play();
-                playBtn.textContent = '⏸️ 暂停';
-            } else {
-                player.pause();
-                playBtn.textContent = '▶️ 播放';
-            }
-        }
+@app.before_request
+def start_request_timer():
+    request.environ['web_player.start'] = time.perf_counter()
 
-        // 快进/快退
-        function skip(seconds) {
-            player.currentTime += seconds;
-        }
+@app.after_request
+def record_request_duration(response):
+    start = request.environ.get('web_player.start')
+    if start is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - start, (request.endpoint or 'unknown',))
+    return response
 
-        // 设置A点
-        function setPointA() {
-            pointA = player.currentTime;
-            updateABStatus();
-        }
+class StreamMeter:
+    """一次媒体响应的发送统计：首字节耗时、发送字节数、进行中的流数"""
 
-        // 设置B点
-        function setPointB() {
-            if (pointA === null) {
-                alert('请先设置A点！');
-                return;
-            }
-            if (player.currentTime <= pointA) {
-                alert('B点必须在A点之后！');
-                return;
-            }
-            pointB = player.currentTime;
-            isLooping = true;
-            updateABStatus();
-            loopIndicator.classList.add('active');
-        }
+    __slots__ = ('route', 'file', 'start', 'sent', 'started', 'closed')
 
-        // 清除AB点
-        function clearAB() {
-            pointA = null;
-            pointB = null;
-            isLooping = false;
-            updateABStatus();
-            loopIndicator.classList.remove('active');
-        }
+    def __init__(self):
+        self.route = request.endpoint or 'unknown'
+        self.file = (request.view_args or {}).get('filename', '')
+        self.start = request.environ.get('web_player.start', time.perf_counter())
+        self.sent = 0
+        self.started = False
+        self.closed = False
 
-        // 更新AB状态显示
-        function updateABStatus() {
-            if (pointA === null) {
-                abStatus.textContent = '未设置';
-                abStatus.style.color = '#888';
-            } else if (pointB === null) {
-                abStatus.textContent = `A点: ${formatTime(pointA)} | 请设置B点`;
-                abStatus.style.color = '#FF9800';
-            } else {
-                abStatus.textContent = `循环: ${formatTime(pointA)} - ${formatTime(pointB)}`;
-                abStatus.style.color = '#4CAF50';
-            }
-        }
+    def first_byte(self):
+        # 响应体开始被读取后才算进行中，服务器没开始发送就关闭时不计入
+        if not self.started:
+            self.started = True
+            MEDIA_TTFB_SECONDS.observe(time.perf_counter() - self.start, (self.route,))
+            ACTIVE_STREAMS.inc(1, (self.route,))
 
-        // 设置播放速度
-        function setSpeed(speed) {
-            player.playbackRate = speed;
-            document.querySelectorAll('.speed-btn').forEach(btn => {
-                btn.classList.remove('active');
-                if (btn.textContent === speed + 'x') {
-                    btn.classList.add('active');
-                }
-            });
-        }
+    def close(self):
+        if self.started and not self.closed:
+            self.closed = True
+            ACTIVE_STREAMS.dec(1, (self.route,))
+            BYTES_SERVED.inc(self.sent, (self.file,))
 
-        // 监听播放进度
-        player.addEventListener('timeupdate', () => {
-            // 更新进度条
-            const progress = (player.currentTime / player.duration) * 100;
-            progressBar.value = progress || 0;
-            currentTimeEl.textContent = formatTime(player.currentTime);
-            durationEl.textContent = formatTime(player.duration);
-
-            // AB循环检查
-            if (isLooping && pointB !== null && player.currentTime >= pointB) {
-                player.currentTime = pointA;
-            }
-        });
+def metered_body(body, meter):
+    """统计生成器响应体的发送情况"""
+    try:
+        for chunk in body:
+            meter.first_byte()
+            meter.sent += len(chunk)
+            yield chunk
+    finally:
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+        meter.close()
 
-        // 进度条拖动
-        progressBar.addEventListener('input', () => {
-            const time = (progressBar.value / 100) * player.duration;
-            player.currentTime = time;
-        });
+_shaper = None
+_shaper_lock = threading.Lock()
 
-        // 播放状态监听
-        player.addEventListener('play', () => {
-            playBtn.textContent = '⏸️ 暂停';
-        });
+def get_shaper():
+    """带宽分配器（没有设置限速时返回None）"""
+    global _shaper
+    if _shaper is None and (SHAPE_TOTAL_MBPS or SHAPE_CLIENT_MBPS):
+        with _shaper_lock:
+            if _shaper is None:
+                _shaper = BandwidthShaper(SHAPE_TOTAL_MBPS * 125000, SHAPE_CLIENT_MBPS * 125000,
+                                          SHAPE_CRITICAL_BYTES)
+    return _shaper
 
-        player.addEventListener('pause', () => {
-            playBtn.textContent = '▶️ 播放';
-        });
+def shaped_body(body, shaper, client, key=None, start=0, prefetch=False):
+    """按客户端限速发送生成器响应体（key、start 为文件和起始位置，用于区分跳转和顺序读取）"""
+    stream = None
+    try:
+        for chunk in body:
+            if stream is None:
+                stream = shaper.open_stream(client, key, start, prefetch)
+            stream.consume(len(chunk))
+            yield chunk
+    finally:
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+        if stream is not None:
+            stream.close()
 
-        player.addEventListener('ended', () => {
-            playBtn.textContent = '▶️ 播放';
-        });
+def media_body(body, key=None, start=0):
+    """媒体响应体：限速（如已设置）并统计发送情况
 
-        // 键盘快捷键
-        document.addEventListener('keydown', (e) => {
-            if (e.code === 'Space') {
-                e.preventDefault();
-                togglePlay();
-            } else if (e.code === 'ArrowLeft') {
-                skip(-5);
-            } else if (e.code === 'ArrowRight') {
-                skip(5);
-            } else if (e.code === 'KeyA') {
-                setPointA();
-            } else if (e.code === 'KeyB') {
-                setPointB();
-            }
-        });
-    </script>
-</body>
-</html>
-'''
+    key、start 为文件和响应在文件中的起始位置（不是文件的一段时 key 为None）
+    """
+    shaper = get_shaper()
+    if shaper is not None:
+        body = shaped_body(body, shaper, request.remote_addr or '', key, start,
+                           request.headers.get('X-Prefetch') == '1')
+    return metered_body(body, StreamMeter())
+
+class MeteredFile:
+    """交给 wsgi.file_wrapper 的文件，统计实际发送的字节数
+
+    服务器可能先读出再退回未发送的部分（seek），所以关闭时按读取位置计算。
+    内层是真实文件时提供 fileno()，gunicorn 等服务器可以用 sendfile 发送
+    （sendfile 发送后会把文件位置移到发送结束处，统计方式不变）。
+    """
+
+    def __init__(self, f, meter):
+        self._file = f
+        self._meter = meter
+        self._start = f.tell()
+
+    def read(self, size=-1):
+        self._meter.first_byte()
+        return self._file.read(size)
+
+    def fileno(self):
+        fileno = getattr(self._file, 'fileno', None)
+        if fileno is None:
+            raise io.UnsupportedOperation('fileno')
+        # 用 sendfile 发送时不会调用 read()
+        self._meter.first_byte()
+        return fileno()
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+    def close(self):
+        self._meter.sent = max(self._file.tell() - self._start, 0)
+        self._file.close()
+        self._meter.close()
+
+_library = None
+_library_lock = threading.Lock()
+_prober = None
+
+def get_library():
+    """媒体库索引（首次使用时从数据库载入，扫描由后台线程完成）"""
+    global _library
+    with _library_lock:
+        if _library is None:
+            _library = MediaLibrary(LIBRARY_DB, MEDIA_ROOTS, VIDEO_EXTENSIONS | AUDIO_EXTENSIONS,
+                                    scan_workers=SCAN_WORKERS)
+            _library.scan_listeners.append(lambda stats: SCAN_SECONDS.observe(stats.elapsed))
+            _library.change_listeners.append(publish_library_change)
+        return _library
+
+def start_prober():
+    """启动后台媒体信息探测（PROBE_WORKERS 为0时不启动）"""
+    global _prober
+    if PROBE_WORKERS > 0:
+        _prober = MetadataProber(get_library(), PROBE_WORKERS, publish_metadata)
+        _prober.start()
+
+class CachedBody:
+    """预先压缩好的响应体（原文、gzip、brotli）和强ETag"""
+
+    def __init__(self, data, mimetype):
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(data).hexdigest()[:32]
+        self.variants = {None: data, 'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.variants['br'] = brotli.compress(data)
+
+def cached_response(body, cache_control='no-cache'):
+    """按 Accept-Encoding 选择预压缩版本，If-None-Match 命中时返回304"""
+    encoding = None
+    for candidate in ('br', 'gzip'):
+        if candidate in body.variants and candidate in request.accept_encodings:
+            encoding = candidate
+            break
+    etag = f'{body.etag}-{encoding}' if encoding else body.etag
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body.variants[encoding], mimetype=body.mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+# 静态资源 {文件名: CachedBody}，文件名带内容哈希
+ASSETS = {}
+
+def register_asset(name, text, mimetype):
+    """注册静态资源，返回其URL"""
+    body = CachedBody(text.encode('utf-8'), mimetype)
+    stem, ext = os.path.splitext(name)
+    hashed_name = f'{stem}.{body.etag[:12]}{ext}'
+    ASSETS[hashed_name] = body
+    return f'/assets/{hashed_name}'
+
+PLAYER_CSS_URL = register_asset('player.css', PLAYER_CSS, 'text/css')
+PLAYER_JS_URL = register_asset('player.js', PLAYER_JS, 'application/javascript')
+
+# 首页模板只编译一次，渲染结果在首次访问时缓存
+INDEX_TEMPLATE = app.jinja_env.from_string(HTML_TEMPLATE)
+_index_body = None
+_service_worker_body = None
+
+# /api/files 的响应缓存 {(媒体库版本, 媒体信息版本, 参数): CachedBody}，媒体库变化后旧版本自然失效
+_json_cache = OrderedDict()
+_json_cache_lock = threading.Lock()
+JSON_CACHE_SIZE = 256
 
-def get_media_files(directory='.'):
-    """获取目录下的所有媒体文件"""
-    files = []
-    for filename in os.listdir(directory):
-        ext = os.path.splitext(filename)[1].lower()
-        if ext in VIDEO_EXTENSIONS or ext in AUDIO_EXTENSIONS:
-            files.append(filename)
-    return sorted(files)
+@app.route('/assets/<name>')
+def serve_asset(name):
+    body = ASSETS.get(name)
+    if body is None:
+        abort(404)
+    return cached_response(body, 'public, max-age=31536000, immutable')
 
 @app.route('/')
 def index():
-    files = get_media_files()
-    return render_template_string(HTML_TEMPLATE, files=files)
+    # 文件列表由页面通过 /api/files 分页加载，首屏大小与媒体库规模无关
+    global _index_body
+    if _index_body is None:
+        html = INDEX_TEMPLATE.render(
+            css_url=PLAYER_CSS_URL, js_url=PLAYER_JS_URL,
+            hls_threshold=HLS_THRESHOLD_BYTES if media_tools.have_ffmpeg() else 0,
+            video_extensions=','.join(sorted(VIDEO_EXTENSIONS)),
+            remux_extensions=','.join(sorted(REMUX_EXTENSIONS)) if media_tools.have_ffmpeg() else '',
+            transcode=1 if media_tools.have_ffmpeg() else 0)
+        _index_body = CachedBody(html.encode('utf-8'), 'text/html')
+    return cached_response(_index_body)
+
+@app.route('/sw.js')
+def service_worker():
+    # 外壳缓存名随静态资源的哈希变化，新版本激活时删除旧的外壳缓存
+    global _service_worker_body
+    if _service_worker_body is None:
+        shell_urls = ['/', PLAYER_CSS_URL, PLAYER_JS_URL]
+        version = hashlib.sha256(''.join(shell_urls).encode('utf-8')).hexdigest()[:12]
+        config = (f"const SHELL_CACHE = 'player-shell-{version}';\n"
+                  f"const SHELL_URLS = {json.dumps(shell_urls)};\n"
+                  f"const QUOTA = {OFFLINE_CACHE_BYTES};\n")
+        _service_worker_body = CachedBody((config + SERVICE_WORKER_JS).encode('utf-8'),
+                                          'application/javascript')
+    return cached_response(_service_worker_body)
+
+def encode_cursor(sort_key):
+    return base64.urlsafe_b64encode(json.dumps(sort_key).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+
+def file_item(library, entry):
+    """文件列表中的一项；meta 为探测到的媒体信息，还没探测时为 null"""
+    return {'name': entry.key, 'size': entry.size, 'mtime': entry.mtime,
+            'meta': library.metadata(entry)}
+
+@app.route('/api/files')
+def api_files():
+    """分页的文件列表
+
+    参数: q 搜索词, mode=substring|prefix, sort=name|mtime|size,
+    limit 每页数量（最多1000）, cursor 上一页返回的 next
+    """
+    q = request.args.get('q', '')
+    mode = request.args.get('mode', 'substring')
+    sort = request.args.get('sort', 'name')
+    limit = request.args.get('limit', FILE_PAGE_SIZE, type=int)
+    if sort not in LibrarySnapshot.SORT_KEYS or mode not in ('substring', 'prefix'):
+        return jsonify({'error': '不支持的排序或搜索方式'}), 400
+    limit = max(1, min(limit, 1000))
+
+    library = get_library()
+    snapshot = library.snapshot()
+    cache_key = (snapshot.version, library.meta_version, q, mode, sort, limit,
+                 request.args.get('cursor'))
+    with _json_cache_lock:
+        body = _json_cache.get(cache_key)
+        if body is not None:
+            _json_cache.move_to_end(cache_key)
+    if body is None:
+        try:
+            after = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+            items, next_key, total = snapshot.page(q, mode, sort, after, limit)
+        except (ValueError, TypeError):
+            return jsonify({'error': '无效的分页游标'}), 400
+        data = json.dumps({
+            'files': [file_item(library, e) for e in items],
+            'next': encode_cursor(next_key) if next_key is not None else None,
+            'total': total,
+            'version': snapshot.version,
+        }, ensure_ascii=False)
+        body = CachedBody(data.encode('utf-8'), 'application/json')
+        with _json_cache_lock:
+            _json_cache[cache_key] = body
+            while len(_json_cache) > JSON_CACHE_SIZE:
+                _json_cache.popitem(last=False)
+    return cached_response(body)
+
+class EventLog:
+    """最近的事件（id 自增）；发布只是追加并唤醒等待者，不会被慢的订阅者阻塞"""
+
+    def __init__(self, size):
+        self._events = deque(maxlen=size)
+        self._next_id = 1
+        self._cond = threading.Condition()
+
+    @property
+    def last_id(self):
+        with self._cond:
+            return self._next_id - 1
+
+    def publish(self, name, data):
+        payload = json.dumps(data, ensure_ascii=False)
+        with self._cond:
+            self._events.append((self._next_id, name, payload))
+            self._next_id += 1
+            self._cond.notify_all()
+
+    def since(self, last_id, timeout):
+        """last_id 之后的事件，没有时最多等待 timeout 秒；
+        last_id 已不在保留范围内（或服务器重启过）时返回 None"""
+        with self._cond:
+            if last_id >= self._next_id:
+                return None
+            self._cond.wait_for(lambda: self._next_id - 1 > last_id, timeout)
+            if self._events and self._events[0][0] > last_id + 1:
+                return None
+            return [event for event in self._events if event[0] > last_id]
+
+_library_events = EventLog(EVENT_LOG_SIZE)
+_event_streams = None
+
+def get_event_streams():
+    """同时保持的媒体库事件流连接数"""
+    global _event_streams
+    if _event_streams is None:
+        _event_streams = threading.BoundedSemaphore(
+            EVENT_STREAM_LIMIT or max(SERVER_THREADS // 2, 1))
+    return _event_streams
+
+def publish_library_change(added, updated, removed):
+    """媒体库变化推送给打开的页面"""
+    library = get_library()
+    _library_events.publish('library', {
+        'added': [file_item(library, e) for e in added],
+        'updated': [file_item(library, e) for e in updated],
+        'removed': removed,
+        'version': library.version,
+    })
+
+def publish_metadata(probed):
+    """新探测到的媒体信息推送给打开的页面"""
+    for _, info in probed:
+        PROBED_FILES.inc(labels=('error' if 'error' in info else 'ok', ))
+    _library_events.publish('metadata', {
+        'files': [{'name': entry.key, 'meta': info} for entry, info in probed],
+    })
+
+def format_event(event_id, name, data):
+    return f'id: {event_id}\nevent: {name}\ndata: {data}\n\n'.encode('utf-8')
+
+def iter_library_events(last_id):
+    """事件流：补发 last_id 之后的事件，然后等待新事件，EVENT_STREAM_SECONDS 后结束"""
+    streams = get_event_streams()
+    yield f'retry: {EVENT_RETRY_MS}\n\n'.encode('ascii')
+    if last_id is None:
+        last_id = _library_events.last_id
+        yield format_event(last_id, 'hello', json.dumps({'version': get_library().version}))
+
+    # 连接数已满：只补发已有的事件，让浏览器稍后重连
+    streaming = streams.acquire(blocking=False)
+    deadline = time.monotonic() + (EVENT_STREAM_SECONDS if streaming else 0)
+    try:
+        while True:
+            events = _library_events.since(last_id, max(min(deadline - time.monotonic(), 15), 0))
+            if events is None:
+                last_id = _library_events.last_id
+                yield format_event(last_id, 'reset', '{}')
+            elif events:
+                for event_id, name, data in events:
+                    yield format_event(event_id, name, data)
+                last_id = events[-1][0]
+            elif time.monotonic() < deadline:
+                yield b': keepalive\n\n'
+            if time.monotonic() >= deadline:
+                break
+    finally:
+        if streaming:
+            streams.release()
+
+@app.route('/api/events')
+def api_events():
+    """媒体库变化的事件流（Server-Sent Events）"""
+    try:
+        last_id = int(request.headers['Last-Event-ID'])
+    except (KeyError, ValueError):
+        last_id = None
+    response = Response(iter_library_events(last_id), mimetype='text/event-stream',
+                        direct_passthrough=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/time')
+def api_time():
+    """服务器时钟（秒），页面多次请求取往返最快的一次估计时钟偏差"""
+    response = jsonify({'time': time.time()})
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+class SessionRoom:
+    """同步播放房间：主持人的播放状态和推送给跟随者的事件
+
+    状态是绝对的（服务器时钟 time 时播放到 position），跟随者按自己估计的时钟偏差
+    算出现在应在的位置，所以只需要最新的一条；发布只追加到 EventLog，不等待任何跟随者。
+    跟随者按最近一次查询的时间计数。
+    """
+
+    def __init__(self, token):
+        self.token = token
+        self.state = {'file': None, 'playing': False, 'position': 0.0, 'time': time.time(),
+                      'rate': 1.0, 'a': None, 'b': None, 'version': 0}
+        self.events = EventLog(SESSION_LOG_SIZE)
+        # {跟随者id: 最近一次查询的时间}
+        self.seen = {}
+        self.last_active = time.monotonic()
+        self.lock = threading.Lock()
+
+    @property
+    def followers(self):
+        cutoff = time.monotonic() - SESSION_FOLLOWER_SECONDS
+        with self.lock:
+            for follower in [f for f, seen in self.seen.items() if seen < cutoff]:
+                del self.seen[follower]
+            return len(self.seen)
+
+    def snapshot(self):
+        """(事件id, 当前状态的JSON)"""
+        with self.lock:
+            return self.events.last_id, json.dumps(self.state, ensure_ascii=False)
+
+    def update(self, state):
+        with self.lock:
+            state['version'] = self.state['version'] + 1
+            self.state = state
+            self.last_active = time.monotonic()
+            self.events.publish('state', state)
+        return state
+
+    def follow(self, follower):
+        """记下跟随者的查询"""
+        with self.lock:
+            self.last_active = self.seen[follower] = time.monotonic()
+
+    def is_following(self, follower):
+        with self.lock:
+            return follower in self.seen
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(room):
+    with _sessions_lock:
+        return _sessions.get(room)
+
+def admit_follower(session, follower):
+    """记下跟随者的查询；所有房间的跟随者已有 SESSION_WAIT_LIMIT 个时不接纳新的跟随者，返回False"""
+    with _sessions_lock:
+        total = sum(s.followers for s in _sessions.values())
+        if not session.is_following(follower) and total >= SESSION_WAIT_LIMIT:
+            return False
+        session.follow(follower)
+    return True
+
+def prune_sessions():
+    """删除长时间没有主持人更新、也没有跟随者的房间"""
+    cutoff = time.monotonic() - SESSION_IDLE_SECONDS
+    with _sessions_lock:
+        for room in [r for r, s in _sessions.items() if s.followers == 0 and s.last_active < cutoff]:
+            del _sessions[room]
+
+def json_number(data, name, low=0, high=math.inf, optional=False):
+    """JSON请求中的数值字段，无效或超出 [low, high] 时抛出 ValueError"""
+    value = data.get(name)
+    if value is None and optional:
+        return None
+    # bool 是 int 的子类；字符串、NaN、无穷大都不接受
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError(f'{name} 无效')
+    value = float(value)
+    if not low <= value <= high:
+        raise ValueError(f'{name} 超出范围')
+    return value
+
+def json_ab(data):
+    """JSON请求中的 A、B 点（都可以为空，但有B点时必须有A点且B在A之后）"""
+    a = json_number(data, 'a', optional=True)
+    b = json_number(data, 'b', optional=True)
+    if a is None and b is not None or b is not None and b <= a:
+        raise ValueError('B点必须在A点之后')
+    return a, b
+
+def parse_session_state(data):
+    """校验主持人发来的播放状态，返回规范化的 dict，无效时抛出 ValueError"""
+    if not isinstance(data, dict):
+        raise ValueError('需要JSON对象')
+    file = data.get('file')
+    if file is not None and not isinstance(file, str):
+        raise ValueError('file 无效')
+    a, b = json_ab(data)
+    now = time.time()
+    stamp = json_number(data, 'time', optional=True)
+    if stamp is None or abs(stamp - now) > SESSION_CLOCK_TOLERANCE:
+        stamp = now
+    return {'file': file, 'playing': bool(data.get('playing')),
+            'position': json_number(data, 'position'), 'time': stamp,
+            'rate': json_number(data, 'rate', 0.0625, 16), 'a': a, 'b': b}
+
+@app.route('/api/sessions', methods=['POST'])
+def api_create_session():
+    """创建同步播放房间，返回房间号和主持人令牌"""
+    prune_sessions()
+    token = uuid.uuid4().hex
+    with _sessions_lock:
+        while True:
+            room = uuid.uuid4().hex[:6].upper()
+            if room not in _sessions:
+                break
+        _sessions[room] = SessionRoom(token)
+    print(f"👥 创建同步播放房间 {room}")
+    return jsonify({'room': room, 'token': token})
+
+@app.route('/api/sessions/<room>')
+def api_session(room):
+    session = get_session(room)
+    if session is None:
+        return jsonify({'error': '房间不存在'}), 404
+    return jsonify({'state': session.state, 'followers': session.followers})
+
+@app.route('/api/sessions/<room>/state', methods=['POST'])
+def api_session_state(room):
+    """主持人更新播放状态，推送给所有跟随者"""
+    session = get_session(room)
+    if session is None:
+        return jsonify({'error': '房间不存在'}), 404
+    if request.headers.get('X-Session-Token') != session.token:
+        return jsonify({'error': '只有主持人可以控制播放'}), 403
+    try:
+        state = parse_session_state(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'state': session.update(state), 'followers': session.followers})
+
+_session_waiters = None
+
+def get_session_waiters():
+    """同时等待房间状态的查询数（与媒体库事件流分开计算）
+
+    接纳的跟随者不超过 SESSION_WAIT_LIMIT，正常情况下不会用满；只挡住同一跟随者同时发出的多余查询
+    """
+    global _session_waiters
+    if _session_waiters is None:
+        _session_waiters = threading.BoundedSemaphore(max(SESSION_WAIT_LIMIT, 1))
+    return _session_waiters
+
+@app.route('/api/sessions/<room>/poll')
+def api_session_poll(room):
+    """跟随者长轮询房间的播放状态
+
+    参数: follower 跟随者id；since 上次收到的事件id（没有时立即返回当前状态）。
+    有新状态时立即返回最新的一条，否则最多等待 SESSION_POLL_SECONDS 秒后返回 state 为null；
+    跟随者已满（见 SESSION_WAIT_LIMIT）时新的跟随者得到503
+    """
+    session = get_session(room)
+    if session is None:
+        return jsonify({'error': '房间不存在'}), 404
+    follower = request.args.get('follower', '')[:64]
+    if not follower:
+        return jsonify({'error': '缺少 follower 参数'}), 400
+    since = request.args.get('since', type=int)
+    if not admit_follower(session, follower):
+        return jsonify({'error': f'同步播放的跟随者已满（最多{SESSION_WAIT_LIMIT}人）'}), 503
+
+    events = None
+    if since is not None:
+        waiters = get_session_waiters()
+        if not waiters.acquire(blocking=False):
+            return jsonify({'error': '等待中的查询过多'}), 503
+        try:
+            events = session.events.since(since, SESSION_POLL_SECONDS)
+        finally:
+            waiters.release()
+        session.follow(follower)
+
+    if events is None:
+        last_id, data = session.snapshot()
+    elif events:
+        last_id, _, data = events[-1]
+    else:
+        last_id, data = since, 'null'
+    response = Response(f'{{"id": {last_id}, "state": {data}}}', mimetype='application/json')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+_progress_store = None
+_progress_store_lock = threading.Lock()
+
+def get_progress_store():
+    """播放进度和书签（首次使用时打开数据库，退出时写入剩余的进度）"""
+    global _progress_store
+    with _progress_store_lock:
+        if _progress_store is None:
+            _progress_store = PlaybackStore(PROGRESS_DB, PROGRESS_FLUSH_SECONDS)
+            atexit.register(_progress_store.close)
+        return _progress_store
+
+@app.route('/api/resume')
+def api_recent():
+    """最近播放、仍在媒体库中的文件及其进度"""
+    library = get_library()
+    for file, progress in get_progress_store().recent():
+        entry = library.get(file)
+        if entry is not None:
+            return jsonify({'file': file_item(library, entry), 'progress': progress})
+    return jsonify({'file': None, 'progress': None})
+
+@app.route('/api/resume/<path:filename>', methods=['GET', 'POST'])
+def api_resume(filename):
+    """GET: 文件的播放进度和书签；POST: 上报播放位置、速度和AB点（合并后定期写入）"""
+    filename = urllib.parse.unquote(filename)
+    resolve_media_path(filename)
+    store = get_progress_store()
+    if request.method == 'POST':
+        # 页面关闭时用 sendBeacon 上报，Content-Type 不是 application/json
+        data = request.get_json(force=True, silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'error': '需要JSON对象'}), 400
+        try:
+            position = json_number(data, 'position')
+            speed = json_number(data, 'speed', 0.0625, 16)
+            a, b = json_ab(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        store.save_progress(filename, position, speed, a, b)
+        return jsonify({'saved': True})
+    return jsonify({'progress': store.progress(filename), 'bookmarks': store.bookmarks(filename)})
+
+@app.route('/api/bookmarks/<path:filename>', methods=['GET', 'POST', 'DELETE'])
+def api_bookmarks(filename):
+    """文件的A-B书签：POST {name, a, b} 保存（同名替换），DELETE ?name= 删除"""
+    filename = urllib.parse.unquote(filename)
+    resolve_media_path(filename)
+    store = get_progress_store()
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'error': '需要JSON对象'}), 400
+        name = data.get('name')
+        if not isinstance(name, str) or not name.strip() or len(name) > 100:
+            return jsonify({'error': '书签名称无效'}), 400
+        try:
+            a, b = json_ab(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if b is None:
+            return jsonify({'error': '需要A点和B点'}), 400
+        store.save_bookmark(filename, name.strip(), a, b)
+    elif request.method == 'DELETE':
+        if not store.delete_bookmark(filename, request.args.get('name', '')):
+            return jsonify({'error': '书签不存在'}), 404
+    return jsonify({'bookmarks': store.bookmarks(filename)})
+
+def resolve_media_path(filename):
+    """把URL中的文件名解析为媒体根目录下的绝对路径，不存在则返回404"""
+    path = get_library().resolve(filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    return path
+
+def guess_mimetype(path):
+    """根据扩展名猜测媒体类型"""
+    ext = os.path.splitext(path)[1].lower()
+    return (MEDIA_MIMETYPES.get(ext) or mimetypes.guess_type(path)[0]
+            or 'application/octet-stream')
+
+def parse_byte_ranges(range_header, size):
+    """解析Range头
+
+    返回按起点排序并合并后的 [(start, stop)] 列表（stop不含）；
+    头无效时返回None，所有区间都不可满足时返回空列表。
+    """
+    parsed = parse_range_header(range_header)
+    if parsed is None or parsed.units != 'bytes':
+        return None
+    ranges = []
+    for start, stop in parsed.ranges:
+        if start < 0:
+            # 后缀区间 bytes=-N
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            ranges.append((start, stop))
+    ranges.sort()
+    merged = []
+    for start, stop in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def if_range_matches(etag, last_modified):
+    """If-Range条件成立（或未提供）时才按Range返回部分内容"""
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return if_range.date == last_modified
+    return True
+
+_block_cache = None
+
+def get_block_cache():
+    """媒体文件的内存块缓存（BLOCK_CACHE_BYTES 为0时返回None）"""
+    global _block_cache
+    if _block_cache is None and BLOCK_CACHE_BYTES > 0:
+        with _library_lock:
+            if _block_cache is None:
+                _block_cache = BlockCache(BLOCK_CACHE_BYTES, STREAM_CHUNK_SIZE, BLOCK_READ_AHEAD)
+    return _block_cache
+
+def open_media(path, admit=False):
+    """打开媒体文件读取（经过内存块缓存；admit 为True时第一次读取就放入缓存）"""
+    cache = get_block_cache()
+    return cache.open(path, admit) if cache is not None else open(path, 'rb')
+
+def iter_file_range(path, start, length):
+    """按块读取文件的一段区间"""
+    with open_media(path) as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def file_range_body(path, start, stop, size, layout=None):
+    """生成区间的响应体（layout 为虚拟faststart布局时按虚拟布局读取）
+
+    区间一直到文件末尾（或服务器会按 Content-Length 截断）时交给服务器的
+    wsgi.file_wrapper：waitress 由异步I/O线程发送，不占用处理请求的线程。
+    其它情况（或开发服务器）按块读取。
+
+    到文件末尾的区间直接发送真实文件，不经过内存块缓存：gunicorn 等服务器可以用
+    sendfile 发送，整个文件顺序读一遍的客户端也不会挤掉AB循环反复读取的块。
+    """
+    wrapper = request.environ.get('wsgi.file_wrapper')
+    length_aware = request.environ.get('SERVER_SOFTWARE', '').startswith(LENGTH_AWARE_SERVERS)
+    # 限速时每块数据都要经过分配器，不能交给服务器直接发送
+    if wrapper is not None and (stop == size or length_aware) and get_shaper() is None:
+        if layout is not None:
+            f = layout.open(path, opener=None if stop == size else open_media)
+        else:
+            f = open(path, 'rb') if stop == size else open_media(path)
+        f.seek(start)
+        return wrapper(MeteredFile(f, StreamMeter()), STREAM_CHUNK_SIZE)
+    if layout is not None:
+        body = layout.iter_range(path, start, stop - start, chunk_size=STREAM_CHUNK_SIZE,
+                                 opener=open_media)
+    else:
+        body = iter_file_range(path, start, stop - start)
+    return media_body(body, path, start)
+
+def iter_multipart_ranges(read_range, ranges, boundary, part_headers):
+    """multipart/byteranges 响应体"""
+    for (start, stop), headers in zip(ranges, part_headers):
+        yield headers
+        yield from read_range(start, stop - start)
+        yield b'\r\n'
+    yield f'--{boundary}--\r\n'.encode('ascii')
+
+def send_media_file(path, mimetype=None, layout=None):
+    """发送媒体文件，支持条件请求和单段/多段Range
+
+    layout 为虚拟faststart布局时，按虚拟布局发送（Range也按虚拟布局计算）。
+    整个文件和单段Range交给 wsgi.file_wrapper（见 file_range_body）；
+    多段Range按块生成，占用处理线程直到最后一段写入连接的写缓冲
+    """
+    st = os.stat(path)
+    size = st.st_size
+    etag = f'{st.st_mtime_ns:x}-{size:x}'
+    last_modified = datetime.fromtimestamp(int(st.st_mtime), timezone.utc)
+    mimetype = mimetype or guess_mimetype(path)
+    is_head = request.method == 'HEAD'
+
+    if layout is None:
+        read_range = functools.partial(iter_file_range, path)
+    else:
+        size = layout.size
+        etag += '-faststart'
+        read_range = functools.partial(layout.iter_range, path, chunk_size=STREAM_CHUNK_SIZE,
+                                       opener=open_media)
+
+    def range_body(start, stop):
+        if is_head:
+            return []
+        return file_range_body(path, start, stop, size, layout)
+
+    def make_response(body, status):
+        response = Response(body, status=status, mimetype=mimetype, direct_passthrough=True)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return make_response(None, 304)
+
+    ranges = None
+    if 'Range' in request.headers and if_range_matches(etag, last_modified):
+        ranges = parse_byte_ranges(request.headers['Range'], size)
+        if ranges is not None and len(ranges) > MAX_RANGES:
+            ranges = None
+
+    if ranges is None:
+        response = make_response(range_body(0, size), 200)
+        response.headers['Content-Length'] = str(size)
+        return response
+
+    if not ranges:
+        response = make_response(None, 416)
+        response.headers['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        response = make_response(range_body(start, stop), 206)
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        response.headers['Content-Length'] = str(stop - start)
+        return response
+
+    boundary = uuid.uuid4().hex
+    part_headers = [
+        (f'--{boundary}\r\nContent-Type: {mimetype}\r\n'
+         f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n').encode('utf-8')
+        for start, stop in ranges
+    ]
+    length = (sum(len(h) for h in part_headers)
+              + sum(stop - start + 2 for start, stop in ranges)
+              + len(boundary) + 6)
+    body = [] if is_head else media_body(
+        iter_multipart_ranges(read_range, ranges, boundary, part_headers))
+    response = make_response(body, 206)
+    response.mimetype = f'multipart/byteranges; boundary={boundary}'
+    response.headers['Content-Length'] = str(length)
+    return response
 
 @app.route('/media/<path:filename>')
 def serve_media(filename):
-    """提供媒体文件"""
+    """提供媒体文件（支持Range分段请求，手机拖动进度时只传输附近的数据）"""
     decoded_filename = urllib.parse.unquote(filename)
-    return app.send_static_file(decoded_filename)
+    path = resolve_media_path(decoded_filename)
+    return send_media_file(path, layout=get_faststart_layout(path))
+
+def get_faststart_layout(path):
+    """moov在文件末尾的MP4返回虚拟faststart布局（先发moov，手机无需先读文件末尾），
+    其它文件返回None"""
+    if not mp4_index.is_mp4(path):
+        return None
+    try:
+        return mp4_index.open_index(path).faststart_layout()
+    except (OSError, mp4_index.MP4Error):
+        return None
+
+_disk_caches = {}
+
+def get_disk_cache(name, max_bytes):
+    """CACHE_DIR 下按用途划分的磁盘缓存（首次使用时创建）"""
+    with _library_lock:
+        cache = _disk_caches.get(name)
+        if cache is None:
+            cache = _disk_caches[name] = DiskCache(os.path.join(CACHE_DIR, name), max_bytes)
+        return cache
+
+def get_clip_cache():
+    return get_disk_cache('clips', CLIP_CACHE_BYTES)
+
+def clip_can_copy(path, a):
+    """A点附近有关键帧（或是纯音频）时可以不重新编码"""
+    if os.path.splitext(path)[1].lower() in media_tools.AUDIO_ONLY_EXTENSIONS:
+        return True
+    if mp4_index.is_mp4(path):
+        try:
+            point = mp4_index.open_index(path).lookup(a)
+            return abs(point.keyframe_time - a) <= CLIP_KEYFRAME_TOLERANCE
+        except mp4_index.MP4Error:
+            pass
+    keyframes = media_tools.keyframes_near(path, a)
+    return any(abs(k - a) <= CLIP_KEYFRAME_TOLERANCE for k in keyframes)
+
+@app.route('/clip/<path:filename>')
+def serve_clip(filename):
+    """AB片段：只包含A-B区间的小文件，浏览器整段缓存后循环播放不再请求网络
+
+    参数: a, b 起止秒数；mode=auto|copy|encode（auto 在关键帧允许时直接复制流）；
+    v 为页面知道的文件版本（大小-修改时间），只用来区分缓存，带上时才允许浏览器长期缓存
+    """
+    path = resolve_media_path(urllib.parse.unquote(filename))
+    a = request.args.get('a', type=float)
+    b = request.args.get('b', type=float)
+    mode = request.args.get('mode', 'auto')
+    if a is None or b is None or not 0 <= a < b or b - a > MAX_CLIP_SECONDS:
+        return jsonify({'error': f'A/B点无效（片段最长{MAX_CLIP_SECONDS}秒）'}), 400
+    if mode not in ('auto', 'copy', 'encode'):
+        return jsonify({'error': '不支持的模式'}), 400
+    if not media_tools.have_ffmpeg():
+        return jsonify({'error': '服务器未安装ffmpeg，无法生成片段'}), 501
+
+    st = os.stat(path)
+    try:
+        copy = mode == 'copy' or (mode == 'auto' and clip_can_copy(path, a))
+        suffix = media_tools.clip_suffix(path, copy)
+        key = f'clip:{path}:{st.st_size}:{st.st_mtime_ns}:{a:.3f}:{b:.3f}:{copy}'
+        clip_path = get_clip_cache().get_or_create(
+            key, suffix, lambda tmp: media_tools.cut_clip(path, tmp, a, b, copy))
+    except media_tools.FFmpegError as e:
+        return jsonify({'error': f'生成片段失败: {e}'}), 500
+    response = send_media_file(clip_path, guess_mimetype(clip_path))
+    response.headers['Cache-Control'] = 'public, max-age=86400' if 'v' in request.args else 'no-cache'
+    return response
+
+_prefetch_pool = None
+_prefetch_lock = threading.Lock()
+# 排队和执行中的预读 (路径, 偏移, 长度)
+_prefetch_pending = set()
+
+def get_prefetch_pool():
+    global _prefetch_pool
+    with _prefetch_lock:
+        if _prefetch_pool is None:
+            _prefetch_pool = ThreadPoolExecutor(max_workers=SEEK_PREFETCH_WORKERS,
+                                                thread_name_prefix='media-prefetch')
+        return _prefetch_pool
+
+def prefetch_range(path, offset, length):
+    """在后台预读文件的一段（NAS上提前把数据拉到内存块缓存或本机页缓存）
+
+    同一段正在预读时不重复提交；等待的预读已满时直接丢弃，返回是否提交
+    """
+    key = (path, offset, length)
+    with _prefetch_lock:
+        if key in _prefetch_pending:
+            return False
+        if len(_prefetch_pending) >= SEEK_PREFETCH_WORKERS + SEEK_PREFETCH_QUEUE:
+            return False
+        _prefetch_pending.add(key)
+    get_prefetch_pool().submit(_prefetch, key)
+    return True
+
+def _prefetch(key):
+    path, offset, length = key
+    try:
+        if get_block_cache() is not None:
+            with open_media(path, admit=True) as f:
+                f.seek(offset)
+                f.read(length)
+            return
+        with open(path, 'rb') as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_WILLNEED)
+            else:
+                f.seek(offset)
+                f.read(length)
+    except OSError:
+        pass
+    finally:
+        with _prefetch_lock:
+            _prefetch_pending.discard(key)
+
+@app.route('/api/seek/<path:filename>')
+def api_seek(filename):
+    """MP4/MOV的时间 -> 字节位置，并预读该位置附近的数据
+
+    参数: t 秒数；返回 t 所在采样的字节偏移和之前最近关键帧的时间、偏移
+    """
+    path = resolve_media_path(urllib.parse.unquote(filename))
+    t = request.args.get('t', type=float)
+    if t is None or t < 0:
+        return jsonify({'error': '时间无效'}), 400
+    if not mp4_index.is_mp4(path):
+        return jsonify({'error': '只支持MP4/MOV文件'}), 415
+    try:
+        index = mp4_index.open_index(path)
+        point = index.lookup(t)
+        layout = index.faststart_layout()
+    except mp4_index.MP4Error as e:
+        return jsonify({'error': f'无法解析文件: {e}'}), 422
+    prefetch_range(path, point.keyframe_offset, SEEK_PREFETCH_BYTES)
+    if layout is not None:
+        # 返回 /media 实际发送的虚拟布局中的偏移
+        point = point._replace(offset=layout.map_offset(point.offset),
+                               keyframe_offset=layout.map_offset(point.keyframe_offset))
+    return jsonify(point._asdict())
+
+def get_hls_cache():
+    return get_disk_cache('hls', HLS_CACHE_BYTES)
+
+def media_version(path):
+    """文件版本（大小和修改时间），用于缓存键和不可变URL"""
+    st = os.stat(path)
+    return f'{st.st_size:x}-{st.st_mtime_ns:x}'
+
+_hls_plans = OrderedDict()
+_hls_plan_errors = OrderedDict()
+_hls_lock = threading.Lock()
+_hls_pool = None
+_hls_pending = set()
+
+def get_hls_pool():
+    global _hls_pool
+    with _hls_lock:
+        if _hls_pool is None:
+            _hls_pool = ThreadPoolExecutor(max_workers=HLS_WORKERS, thread_name_prefix='hls')
+        return _hls_pool
+
+def hls_plan(path, version):
+    """按关键帧切分的片段列表 [(起点, 终点)]，内存和磁盘缓存各保存一份
+
+    还没切分好时在后台切分并返回None：非MP4文件要用 ffprobe 扫描全部数据包，
+    大文件需要几分钟，不能占住处理请求的线程。切分失败时抛出 FFmpegError（只报告一次，之后再请求会重新切分）
+    """
+    key = f'hls-plan:{path}:{version}'
+    with _hls_lock:
+        plan = _hls_plans.get(key)
+        if plan is not None:
+            _hls_plans.move_to_end(key)
+            return plan
+        error = _hls_plan_errors.pop(key, None)
+    if error is not None:
+        raise media_tools.FFmpegError(error)
+
+    plan_path = get_hls_cache().get(key, '.json')
+    if plan_path is not None:
+        try:
+            return _load_hls_plan(key, plan_path)
+        except (OSError, ValueError):
+            pass
+    with _hls_lock:
+        if key in _hls_pending:
+            return None
+        _hls_pending.add(key)
+    get_hls_pool().submit(_plan_hls, key, path)
+    return None
+
+def _plan_hls(key, path):
+    def produce(temp_path):
+        keyframes = duration = None
+        if mp4_index.is_mp4(path):
+            try:
+                index = mp4_index.open_index(path)
+                keyframes, duration = index.keyframe_times(), index.duration
+            except mp4_index.MP4Error:
+                pass
+        if duration is None:
+            keyframes = media_tools.keyframe_times(path)
+            duration = media_tools.probe_duration(path)
+        segments = media_tools.plan_segments(keyframes, duration, HLS_SEGMENT_SECONDS)
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(segments, f)
+
+    try:
+        _load_hls_plan(key, get_hls_cache().get_or_create(key, '.json', produce))
+    except (OSError, ValueError, media_tools.FFmpegError) as e:
+        print(f"⚠️  HLS切分失败: {os.path.basename(path)}: {e}")
+        with _hls_lock:
+            _hls_plan_errors[key] = str(e)
+            while len(_hls_plan_errors) > 64:
+                _hls_plan_errors.popitem(last=False)
+    finally:
+        with _hls_lock:
+            _hls_pending.discard(key)
+
+def _load_hls_plan(key, plan_path):
+    with open(plan_path, encoding='utf-8') as f:
+        plan = [tuple(segment) for segment in json.load(f)]
+    with _hls_lock:
+        _hls_plans[key] = plan
+        while len(_hls_plans) > 64:
+            _hls_plans.popitem(last=False)
+    return plan
+
+def hls_plan_pending():
+    """切分还没完成：202，页面先用普通方式播放"""
+    response = jsonify({'pending': True})
+    response.status_code = 202
+    response.headers['Retry-After'] = str(HLS_PLAN_RETRY_SECONDS)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def hls_segment(path, version, plan, n):
+    """生成（或取缓存的）第n个片段，返回文件路径"""
+    start, end = plan[n]
+    return get_hls_cache().get_or_create(
+        f'hls-seg:{path}:{version}:{n}', '.ts',
+        lambda temp_path: media_tools.cut_segment(path, temp_path, start, end))
+
+def warm_hls_segments(path, version, plan, indices):
+    """后台预生成片段；已缓存的只标记为最近使用，避免被淘汰"""
+    cache = get_hls_cache()
+    for n in indices:
+        if not 0 <= n < len(plan):
+            continue
+        key = f'hls-seg:{path}:{version}:{n}'
+        if cache.get(key, '.ts') is not None:
+            continue
+        with _hls_lock:
+            if key in _hls_pending:
+                continue
+            _hls_pending.add(key)
+        get_hls_pool().submit(_warm_hls_segment, key, path, version, plan, n)
+
+def _warm_hls_segment(key, path, version, plan, n):
+    try:
+        hls_segment(path, version, plan, n)
+    except (OSError, media_tools.FFmpegError) as e:
+        print(f"⚠️  HLS片段生成失败: {os.path.basename(path)} #{n}: {e}")
+    finally:
+        with _hls_lock:
+            _hls_pending.discard(key)
+
+def resolve_hls_path(filename):
+    path = resolve_media_path(urllib.parse.unquote(filename))
+    if os.path.splitext(path)[1].lower() not in VIDEO_EXTENSIONS:
+        abort(404)
+    if not media_tools.have_ffmpeg():
+        abort(501)
+    return path
+
+@app.route('/hls/<path:filename>/index.m3u8')
+def hls_playlist(filename):
+    """HLS播放列表（片段按关键帧对齐，直接复制音视频流，不重新编码）"""
+    path = resolve_hls_path(filename)
+    version = media_version(path)
+    try:
+        plan = hls_plan(path, version)
+    except media_tools.FFmpegError as e:
+        return jsonify({'error': f'无法切分: {e}'}), 500
+    if plan is None:
+        return hls_plan_pending()
+
+    target = max((end - start for start, end in plan), default=HLS_SEGMENT_SECONDS)
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{math.ceil(target)}',
+             '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-PLAYLIST-TYPE:VOD']
+    for n, (start, end) in enumerate(plan):
+        lines.append(f'#EXTINF:{end - start:.3f},')
+        lines.append(f'{n}.ts?v={version}')
+    lines.append('#EXT-X-ENDLIST')
+    body = CachedBody(('\n'.join(lines) + '\n').encode('utf-8'), 'application/vnd.apple.mpegurl')
+    return cached_response(body)
+
+@app.route('/hls/<path:filename>/<int:n>.ts')
+def hls_segment_file(filename, n):
+    """HLS片段（按需生成，存入磁盘缓存；URL带文件版本，可永久缓存）"""
+    path = resolve_hls_path(filename)
+    version = media_version(path)
+    try:
+        plan = hls_plan(path, version)
+        if plan is None:
+            return hls_plan_pending()
+        if not 0 <= n < len(plan):
+            abort(404)
+        segment_path = hls_segment(path, version, plan, n)
+    except media_tools.FFmpegError as e:
+        return jsonify({'error': f'片段生成失败: {e}'}), 500
+    warm_hls_segments(path, version, plan, range(n + 1, n + 1 + HLS_PREFETCH_SEGMENTS))
+    response = send_media_file(segment_path, 'video/mp2t')
+    if request.args.get('v') == version:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.route('/api/hls/warm/<path:filename>', methods=['POST'])
+def api_hls_warm(filename):
+    """预热AB区间附近的HLS片段，循环时不必等待生成"""
+    path = resolve_hls_path(filename)
+    data = request.get_json(silent=True) or {}
+    try:
+        a, b = float(data['a']), float(data['b'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'A/B点无效'}), 400
+    version = media_version(path)
+    try:
+        plan = hls_plan(path, version)
+    except media_tools.FFmpegError as e:
+        return jsonify({'error': f'无法切分: {e}'}), 500
+    if plan is None:
+        return hls_plan_pending()
+    indices = [n for n, (start, end) in enumerate(plan) if end > a and start <= b]
+    if indices:
+        indices = list(range(max(indices[0] - 1, 0), indices[-1] + 2))
+    warm_hls_segments(path, version, plan, indices)
+    return jsonify({'segments': indices})
+
+def get_remux_cache():
+    return get_disk_cache('remux', REMUX_CACHE_BYTES)
+
+_remux_profiles = OrderedDict()
+_remux_lock = threading.Lock()
+_remux_writers = set()
+
+def remux_profile(path, fingerprint):
+    """转封装方案（按内容指纹记住，不必每次都调用ffprobe）"""
+    with _remux_lock:
+        profile = _remux_profiles.get(fingerprint)
+    if profile is None:
+        profile = media_tools.remux_profile(path)
+        with _remux_lock:
+            _remux_profiles[fingerprint] = profile
+            while len(_remux_profiles) > 256:
+                _remux_profiles.popitem(last=False)
+    return profile
+
+def iter_remux(proc, key):
+    """逐块转发ffmpeg输出，同时写入缓存临时文件，完整结束后才放入缓存
+
+    客户端读得慢时生成器不被推进，管道写满后ffmpeg随之暂停；
+    客户端断开时结束ffmpeg并丢弃临时文件。同一文件同时只有一个请求写缓存。
+    整个转封装期间占用一个处理线程（见 SERVER_THREADS）。
+    """
+    cache = get_remux_cache()
+    with _remux_lock:
+        tee = key not in _remux_writers
+        if tee:
+            _remux_writers.add(key)
+    temp_path = cache.temp_path('.mp4') if tee else None
+    out = open(temp_path, 'wb') if tee else None
+    complete = False
+    try:
+        while True:
+            chunk = proc.stdout.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            if out is not None:
+                out.write(chunk)
+            yield chunk
+        complete = proc.wait() == 0
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        if out is not None:
+            out.close()
+            if complete:
+                cache.put(key, temp_path, '.mp4')
+            else:
+                os.remove(temp_path)
+            with _remux_lock:
+                _remux_writers.discard(key)
+
+@app.route('/remux/<path:filename>')
+def serve_remux(filename):
+    """把浏览器无法直接播放的容器转封装为分片MP4
+
+    编码浏览器支持时直接复制音视频流，否则才转码。首次观看边转边播，
+    之后从缓存发送完整文件（支持Range，可任意跳转）。
+    """
+    path = resolve_media_path(urllib.parse.unquote(filename))
+    if os.path.splitext(path)[1].lower() not in REMUX_EXTENSIONS:
+        abort(404)
+    if not media_tools.have_ffmpeg():
+        return jsonify({'error': '服务器未安装 ffmpeg，无法转封装'}), 501
+
+    try:
+        fingerprint = file_fingerprint(path)
+        profile = remux_profile(path, fingerprint)
+    except media_tools.FFmpegError as e:
+        return jsonify({'error': f'无法识别编码: {e}'}), 500
+    key = f'remux:{fingerprint}:{profile}'
+    cached = get_remux_cache().get(key, '.mp4')
+    if cached is not None:
+        response = send_media_file(cached, 'video/mp4')
+        response.headers['Cache-Control'] = 'public, max-age=86400'
+        return response
+
+    response = Response(mimetype='video/mp4')
+    response.headers['Accept-Ranges'] = 'none'
+    response.headers['Cache-Control'] = 'no-store'
+    if request.method == 'HEAD':
+        return response
+    try:
+        proc = media_tools.open_remux(path, profile)
+    except (OSError, media_tools.FFmpegError) as e:
+        return jsonify({'error': f'转封装失败: {e}'}), 500
+    response.response = media_body(iter_remux(proc, key))
+    response.direct_passthrough = True
+    return response
+
+def get_mse_remux_pool():
+    global _mse_remux_pool
+    with _media_info_lock:
+        if _mse_remux_pool is None:
+            _mse_remux_pool = media_tools.PriorityPool(MSE_REMUX_WORKERS, 'mse-remux')
+        return _mse_remux_pool
+
+def fragmented_file(path, fingerprint, create=True):
+    """MSE播放用的分片MP4：原文件已经是分片MP4时直接使用原文件，
+    否则为转封装结果（与 /remux 共用缓存）；还没生成时返回None，create 为真时在后台生成
+    """
+    if mp4_index.is_mp4(path):
+        try:
+            mp4_index.open_fragment_map(path)
+            return path
+        except mp4_index.MP4Error:
+            pass
+    if not media_tools.have_ffmpeg():
+        abort(501)
+    profile = remux_profile(path, fingerprint)
+    key = f'remux:{fingerprint}:{profile}'
+    error = generation_failure(key)
+    if error is not None:
+        raise media_tools.FFmpegError(error)
+    cache = get_remux_cache()
+    cached = cache.get(key, '.mp4')
+    if cached is None and create:
+        queue_generation(get_mse_remux_pool(), cache, key, '.mp4',
+                         lambda temp_path: media_tools.remux_file(path, temp_path, profile),
+                         f'转封装 {os.path.basename(path)} ')
+    return cached
+
+@app.route('/api/fragments/<path:filename>')
+def api_fragments(filename):
+    """MSE播放用的片段表（时间 -> 字节）
+
+    还没有分片MP4时在后台转封装并返回 ready=false，页面稍后再查。
+    segments 每项为 [开始秒, 结束秒, 字节偏移, 字节数]，都是 url 指向的文件中的位置，
+    页面先追加前 init 个字节（ftyp+moov），之后任意一段或几段相邻的连续字节都能单独追加。
+    """
+    path = resolve_media_path(urllib.parse.unquote(filename))
+    try:
+        fingerprint = file_fingerprint(path)
+        source = fragmented_file(path, fingerprint)
+        if source is None:
+            return jsonify({'ready': False})
+        fragments = mp4_index.open_fragment_map(source)
+    except media_tools.FFmpegError as e:
+        return jsonify({'error': f'转封装失败: {e}'}), 500
+    except mp4_index.MP4Error as e:
+        return jsonify({'error': f'无法解析分片MP4: {e}'}), 422
+    segments = fragments.segments(MSE_SEGMENT_SECONDS)
+    return jsonify({
+        'ready': True,
+        'mime': fragments.mime,
+        'duration': fragments.duration,
+        'init': fragments.init_size,
+        'segments': [[round(seg.start, 3), round(seg.end, 3), seg.offset, seg.size] for seg in segments],
+        'url': f'/fragments/{urllib.parse.quote(filename)}?v={fingerprint[:16]}',
+    })
+
+@app.route('/fragments/<path:filename>')
+def serve_fragments(filename):
+    """片段表对应的分片MP4（按Range读取其中的片段）"""
+    path = resolve_media_path(urllib.parse.unquote(filename))
+    try:
+        source = fragmented_file(path, file_fingerprint(path), create=False)
+    except media_tools.FFmpegError:
+        source = None
+    if source is None:
+        abort(404)
+    response = send_media_file(source, 'video/mp4')
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+def get_rendition_cache():
+    return get_disk_cache('renditions', RENDITION_CACHE_BYTES)
+
+_transcode_pool = None
+_media_info = OrderedDict()
+_media_info_lock = threading.Lock()
+
+def get_transcode_pool():
+    """转码工作线程池（首次使用时按 TRANSCODE_WORKERS 创建）"""
+    global _transcode_pool
+    with _media_info_lock:
+        if _transcode_pool is None:
+            _transcode_pool = media_tools.PriorityPool(TRANSCODE_WORKERS, 'transcode')
+        return _transcode_pool
+
+def media_info(path, fingerprint):
+    """(时长, 视频高度)，按内容指纹记住"""
+    with _media_info_lock:
+        info = _media_info.get(fingerprint)
+    if info is None:
+        info = media_tools.probe_media(path)
+        with _media_info_lock:
+            _media_info[fingerprint] = info
+            while len(_media_info) > 256:
+                _media_info.popitem(last=False)
+    return info
+
+def rendition_ladder(path, fingerprint):
+    """适用于该文件的档位：低于原文件分辨率和码率的视频档，或音频文件的Opus档"""
+    duration, height = media_info(path, fingerprint)
+    source_kbps = os.path.getsize(path) * 8 / 1000 / duration if duration > 0 else 0
+    if height is None:
+        ladder = AUDIO_RENDITIONS
+    else:
+        ladder = [spec for spec in RENDITION_LADDER if spec['height'] < height]
+    return [spec for spec in ladder
+            if spec.get('video_kbps', 0) + spec['audio_kbps'] < source_kbps * 0.8], source_kbps
+
+def rendition_key(fingerprint, spec):
+    # 档位参数也作为键的一部分，修改配置后自动重新生成
+    return f'rendition:{fingerprint}:' + json.dumps(spec, sort_keys=True)
+
+def rendition_suffix(spec):
+    return '.mp4' if 'height' in spec else '.webm'
+
+def queue_rendition(path, fingerprint, spec, priority):
+    """把转码任务放入线程池（已缓存或最近失败过时不做任何事）"""
+    cache = get_rendition_cache()
+    key, suffix = rendition_key(fingerprint, spec), rendition_suffix(spec)
+    if cache.contains(key, suffix) or generation_failure(key) is not None:
+        return
+
+    def produce(temp_path):
+        if 'height' in spec:
+            media_tools.transcode_video(path, temp_path, spec['height'],
+                                        spec['video_kbps'], spec['audio_kbps'])
+        else:
+            media_tools.transcode_audio(path, temp_path, spec['audio_kbps'])
+
+    queue_generation(get_transcode_pool(), cache, key, suffix, produce,
+                     f"转码 {os.path.basename(path)} {spec['name']} ", priority)
+
+def resolve_rendition_path(filename):
+    path = resolve_media_path(urllib.parse.unquote(filename))
+    if not media_tools.have_ffmpeg():
+        abort(501)
+    return path, file_fingerprint(path)
+
+@app.route('/api/renditions/<path:filename>', methods=['GET', 'POST'])
+def api_renditions(filename):
+    """可选档位及其码率和是否已生成
+
+    GET 同时在后台（低优先级）预生成缺少的档位；
+    POST {"name": 档位} 把该档位提到最高优先级，用于页面正要播放的档位。
+    """
+    path, fingerprint = resolve_rendition_path(filename)
+    try:
+        ladder, source_kbps = rendition_ladder(path, fingerprint)
+    except media_tools.FFmpegError as e:
+        return jsonify({'error': f'无法识别媒体信息: {e}'}), 500
+
+    if request.method == 'POST':
+        name = (request.get_json(silent=True) or {}).get('name')
+        spec = next((spec for spec in ladder if spec['name'] == name), None)
+        if spec is None:
+            return jsonify({'error': f'没有档位: {name}'}), 404
+        queue_rendition(path, fingerprint, spec, PRIORITY_OPEN)
+    else:
+        for spec in ladder:
+            queue_rendition(path, fingerprint, spec, PRIORITY_BACKGROUND)
+
+    cache = get_rendition_cache()
+    encoded = urllib.parse.quote(filename)
+    renditions = [{'name': 'source', 'kbps': round(source_kbps), 'ready': True, 'url': None}]
+    for spec in ladder:
+        renditions.append({
+            'name': spec['name'],
+            'kbps': spec.get('video_kbps', 0) + spec['audio_kbps'],
+            'ready': cache.contains(rendition_key(fingerprint, spec), rendition_suffix(spec)),
+            'url': f"/rendition/{encoded}?name={urllib.parse.quote(spec['name'])}",
+        })
+    renditions.sort(key=lambda r: r['kbps'])
+    return jsonify({'renditions': renditions})
+
+@app.route('/rendition/<path:filename>')
+def serve_rendition(filename):
+    """已生成的转码档位文件（未生成时返回404）"""
+    path, fingerprint = resolve_rendition_path(filename)
+    name = request.args.get('name')
+    try:
+        ladder, _ = rendition_ladder(path, fingerprint)
+    except media_tools.FFmpegError as e:
+        return jsonify({'error': f'无法识别媒体信息: {e}'}), 500
+    spec = next((spec for spec in ladder if spec['name'] == name), None)
+    if spec is None:
+        abort(404)
+    suffix = rendition_suffix(spec)
+    cached = get_rendition_cache().get(rendition_key(fingerprint, spec), suffix)
+    if cached is None:
+        abort(404)
+    response = send_media_file(cached, 'video/mp4' if suffix == '.mp4' else 'audio/webm')
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+def get_thumbnail_cache():
+    return get_disk_cache('thumbnails', THUMB_CACHE_BYTES)
+
+_thumbnail_pool = None
+_mse_remux_pool = None
+_waveform_pool = None
+_video_geometry = OrderedDict()
+# 后台生成失败的文件 {缓存key: (失败时间, 错误)}，GENERATION_RETRY_SECONDS 内不反复重试
+_generation_failures = OrderedDict()
+
+def get_thumbnail_pool():
+    """生成雪碧图的工作线程池（与转码分开，不会排在长时间的转码任务后面）"""
+    global _thumbnail_pool
+    with _media_info_lock:
+        if _thumbnail_pool is None:
+            _thumbnail_pool = media_tools.PriorityPool(THUMB_WORKERS, 'thumbnail')
+        return _thumbnail_pool
+
+def queue_generation(pool, cache, key, suffix, producer, what, priority=PRIORITY_OPEN):
+    """在后台生成缓存文件（同一key只生成一次；失败的记下来，一段时间内不反复重试）"""
+    def report(future):
+        error = future.exception()
+        if error is not None:
+            print(f"⚠️  {what}失败: {error}")
+            with _media_info_lock:
+                _generation_failures[key] = (time.monotonic(), str(error))
+                while len(_generation_failures) > 256:
+                    _generation_failures.popitem(last=False)
+
+    future = pool.submit(key, priority, lambda: cache.get_or_create(key, suffix, producer))
+    future.add_done_callback(report)
+
+def generation_failure(key):
+    """最近一次生成失败的错误；超过 GENERATION_RETRY_SECONDS 后忘掉，下次请求重新生成
+    （磁盘满、ffmpeg升级等问题可能已经解决，文件内容变化时 key 也会变）"""
+    with _media_info_lock:
+        failure = _generation_failures.get(key)
+        if failure is None:
+            return None
+        failed_at, error = failure
+        if time.monotonic() - failed_at > GENERATION_RETRY_SECONDS:
+            del _generation_failures[key]
+            return None
+        return error
+
+def video_geometry(filename, path, fingerprint):
+    """(时长, 宽, 高)：优先用后台探测到的媒体信息，没有时调用 ffprobe（按内容指纹记住）"""
+    library = get_library()
+    entry = library.get(filename)
+    info = library.metadata(entry) if entry is not None else None
+    if info is None or 'error' in info:
+        with _media_info_lock:
+            info = _video_geometry.get(fingerprint)
+        if info is None:
+            info = media_tools.probe_info(path)
+            with _media_info_lock:
+                _video_geometry[fingerprint] = info
+                while len(_video_geometry) > 256:
+                    _video_geometry.popitem(last=False)
+    return info['duration'], info['width'], info['height']
+
+def thumbnail_layout(filename):
+    """(路径, 内容指纹, 雪碧图布局, 缓存key)；纯音频等没有画面的文件返回404"""
+    path, fingerprint = resolve_rendition_path(filename)
+    try:
+        layout = media_thumbs.sprite_layout(
+            *video_geometry(urllib.parse.unquote(filename), path, fingerprint))
+    except media_tools.FFmpegError:
+        layout = None
+    if layout is None:
+        abort(404)
+    # 布局参数也作为键的一部分，修改配置后自动重新生成
+    return path, fingerprint, layout, f'thumbs:{fingerprint}:' + json.dumps(layout, sort_keys=True)
+
+@app.route('/api/thumbnails/<path:filename>')
+def api_thumbnails(filename):
+    """进度条预览的雪碧图布局和地址
+
+    雪碧图还没生成时在后台生成并返回 ready=false，页面稍后再查；
+    时间 t 对应第 round(t / interval) 张，按 columns 列从左到右、从上到下排列。
+    """
+    path, fingerprint, layout, key = thumbnail_layout(filename)
+    error = generation_failure(key)
+    if error is not None:
+        return jsonify({'error': f'生成缩略图失败: {error}'}), 500
+    cache = get_thumbnail_cache()
+    ready = cache.contains(key, '.jpg')
+    if not ready:
+        queue_generation(get_thumbnail_pool(), cache, key, '.jpg',
+                         lambda temp_path: media_thumbs.make_sprite(path, temp_path, layout),
+                         f'生成缩略图 {os.path.basename(path)} ')
+    return jsonify(dict(layout, ready=ready,
+                        url=f'/thumbnails/{urllib.parse.quote(filename)}?v={fingerprint[:16]}'))
+
+@app.route('/thumbnails/<path:filename>')
+def serve_thumbnails(filename):
+    """雪碧图；URL 带内容指纹，可以永久缓存（未生成时返回404）"""
+    _, fingerprint, _, key = thumbnail_layout(filename)
+    cached = get_thumbnail_cache().get(key, '.jpg')
+    if cached is None:
+        abort(404)
+    response = send_media_file(cached, 'image/jpeg')
+    if request.args.get('v') == fingerprint[:16]:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def get_waveform_cache():
+    return get_disk_cache('waveforms', WAVEFORM_CACHE_BYTES)
+
+def get_waveform_pool():
+    global _waveform_pool
+    with _media_info_lock:
+        if _waveform_pool is None:
+            _waveform_pool = media_tools.PriorityPool(WAVEFORM_WORKERS, 'waveform')
+        return _waveform_pool
+
+def waveform_source(filename):
+    """(路径, 内容指纹, 缓存key)；本机无法生成波形（没有 numpy，或没有 ffmpeg 时的非WAV文件）时返回501"""
+    path = resolve_media_path(urllib.parse.unquote(filename))
+    if not waveform.can_build(path):
+        abort(501)
+    fingerprint = file_fingerprint(path)
+    return path, fingerprint, f'waveform:{fingerprint}:{WAVEFORM_BITS}:{waveform.VERSION}'
+
+@app.route('/api/waveform/<path:filename>')
+def api_waveform(filename):
+    """波形金字塔的各级信息
+
+    还没生成时在后台生成并返回 ready=false，页面稍后再查；
+    页面按可见时间范围选一级，从 url 加 level=N 取这一级的数据（min,max 交错的有符号整数）。
+    """
+    path, fingerprint, key = waveform_source(filename)
+    error = generation_failure(key)
+    if error is not None:
+        return jsonify({'error': f'生成波形失败: {error}'}), 500
+    cache = get_waveform_cache()
+    cached = cache.get(key, '.peaks')
+    if cached is None:
+        queue_generation(get_waveform_pool(), cache, key, '.peaks',
+                         lambda temp_path: waveform.build_waveform(path, temp_path, WAVEFORM_BITS),
+                         f'生成波形 {os.path.basename(path)} ')
+        return jsonify({'ready': False})
+    try:
+        header = waveform.read_header(cached)
+    except (OSError, waveform.WaveformError):
+        abort(404)
+    return jsonify({
+        'ready': True,
+        'bits': header['bits'],
+        'sample_rate': header['sample_rate'],
+        'duration': header['duration'],
+        'levels': [{'samples_per_peak': level['samples_per_peak'], 'count': level['count']}
+                   for level in header['levels']],
+        'url': f'/waveform/{urllib.parse.quote(filename)}?v={fingerprint[:16]}',
+    })
+
+@app.route('/waveform/<path:filename>')
+def serve_waveform(filename):
+    """波形金字塔中的一级（level 参数），只读取这一级的数据；URL 带内容指纹，可以永久缓存"""
+    _, fingerprint, key = waveform_source(filename)
+    level = request.args.get('level', 0, type=int)
+    cached = get_waveform_cache().get(key, '.peaks')
+    if cached is None:
+        abort(404)
+    try:
+        header = waveform.read_header(cached)
+        if not 0 <= level < len(header['levels']):
+            abort(404)
+        data = waveform.read_level(cached, header, level)
+    except (OSError, waveform.WaveformError):
+        abort(404)
+    response = Response(data, mimetype='application/octet-stream')
+    if request.args.get('v') == fingerprint[:16]:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def metrics_collector(fn):
+    """把返回 {标签值元组: 数值} 的函数用作指标（出错时不输出）"""
+    def collect():
+        try:
+            return fn()
+        except Exception:
+            return {}
+    return collect
+
+def _disk_cache_stat(field):
+    return lambda: {(name, ): cache.stats()[field] for name, cache in list(_disk_caches.items())}
+
+def _block_cache_stat(field):
+    def collect():
+        cache = get_block_cache()
+        return {(): cache.stats()[field]} if cache is not None else {}
+    return collect
+
+def _transcode_queue():
+    if _transcode_pool is None:
+        return {}
+    queued, running = _transcode_pool.pending()
+    return {('queued', ): queued, ('running', ): running}
+
+media_metrics.Gauge('web_player_library_files', '媒体库文件数',
+                    collect=metrics_collector(lambda: {(): len(get_library().snapshot().by_name)}))
+media_metrics.Counter('web_player_block_cache_hits_total', '内存块缓存命中次数',
+                      collect=metrics_collector(_block_cache_stat('hits')))
+media_metrics.Counter('web_player_block_cache_misses_total', '内存块缓存未命中次数',
+                      collect=metrics_collector(_block_cache_stat('misses')))
+media_metrics.Gauge('web_player_block_cache_bytes', '内存块缓存占用字节数',
+                    collect=metrics_collector(_block_cache_stat('bytes')))
+media_metrics.Counter('web_player_block_cache_bypassed_total', '第一次读取、没有放入内存块缓存的块数',
+                      collect=metrics_collector(_block_cache_stat('bypassed')))
+media_metrics.Counter('web_player_block_cache_shared_total', '等待其它请求读出后直接使用的块数',
+                      collect=metrics_collector(_block_cache_stat('shared')))
+media_metrics.Counter('web_player_disk_cache_hits_total', '磁盘缓存命中次数', ('cache',),
+                      collect=metrics_collector(_disk_cache_stat('hits')))
+media_metrics.Counter('web_player_disk_cache_misses_total', '磁盘缓存未命中次数', ('cache',),
+                      collect=metrics_collector(_disk_cache_stat('misses')))
+media_metrics.Gauge('web_player_disk_cache_bytes', '磁盘缓存占用字节数', ('cache',),
+                    collect=metrics_collector(_disk_cache_stat('bytes')))
+media_metrics.Gauge('web_player_transcode_jobs', '转码任务数', ('state',),
+                    collect=metrics_collector(_transcode_queue))
+media_metrics.Counter('web_player_progress_flushes_total', '播放进度写入数据库的次数',
+                      collect=metrics_collector(
+                          lambda: {(): _progress_store.flushes} if _progress_store is not None else {}))
+media_metrics.Counter('web_player_progress_coalesced_total', '合并掉（没有单独写入）的进度上报次数',
+                      collect=metrics_collector(
+                          lambda: {(): _progress_store.coalesced} if _progress_store is not None else {}))
+media_metrics.Gauge('web_player_probe_pending', '等待探测媒体信息的文件数',
+                    collect=metrics_collector(
+                        lambda: {(): _prober.pending()} if _prober is not None else {}))
+
+@app.route('/api/bandwidth')
+def api_bandwidth():
+    """当前各客户端分到的带宽（字节/秒）、实际速率和发送中的响应数"""
+    shaper = get_shaper()
+    if shaper is None:
+        return jsonify({'total_rate': None, 'client_rate': None, 'clients': []})
+    return jsonify(shaper.allocations())
+
+@app.route('/metrics')
+def metrics():
+    """运行指标（Prometheus文本格式）"""
+    response = Response(media_metrics.render(), mimetype='text/plain')
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 def get_local_ip():
     """获取本地IP地址"""
@@ -495,10 +4606,115 @@ def get_local_ip():
     except:
         return "127.0.0.1"
 
+def parse_ladder(value):
+    """解析 --renditions 参数"""
+    ladder = []
+    for item in value.split(','):
+        try:
+            height, video_kbps = (int(part) for part in item.split(':'))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'档位格式应为 高度:码率，而不是 {item}')
+        ladder.append({'name': f'{height}p', 'height': height, 'video_kbps': video_kbps,
+                       'audio_kbps': 96 if height < 720 else 128})
+    return sorted(ladder, key=lambda spec: spec['height'])
+
+def run_server(port, server='auto'):
+    """运行服务器（允许外部访问）
+
+    waitress 用异步I/O收发数据，媒体文件交给它的 file_wrapper 后不再占用处理线程，
+    少量线程即可支撑数百个同时播放的客户端；未安装时退回 Flask 开发服务器。
+    """
+    if server != 'dev':
+        try:
+            from waitress import serve
+        except ImportError:
+            if server == 'waitress':
+                raise SystemExit('未安装 waitress，请先运行: pip install waitress')
+            print("⚠️  未安装 waitress，使用开发服务器（同时播放的客户端较多时请安装 waitress）")
+        else:
+            print(f"🚀 waitress: {SERVER_THREADS}线程（另有{SESSION_WAIT_LIMIT}个给同步播放的跟随者）, "
+                  f"最多{SERVER_CONNECTION_LIMIT}个连接")
+            if get_shaper() is not None:
+                print("⚡ 已启用限速：每个发送中的媒体响应占用一个线程，--threads 应不少于同时播放的客户端数")
+            # 等待房间状态的跟随者另外占用线程，不挤占媒体请求
+            serve(app, host='0.0.0.0', port=port, threads=SERVER_THREADS + SESSION_WAIT_LIMIT,
+                  connection_limit=SERVER_CONNECTION_LIMIT,
+                  channel_timeout=SERVER_KEEPALIVE_TIMEOUT,
+                  outbuf_high_watermark=SERVER_WRITE_BUFFER,
+                  outbuf_overflow=min(SERVER_WRITE_BUFFER, 1024 * 1024),
+                  # select() 最多只能监视1024个连接
+                  asyncore_use_poll=True)
+            return
+    app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
+
+def parse_args():
+    """命令行参数"""
+    parser = argparse.ArgumentParser(description='全能播放器 - Web版')
+    parser.add_argument('roots', nargs='*', default=MEDIA_ROOTS,
+                        help='媒体文件根目录，可指定多个（默认当前目录）')
+    parser.add_argument('--port', type=int, default=5000, help='端口（默认5000）')
+    parser.add_argument('--block-cache', type=int, default=BLOCK_CACHE_BYTES // 1024 ** 2,
+                        help=f'内存块缓存容量MB，0 表示关闭（默认{BLOCK_CACHE_BYTES // 1024 ** 2}）')
+    parser.add_argument('--total-rate', type=float, default=SHAPE_TOTAL_MBPS,
+                        help='所有客户端共享的总带宽Mbps，按客户端公平分配（默认不限制）。'
+                             '限速时每个发送中的媒体响应占用一个 waitress 线程，'
+                             f'没有指定 --threads 时线程数改为{SHAPED_SERVER_THREADS}')
+    parser.add_argument('--client-rate', type=float, default=SHAPE_CLIENT_MBPS,
+                        help='单个客户端的带宽上限Mbps（默认不限制，限速时的线程数同 --total-rate）')
+    parser.add_argument('--server', choices=['auto', 'waitress', 'dev'], default='auto',
+                        help='auto: 已安装 waitress 时使用它，否则使用 Flask 开发服务器')
+    parser.add_argument('--threads', type=int, default=None,
+                        help=f'waitress 处理请求的线程数（默认{SERVER_THREADS}，限速时{SHAPED_SERVER_THREADS}）')
+    parser.add_argument('--room-waiters', type=int, default=SESSION_WAIT_LIMIT,
+                        help=f'同步播放的跟随者上限（所有房间合计），为它们另外准备的线程数'
+                             f'（默认{SESSION_WAIT_LIMIT}；名额满时新的跟随者无法加入）')
+    parser.add_argument('--connection-limit', type=int, default=SERVER_CONNECTION_LIMIT,
+                        help=f'waitress 最大同时连接数（默认{SERVER_CONNECTION_LIMIT}）')
+    parser.add_argument('--keepalive-timeout', type=int, default=SERVER_KEEPALIVE_TIMEOUT,
+                        help=f'空闲连接保持的秒数（默认{SERVER_KEEPALIVE_TIMEOUT}）')
+    parser.add_argument('--write-buffer', type=int, default=SERVER_WRITE_BUFFER,
+                        help=f'每个连接的写缓冲字节数（默认{SERVER_WRITE_BUFFER}）')
+    parser.add_argument('--scan-workers', type=int, default=SCAN_WORKERS,
+                        help=f'扫描媒体库的线程数（默认{SCAN_WORKERS}）')
+    parser.add_argument('--renditions', type=parse_ladder, default=RENDITION_LADDER,
+                        help='转码档位，如 360:800,720:2500（高度:视频码率kbps，默认360p和720p）')
+    parser.add_argument('--probe-workers', type=int, default=PROBE_WORKERS,
+                        help=f'后台探测媒体信息的进程数，0 表示不探测（默认{PROBE_WORKERS}）')
+    parser.add_argument('--thumb-workers', type=int, default=THUMB_WORKERS,
+                        help=f'同时生成预览缩略图的进程数（默认{THUMB_WORKERS}）')
+    parser.add_argument('--waveform-bits', type=int, choices=[8, 16], default=WAVEFORM_BITS,
+                        help=f'波形峰值的位数（默认{WAVEFORM_BITS}）')
+    parser.add_argument('--offline-cache', type=int, default=OFFLINE_CACHE_BYTES // 1024 ** 2,
+                        help=f'浏览器离线缓存容量MB（默认{OFFLINE_CACHE_BYTES // 1024 ** 2}）')
+    parser.add_argument('--transcode-workers', type=int, default=TRANSCODE_WORKERS,
+                        help=f'同时运行的转码进程数（默认{TRANSCODE_WORKERS}）')
+    return parser.parse_args()
+
 if __name__ == '__main__':
+    args = parse_args()
+    MEDIA_ROOTS = args.roots
+    SCAN_WORKERS = args.scan_workers
+    PROBE_WORKERS = args.probe_workers
+    RENDITION_LADDER = args.renditions
+    TRANSCODE_WORKERS = args.transcode_workers
+    THUMB_WORKERS = args.thumb_workers
+    WAVEFORM_BITS = args.waveform_bits
+    BLOCK_CACHE_BYTES = args.block_cache * 1024 ** 2
+    OFFLINE_CACHE_BYTES = args.offline_cache * 1024 ** 2
+    SHAPE_TOTAL_MBPS = args.total_rate
+    SHAPE_CLIENT_MBPS = args.client_rate
+    if args.threads is not None:
+        SERVER_THREADS = args.threads
+    elif SHAPE_TOTAL_MBPS or SHAPE_CLIENT_MBPS:
+        SERVER_THREADS = SHAPED_SERVER_THREADS
+    SERVER_CONNECTION_LIMIT = args.connection_limit
+    SESSION_WAIT_LIMIT = max(args.room_waiters, 1)
+    SERVER_KEEPALIVE_TIMEOUT = args.keepalive_timeout
+    SERVER_WRITE_BUFFER = args.write_buffer
+
     # 获取本地IP
     local_ip = get_local_ip()
-    port = 5000
+    port = args.port
 
     print("=" * 50)
     print("🎬 全能播放器 - Web版")
@@ -506,8 +4722,8 @@ if __name__ == '__main__':
     print(f"\n📱 电脑访问: http://localhost:{port}")
     print(f"📱 手机访问: http://{local_ip}:{port}")
     print("\n📖 使用说明:")
-    print("   1. 将视频/音频文件放在此目录下")
-    print("   2. 刷新页面即可选择文件播放")
+    print("   1. 将视频/音频文件放在此目录下（或在命令行指定目录）")
+    print("   2. 刷新页面即可选择文件播放（新文件几秒内自动出现）")
     print("   3. 支持AB循环、慢进/快进")
     print("   4. 按空格键播放/暂停")
     print("\n⚠️  确保电脑和手机在同一WiFi网络下")
@@ -517,5 +4733,8 @@ if __name__ == '__main__':
     if not os.path.exists('static'):
         os.makedirs('static')
 
-    # 运行服务器（允许外部访问）
-    app.run(host='0.0.0.0', port=port, debug=False)
+    # 载入媒体库索引，后台扫描并检查新增/删除的文件
+    get_library().start_auto_refresh(LIBRARY_REFRESH_INTERVAL)
+    start_prober()
+
+    run_server(port, args.server)
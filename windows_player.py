@@ -2,20 +2,36 @@
 # -*- coding: utf-8 -*-
 """
 全能播放器 - Windows版
-功能：视频/音频播放、AB点循环、慢进/快进、截图
+功能：视频/音频播放、AB点循环、慢进/快进、截图、进度条画面预览、音频波形
 """
 
 import sys
 import os
+import json
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
                              QHBoxLayout, QPushButton, QSlider, QLabel,
                              QFileDialog, QStyle, QFrame, QSpinBox,
                              QDoubleSpinBox, QGroupBox, QGridLayout)
-from PyQt6.QtCore import Qt, QTimer, QUrl, pyqtSignal, QSize
-from PyQt6.QtGui import QKeySequence, QFont, QIcon, QDragEnterEvent, QDropEvent, QShortcut
+from PyQt6.QtCore import Qt, QTimer, QUrl, pyqtSignal, QSize, QEvent, QPoint
+from PyQt6.QtGui import (QKeySequence, QFont, QIcon, QDragEnterEvent, QDropEvent, QShortcut,
+                         QPixmap, QPainter, QColor)
 from PyQt6.QtMultimedia import QMediaPlayer, QAudioOutput
 from PyQt6.QtMultimediaWidgets import QVideoWidget
 
+import media_tools
+import media_thumbs
+import waveform
+from media_cache import DiskCache, file_fingerprint
+
+
+# 进度条预览缩略图（雪碧图）的缓存目录和容量
+THUMB_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.windows_player', 'thumbnails')
+THUMB_CACHE_BYTES = 1024 ** 3
+
+# 音频波形（峰值金字塔）的缓存目录和容量
+WAVEFORM_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.windows_player', 'waveforms')
+WAVEFORM_CACHE_BYTES = 256 * 1024 ** 2
+
 
 class ABLoopButton(QPushButton):
     """AB点循环按钮"""
@@ -77,7 +93,138 @@ class ABLoopButton(QPushButton):
         return f"{minutes:02d}:{seconds:02d}"
 
 
+class WaveformWidget(QWidget):
+    """音频波形：按可见范围和宽度只读取需要的一级峰值；点击跳转，滚轮缩放，双击还原"""
+
+    # 点击波形请求跳转（毫秒）
+    seek_requested = pyqtSignal(int)
+
+    # 放大时最短的可见范围（秒）
+    MIN_SPAN = 1.0
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setFixedHeight(64)
+        self.setCursor(Qt.CursorShape.PointingHandCursor)
+        self.path = None
+        self.header = None
+        self.levels = {}
+        self.view = None
+        self.position = 0.0
+        self.point_a = None
+        self.point_b = None
+        self.hide()
+
+    def set_waveform(self, path):
+        """显示波形文件 path（None 时隐藏）"""
+        self.header = None
+        if path is not None:
+            try:
+                self.header = waveform.read_header(path)
+            except (OSError, waveform.WaveformError) as e:
+                print(f"读取波形失败: {e}")
+        self.path = path if self.header is not None else None
+        self.levels = {}
+        self.view = None
+        self.setVisible(self.header is not None)
+        self.update()
+
+    def set_position(self, position):
+        """播放位置（毫秒）；放大时可见范围跟随播放位置"""
+        self.position = position / 1000
+        if self.view is not None:
+            start, end = self.view
+            if not start <= self.position <= end:
+                span = end - start
+                start = min(max(self.position - span * 0.1, 0), self.header['duration'] - span)
+                self.view = (start, start + span)
+        self.update()
+
+    def set_loop(self, point_a, point_b):
+        """AB点（毫秒，未设置为None）"""
+        self.point_a = None if point_a is None else point_a / 1000
+        self.point_b = None if point_b is None else point_b / 1000
+        self.update()
+
+    def visible_range(self):
+        return self.view or (0.0, self.header['duration'])
+
+    def time_at(self, x):
+        start, end = self.visible_range()
+        return start + min(max(x / max(self.width(), 1), 0.0), 1.0) * (end - start)
+
+    def peaks(self, level):
+        # 每级只在第一次用到时从文件读取
+        if level not in self.levels:
+            self.levels[level] = waveform.level_peaks(self.path, self.header, level)
+        return self.levels[level]
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), QColor('#16213e'))
+        if self.header is None:
+            return
+        width, height = self.width(), self.height()
+        start, end = self.visible_range()
+
+        def x(t):
+            return int((t - start) / (end - start) * width)
+
+        if self.point_a is not None:
+            point_b = self.point_b if self.point_b is not None else self.position
+            painter.fillRect(x(self.point_a), 0, max(x(point_b) - x(self.point_a), 1), height,
+                             QColor(255, 152, 0, 64))
+
+        level = waveform.choose_level(self.header, end - start, width)
+        try:
+            peaks = self.peaks(level)
+        except (OSError, waveform.WaveformError) as e:
+            print(f"读取波形失败: {e}")
+            return
+        mins, maxs = waveform.column_peaks(
+            peaks, self.header['levels'][level]['samples_per_peak'], self.header['sample_rate'],
+            start, end, width)
+        middle = height / 2
+        tops = (middle - maxs * middle).astype(int).tolist()
+        bottoms = (middle - mins * middle).astype(int).tolist()
+        painter.setPen(QColor('#4CAF50'))
+        for column, (top, bottom) in enumerate(zip(tops, bottoms)):
+            painter.drawLine(column, top, column, bottom)
+
+        painter.setPen(QColor('#f44336'))
+        playhead = x(self.position)
+        painter.drawLine(playhead, 0, playhead, height)
+
+    def mousePressEvent(self, event):
+        if self.header is not None and event.button() == Qt.MouseButton.LeftButton:
+            self.seek_requested.emit(int(self.time_at(event.position().x()) * 1000))
+
+    def mouseDoubleClickEvent(self, event):
+        self.view = None
+        self.update()
+
+    def wheelEvent(self, event):
+        if self.header is None:
+            return
+        duration = self.header['duration']
+        start, end = self.visible_range()
+        center = self.time_at(event.position().x())
+        factor = 0.5 if event.angleDelta().y() > 0 else 2.0
+        span = min(max((end - start) * factor, self.MIN_SPAN), duration)
+        if span >= duration:
+            self.view = None
+        else:
+            start = min(max(center - (center - start) * span / (end - start), 0), duration - span)
+            self.view = (start, start + span)
+        self.update()
+
+
 class VideoPlayer(QMainWindow):
+    # 雪碧图在后台线程生成完成（文件路径, 雪碧图路径, 布局）
+    thumbnails_ready = pyqtSignal(str, str, object)
+    # 波形在后台线程生成完成（文件路径, 波形文件路径）
+    waveform_ready = pyqtSignal(str, str)
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("全能播放器 - Windows版")
@@ -93,6 +240,19 @@ class VideoPlayer(QMainWindow):
         self.video_widget = QVideoWidget()
         self.media_player.setVideoOutput(self.video_widget)
 
+        # 进度条预览：一个ffmpeg进程在后台生成雪碧图，拖动时只显示预览，松开才跳转
+        self.current_file = None
+        self.thumb_cache = None
+        self.thumb_pool = media_tools.PriorityPool(1, 'thumbnail')
+        self.thumb_sprite = None
+        self.thumb_layout = None
+        self.thumbnails_ready.connect(self.on_thumbnails_ready)
+
+        # 音频波形：后台线程解码并生成峰值金字塔
+        self.waveform_cache = None
+        self.waveform_pool = media_tools.PriorityPool(1, 'waveform')
+        self.waveform_ready.connect(self.on_waveform_ready)
+
         # 初始化UI
         self.init_ui()
         self.init_shortcuts()
@@ -134,6 +294,9 @@ class VideoPlayer(QMainWindow):
         self.progress_slider = QSlider(Qt.Orientation.Horizontal)
         self.progress_slider.setRange(0, 0)
         self.progress_slider.sliderMoved.connect(self.set_position)
+        self.progress_slider.sliderReleased.connect(self.slider_released)
+        self.progress_slider.setMouseTracking(True)
+        self.progress_slider.installEventFilter(self)
         self.progress_slider.setStyleSheet("""
             QSlider::groove:horizontal {
                 height: 8px;
@@ -151,8 +314,16 @@ class VideoPlayer(QMainWindow):
                 border-radius: 9px;
             }
         """)
+        self.waveform = WaveformWidget()
+        self.waveform.seek_requested.connect(self.media_player.setPosition)
+        layout.addWidget(self.waveform)
         layout.addWidget(self.progress_slider)
 
+        # 进度条上方的画面预览
+        self.thumb_preview = QLabel(self, Qt.WindowType.ToolTip)
+        self.thumb_preview.setStyleSheet("border: 2px solid #4CAF50; background: black;")
+        self.thumb_preview.hide()
+
         # 控制按钮区
         controls_layout = QHBoxLayout()
         controls_layout.setSpacing(10)
@@ -319,6 +490,98 @@ class VideoPlayer(QMainWindow):
         self.ab_btn.reset()
         self.ab_loop_enabled = False
 
+        self.current_file = file_path
+        self.thumb_sprite = None
+        self.thumb_layout = None
+        self.thumb_preview.hide()
+        if media_tools.have_ffmpeg():
+            self.thumb_pool.submit(file_path, 0, lambda: self.build_thumbnails(file_path))
+
+        self.waveform.set_waveform(None)
+        self.waveform.set_loop(None, None)
+        if waveform.can_build(file_path):
+            self.waveform_pool.submit(file_path, 0, lambda: self.build_waveform(file_path))
+
+    def build_thumbnails(self, file_path):
+        """在后台线程生成（或从缓存取）雪碧图，完成后发出 thumbnails_ready"""
+        if file_path != self.current_file:
+            # 已经换了文件
+            return
+        try:
+            info = media_tools.probe_info(file_path)
+            layout = media_thumbs.sprite_layout(info['duration'], info['width'], info['height'])
+            if layout is None:
+                return
+            if self.thumb_cache is None:
+                self.thumb_cache = DiskCache(THUMB_CACHE_DIR, THUMB_CACHE_BYTES)
+            key = f'thumbs:{file_fingerprint(file_path)}:' + json.dumps(layout, sort_keys=True)
+            sprite = self.thumb_cache.get_or_create(
+                key, '.jpg', lambda temp_path: media_thumbs.make_sprite(file_path, temp_path, layout))
+        except (OSError, media_tools.FFmpegError) as e:
+            print(f"生成预览缩略图失败: {e}")
+            return
+        self.thumbnails_ready.emit(file_path, sprite, layout)
+
+    def on_thumbnails_ready(self, file_path, sprite, layout):
+        if file_path != self.current_file:
+            return
+        pixmap = QPixmap(sprite)
+        if not pixmap.isNull():
+            self.thumb_sprite = pixmap
+            self.thumb_layout = layout
+
+    def build_waveform(self, file_path):
+        """在后台线程生成（或从缓存取）波形，完成后发出 waveform_ready"""
+        if file_path != self.current_file:
+            return
+        try:
+            if self.waveform_cache is None:
+                self.waveform_cache = DiskCache(WAVEFORM_CACHE_DIR, WAVEFORM_CACHE_BYTES)
+            key = f'waveform:{file_fingerprint(file_path)}:8:{waveform.VERSION}'
+            peaks = self.waveform_cache.get_or_create(
+                key, '.peaks', lambda temp_path: waveform.build_waveform(file_path, temp_path))
+        except (OSError, media_tools.FFmpegError, waveform.WaveformError) as e:
+            print(f"生成波形失败: {e}")
+            return
+        self.waveform_ready.emit(file_path, peaks)
+
+    def on_waveform_ready(self, file_path, peaks):
+        if file_path == self.current_file:
+            self.waveform.set_waveform(peaks)
+
+    def show_thumbnail(self, position):
+        """在进度条上方显示 position（毫秒）处的画面"""
+        layout = self.thumb_layout
+        x, y = media_thumbs.tile_at(layout, position / 1000)
+        width, height = layout['tile_width'], layout['tile_height']
+        self.thumb_preview.setPixmap(self.thumb_sprite.copy(x, y, width, height))
+        self.thumb_preview.adjustSize()
+
+        slider = self.progress_slider
+        offset = QStyle.sliderPositionFromValue(slider.minimum(), slider.maximum(),
+                                                position, slider.width())
+        preview_width = self.thumb_preview.width()
+        left = min(max(offset - preview_width // 2, 0), slider.width() - preview_width)
+        self.thumb_preview.move(slider.mapToGlobal(QPoint(left, -self.thumb_preview.height() - 6)))
+        self.thumb_preview.show()
+        self.time_label.setText(
+            f"{self.format_time(position)} / {self.format_time(self.media_player.duration())}"
+        )
+
+    def eventFilter(self, obj, event):
+        # 鼠标悬停在进度条上时预览该位置
+        if obj is self.progress_slider and self.thumb_sprite is not None \
+                and not self.progress_slider.isSliderDown():
+            if event.type() == QEvent.Type.MouseMove:
+                slider = self.progress_slider
+                position = QStyle.sliderValueFromPosition(
+                    slider.minimum(), slider.maximum(), int(event.position().x()), slider.width())
+                self.show_thumbnail(position)
+            elif event.type() == QEvent.Type.Leave:
+                self.thumb_preview.hide()
+                self.update_time_label()
+        return super().eventFilter(obj, event)
+
     def play_pause(self):
         if self.media_player.playbackState() == QMediaPlayer.PlaybackState.PlayingState:
             self.media_player.pause()
@@ -339,8 +602,10 @@ class VideoPlayer(QMainWindow):
             self.play_btn.setText("▶️ 播放")
 
     def position_changed(self, position):
-        self.progress_slider.setValue(position)
-        self.update_time_label()
+        if not self.progress_slider.isSliderDown():
+            self.progress_slider.setValue(position)
+            self.update_time_label()
+        self.waveform.set_position(position)
 
         # AB循环检查
         if self.ab_loop_enabled and self.ab_btn.is_b_set:
@@ -359,7 +624,17 @@ class VideoPlayer(QMainWindow):
         )
 
     def set_position(self, position):
-        self.media_player.setPosition(position)
+        # 有缩略图时拖动中只显示预览，松开后再跳转
+        if self.thumb_sprite is not None:
+            self.show_thumbnail(position)
+        else:
+            self.media_player.setPosition(position)
+
+    def slider_released(self):
+        if self.thumb_sprite is not None:
+            self.media_player.setPosition(self.progress_slider.value())
+            self.thumb_preview.hide()
+            self.update_time_label()
 
     def update_position(self):
         pass  # 由 positionChanged 信号处理
@@ -405,10 +680,12 @@ class VideoPlayer(QMainWindow):
                 self.statusBar().showMessage(
                     f"B点已设置: {self.format_time(current_pos)} - AB循环已启动"
                 )
+        self.waveform.set_loop(self.ab_btn.point_a, self.ab_btn.point_b)
 
     def clear_ab_loop(self):
         self.ab_btn.reset()
         self.ab_loop_enabled = False
+        self.waveform.set_loop(None, None)
         self.statusBar().showMessage("AB点已清除")
 
     def take_screenshot(self):